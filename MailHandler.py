@@ -15,6 +15,36 @@ from abc import ABCMeta, abstractmethod
 class MailHandler(object):
 	__metaclass__ = ABCMeta
 
+	# What a handler needs from a received mail. The proxy parses the mail
+	# only as far as the enabled handlers need it.
+	ENVELOPE	= 'envelope'	# only the sender and recipients. *message* is None.
+	HEADERS		= 'headers'		# the header fields. *message* has no payload.
+	FULL		= 'full'		# the complete MIME tree. It is parsed on the first access to the payload.
+
+	needs = FULL
+
+	# A handler can be run in a separate worker process (see the
+	# 'handlerprocesses' setting), so that CPU intensive work doesn't block
+	# the proxy. Such a handler is stopped after 'timeout' seconds, which
+	# include the wait for a free worker process, and then (or when its
+	# process crashed) the 'onTimeout' policy applies.
+	ACCEPT		= 'accept'		# accept the mail without calling the remaining handlers
+	TEMPFAIL	= 'tempfail'	# reject the mail with a temporary error, the client may try again
+	SKIP		= 'skip'		# ignore the handler and continue with the next one
+
+	# A handler runs either while the mail is received, so that it can change
+	# or discard the mail, or after the mail was accepted and stored, by a
+	# separate thread. The latter is for handlers that only have side
+	# effects; their result and their changes of the mail are ignored.
+	SYNC		= 'sync'
+	ASYNC		= 'async'
+
+	phase		= SYNC
+
+	process		= False
+	timeout		= None
+	onTimeout	= ACCEPT
+
 	@abstractmethod
 	def isEnabled(self):
 		"""Check whether the implementing handler should be executed.
@@ -32,7 +62,8 @@ class MailHandler(object):
 	@abstractmethod
 	def handleMessage(self, message, mail, callback):
 		"""This message is called to handle a message. The *message* is an email 
-		   object that conforms to the Python email library package. *mail* is an internal Mail object with the
+		   object that conforms to the Python email library package, or None if
+		   the handler only needs the envelope (see *needs*). *mail* is an internal Mail object with the
 		   fields 'Mail.to', 'Mail.frm' and 'Mail.msg'. *callback* is an object with two methods 'setTo(string)' and
 		   'setFrom(string)' to set the respective header fields.
 		   See [https://docs.python.org/2/library/email.html](https://docs.python.org/2/library/email.html) for details.
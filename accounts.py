@@ -0,0 +1,122 @@
+#
+# accounts.py
+#
+# Author: Andreas Kraft (akr@mheg.org)
+#
+# DISCLAIMER
+# You are free to use this code in any way you like, subject to the
+# Python disclaimers & copyrights. I make no representations about the
+# suitability of this software for any purpose. It is provided "AS-IS"
+# without warranty of any kind, either express or implied. So there.
+#
+"""	Finds the mail account of a sender address.
+
+	The names of the account sections are rules for the sender addresses:
+
+	* name@example.com - Only this address.
+	* *@example.com - Every address of the domain example.com.
+	* *@*.example.com - Every address of a subdomain of example.com, e.g.
+	  name@mail.example.com, but not of example.com itself.
+
+	An exact address is preferred over a domain, and a domain over a
+	subdomain rule. Of several subdomain rules the most specific one wins.
+	Addresses and rules are compared case-insensitively.
+
+	The resolver is built once from the configured accounts. The 'use'
+	references of the accounts are followed to their end at that time, and
+	missing references and cycles are reported as errors. Lookups are
+	remembered, so that the addresses of frequent senders are found with a
+	single dictionary access.
+"""
+
+import threading
+
+
+class AccountResolver:
+	""" Resolves sender addresses to mail accounts. 'accounts' maps the
+		section names to the account objects, whose 'useconfig' attribute
+		names the account that is used instead, or is None.
+
+		Raises a ValueError if a referenced account doesn't exist or the
+		references form a cycle.
+	"""
+
+	# The maximum number of remembered lookups
+	cacheSize = 10000
+
+	def __init__(self, accounts):
+		self.accounts = accounts
+		self._names = {}		# section name -> account
+		self._exact = {}		# address or name -> account
+		self._domains = {}		# domain -> account
+		self._subdomains = {}	# parent domain -> account
+		self._cache = {}		# address -> account or None
+		self._lock = threading.Lock()
+		for (name, account) in accounts.items():
+			account = self._follow(name)
+			self._names[name] = account
+			rule = name.strip().lower()
+			if rule.startswith('*@*.'):
+				self._subdomains[rule[4:]] = account
+			elif rule.startswith('*@'):
+				self._domains[rule[2:]] = account
+			else:
+				self._exact[rule] = account
+
+
+	def _follow(self, name):
+		""" Return the account at the end of the 'use' references of the
+			account 'name'.
+		"""
+		seen = [ name ]
+		account = self.accounts[name]
+		while account.useconfig != None:
+			if account.useconfig not in self.accounts:
+				raise ValueError('No account data found for referenced configuration ' + account.useconfig + ' (' + seen[-1] + ')')
+			if account.useconfig in seen:
+				raise ValueError('Cyclic account references: ' + ' -> '.join(seen + [ account.useconfig ]))
+			seen.append(account.useconfig)
+			account = self.accounts[account.useconfig]
+		return account
+
+
+	def account(self, name):
+		""" Return the account of the section 'name' at the end of its 'use'
+			references, or None if there is no such section.
+		"""
+		return self._names.get(name)
+
+
+	def resolve(self, address):
+		""" Return the account for the sender 'address' (or an account name),
+			or None if no rule matches.
+		"""
+		try:
+			return self._cache[address]
+		except KeyError:
+			pass
+		account = self._lookup(address.strip().lower())
+		with self._lock:
+			if len(self._cache) >= self.cacheSize:
+				self._cache.clear()
+			self._cache[address] = account
+		return account
+
+
+	def _lookup(self, address):
+		account = self._exact.get(address)
+		if account != None:
+			return account
+		domain = address.rpartition('@')[2]
+		if not domain or domain == address:
+			return None
+		account = self._domains.get(domain)
+		if account != None:
+			return account
+		# Look for the most specific parent domain
+		while '.' in domain:
+			domain = domain.partition('.')[2]
+			account = self._subdomains.get(domain)
+			if account != None:
+				return account
+		return None
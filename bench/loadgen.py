@@ -0,0 +1,252 @@
+#
+# loadgen.py
+#
+# Author: Andreas Kraft (akr@mheg.org)
+#
+# DISCLAIMER
+# You are free to use this code in any way you like, subject to the
+# Python disclaimers & copyrights. I make no representations about the
+# suitability of this software for any purpose. It is provided "AS-IS"
+# without warranty of any kind, either express or implied. So there.
+#
+"""	A load generator for SMTP servers.
+
+	A number of concurrent connections each send a number of mails. The size
+	of the mails is chosen randomly from a weighted list of sizes. With
+	pipelining the MAIL, RCPT and DATA commands of a mail are sent in one
+	batch. Every mail gets the header fields 'X-Bench-Id' and 'X-Bench-Sent'
+	(the time it was sent), so that a receiving sink can measure the
+	end-to-end latency.
+
+	Usage: python loadgen.py [options] host port
+"""
+
+import argparse, json, random, socket, threading, time
+
+defaultSizes = '2048:70,16384:25,262144:5'
+
+
+def parseSizes(spec):
+	""" Parse a size distribution of the form 'size:weight,size:weight,...'.
+		Returns a list of (size, weight) tuples.
+	"""
+	sizes = []
+	for item in spec.split(','):
+		(size, _, weight) = item.strip().partition(':')
+		sizes.append((int(size), float(weight) if weight else 1.0))
+	return sizes
+
+
+def makeMessage(seq, size, frm, to):
+	""" Return a mail with about 'size' bytes, with CRLF line endings and
+		without lines that start with a dot.
+	"""
+	header = ('From: ' + frm + '\r\nTo: ' + to + '\r\nSubject: Benchmark mail ' + str(seq) +
+			  '\r\nX-Bench-Id: ' + str(seq) + '\r\nX-Bench-Sent: ' + repr(time.time()) + '\r\n\r\n').encode('ascii')
+	line = b'x' * 76 + b'\r\n'
+	count = max(1, (size - len(header)) // len(line))
+	return header + line * count
+
+
+def percentile(values, p):
+	""" Return the p-th percentile (0..100) of 'values' (nearest rank), or
+		None for an empty list.
+	"""
+	if len(values) == 0:
+		return None
+	values = sorted(values)
+	k = max(0, min(len(values) - 1, int(round(p / 100.0 * len(values) + 0.5)) - 1))
+	return values[k]
+
+
+def latencySummary(values):
+	""" Return the p50, p99 and maximum of a list of latencies in seconds.
+	"""
+	return { 'p50' : percentile(values, 50), 'p99' : percentile(values, 99), 'max' : max(values) if values else None }
+
+
+
+class LoadResult:
+	""" The outcome of a load run.
+
+		* sent - The number of mails that were accepted by the server.
+		* failed - The number of mails that were rejected, or lost with their connection.
+		* bytes - The number of message bytes that were accepted.
+		* latencies - The time from the MAIL command until the reply to the message data, per accepted mail.
+		* errors - The error replies and exceptions, with their numbers.
+		* started, finished - The times the run started and ended.
+	"""
+
+	def __init__(self):
+		self.sent		= 0
+		self.failed		= 0
+		self.bytes		= 0
+		self.latencies	= []
+		self.errors		= {}
+		self.started	= 0
+		self.finished	= 0
+		self._lock		= threading.Lock()
+
+
+	def accepted(self, size, latency):
+		with self._lock:
+			self.sent += 1
+			self.bytes += size
+			self.latencies.append(latency)
+
+
+	def rejected(self, error, count = 1):
+		with self._lock:
+			self.failed += count
+			self.errors[error] = self.errors.get(error, 0) + 1
+
+
+	def toDict(self):
+		seconds = self.finished - self.started
+		return {
+			'accepted'	: self.sent,
+			'failed'	: self.failed,
+			'bytes'		: self.bytes,
+			'seconds'	: seconds,
+			'rate'		: self.sent / seconds if seconds > 0 else None,
+			'latency'	: latencySummary(self.latencies),
+			'errors'	: self.errors,
+		}
+
+
+
+class SMTPClient:
+	""" A minimal SMTP client that can send pipelined commands.
+	"""
+
+	def __init__(self, host, port, timeout = 60):
+		self.sock = socket.create_connection((host, port), timeout)
+		self.rfile = self.sock.makefile('rb')
+
+
+	def reply(self):
+		""" Read one (possibly multi-line) reply. Returns (code, text).
+		"""
+		lines = []
+		while True:
+			line = self.rfile.readline()
+			if not line:
+				raise EOFError('Connection closed by server')
+			lines.append(line[4:].strip().decode('ascii', 'replace'))
+			if line[3:4] != b'-':
+				return (int(line[:3]), ' '.join(lines))
+
+
+	def send(self, data):
+		self.sock.sendall(data)
+
+
+	def close(self):
+		try:
+			self.send(b'QUIT\r\n')
+			self.reply()
+		except (OSError, EOFError, ValueError):
+			pass
+		self.rfile.close()
+		self.sock.close()
+
+
+
+def sendMails(host, port, count, sizes, pipelining, frm, to, result, nextSeq, rnd):
+	""" Send 'count' mails over one connection and record them in 'result'.
+		'nextSeq' returns the number of the next mail.
+	"""
+	try:
+		client = SMTPClient(host, port)
+	except OSError as e:
+		result.rejected('connect: ' + str(e), count)
+		return
+	sent = 0
+	try:
+		(code, text) = client.reply()
+		if code != 220:
+			result.rejected(str(code), count)
+			return
+		client.send(b'EHLO loadgen\r\n')
+		(code, text) = client.reply()
+		if code != 250:
+			client.send(b'HELO loadgen\r\n')
+			client.reply()
+		for i in range(count):
+			sent = i
+			seq = nextSeq()
+			size = rnd.choices([ s for (s, w) in sizes ], [ w for (s, w) in sizes ])[0]
+			started = time.time()
+			message = makeMessage(seq, size, frm, to)
+			envelope = [ ('MAIL FROM:<' + frm + '>\r\n').encode(), ('RCPT TO:<' + to + '>\r\n').encode(), b'DATA\r\n' ]
+			if pipelining:
+				client.send(b''.join(envelope))
+				replies = [ client.reply() for e in envelope ]
+			else:
+				replies = []
+				for e in envelope:
+					client.send(e)
+					replies.append(client.reply())
+					if replies[-1][0] >= 400:
+						break
+			if replies[-1][0] != 354:
+				code = [ c for (c, t) in replies if c >= 400 ][0]
+				result.rejected(str(code))
+				client.send(b'RSET\r\n')
+				client.reply()
+				continue
+			client.send(message + b'.\r\n')
+			(code, text) = client.reply()
+			if code == 250:
+				result.accepted(len(message), time.time() - started)
+			else:
+				result.rejected(str(code))
+	except (OSError, EOFError, ValueError) as e:
+		result.rejected(e.__class__.__name__, count - sent)
+	finally:
+		client.close()
+
+
+def run(host, port, connections = 10, messages = 10, sizes = defaultSizes, pipelining = False, frm = 'bench@localhost', to = 'sink@localhost', seed = None):
+	""" Open 'connections' concurrent connections to the SMTP server at
+		host:port and send 'messages' mails over each of them. Returns a
+		LoadResult.
+	"""
+	if not isinstance(sizes, list):
+		sizes = parseSizes(sizes)
+	result = LoadResult()
+	lock = threading.Lock()
+	seq = [ 0 ]
+	def nextSeq():
+		with lock:
+			seq[0] += 1
+			return seq[0]
+	threads = []
+	result.started = time.time()
+	for i in range(connections):
+		rnd = random.Random(seed + i if seed != None else None)
+		t = threading.Thread(target=sendMails, args=(host, port, messages, sizes, pipelining, frm, to, result, nextSeq, rnd), name='loadgen-' + str(i))
+		t.daemon = True
+		t.start()
+		threads.append(t)
+	for t in threads:
+		t.join()
+	result.finished = time.time()
+	return result
+
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Send mails to an SMTP server with concurrent connections.')
+	parser.add_argument('host')
+	parser.add_argument('port', type=int)
+	parser.add_argument('--connections', type=int, default=10, help='number of concurrent connections (default 10)')
+	parser.add_argument('--messages', type=int, default=10, help='mails per connection (default 10)')
+	parser.add_argument('--sizes', default=defaultSizes, help='size distribution, size:weight,... (default ' + defaultSizes + ')')
+	parser.add_argument('--pipelining', action='store_true', help='send MAIL, RCPT and DATA in one batch')
+	parser.add_argument('--from', dest='frm', default='bench@localhost', help='sender address')
+	parser.add_argument('--to', default='sink@localhost', help='recipient address')
+	parser.add_argument('--seed', type=int, default=None, help='seed for the size distribution')
+	args = parser.parse_args()
+	result = run(args.host, args.port, args.connections, args.messages, args.sizes, args.pipelining, args.frm, args.to, args.seed)
+	print(json.dumps(result.toDict(), indent=4, sort_keys=True))
@@ -0,0 +1,216 @@
+#
+# runner.py
+#
+# Author: Andreas Kraft (akr@mheg.org)
+#
+# DISCLAIMER
+# You are free to use this code in any way you like, subject to the
+# Python disclaimers & copyrights. I make no representations about the
+# suitability of this software for any purpose. It is provided "AS-IS"
+# without warranty of any kind, either express or implied. So there.
+#
+"""	Runs a benchmark of the proxy and reports the results as JSON.
+
+	The runner starts the upstream sink, writes a configuration for the
+	proxy into a temporary directory and starts the proxy there as a
+	separate process. It then sends mails with the load generator, waits
+	until the proxy relayed them to the sink, and reports:
+
+	* accept - The rate at which the proxy accepted mails, and the p50/p99
+	  latency from the MAIL command to the reply to the message data.
+	* relay - The end-to-end throughput (delivered mails per second from the
+	  start of the load until the last mail arrived at the sink), and the
+	  p50/p99 latency from sending a mail to its arrival at the sink.
+
+	With --baseline the results are compared with those of an earlier run,
+	e.g. of the previous version.
+
+	Usage: python bench/runner.py [options]
+"""
+
+import argparse, json, os, platform, shutil, socket, subprocess, sys, tempfile, time
+import loadgen, upstream
+
+proxyDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The results that are compared with a baseline, and whether larger is better
+comparedResults = [ ('accept.rate', True), ('accept.latency.p50', False), ('accept.latency.p99', False),
+					('relay.throughput', True), ('relay.latency.p50', False), ('relay.latency.p99', False) ]
+
+
+def freePort():
+	s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	s.bind(('127.0.0.1', 0))
+	port = s.getsockname()[1]
+	s.close()
+	return port
+
+
+def waitForPort(port, timeout):
+	deadline = time.time() + timeout
+	while time.time() < deadline:
+		try:
+			socket.create_connection(('127.0.0.1', port), 1).close()
+			return True
+		except OSError:
+			time.sleep(0.1)
+	return False
+
+
+def writeConfig(directory, args, proxyPort, sink):
+	""" Write the smtpproxy.ini for the benchmark.
+	"""
+	lines = [ '[config]',
+			  'port=' + str(proxyPort),
+			  'engine=' + args.engine,
+			  'deleteonerror=true',
+			  'maxattempts=' + str(args.max_attempts),
+			  'retrydelay=' + str(args.retry_delay),
+			  'waitafterpop=0',
+			  'handlers=' + ' '.join(args.handlers) ] + args.option + [
+			  '',
+			  '[logging]',
+			  'file=smtpproxy.log',
+			  'level=' + args.log_level,
+			  'console=false',
+			  '',
+			  '[' + args.frm + ']',
+			  'smtphost=127.0.0.1',
+			  'smtpport=' + str(sink.smtpPort) ]
+	if sink.popPort != None:
+		lines += [ 'popbeforesmtp=true', 'pophost=127.0.0.1', 'popport=' + str(sink.popPort), 'popssl=false',
+				   'popusername=bench', 'poppassword=bench', 'popcheckdelay=' + str(args.pop_check_delay) ]
+	lines += [ '', '[default]', 'use=' + args.frm, '' ]
+	with open(os.path.join(directory, 'smtpproxy.ini'), 'w') as f:
+		f.write('\n'.join(lines) + '\n')
+
+
+def waitForRelay(sink, ids, idleTimeout, timeout):
+	""" Wait until all mails in 'ids' arrived at the sink, or nothing
+		happened for 'idleTimeout' seconds. Returns the set of arrived mails.
+	"""
+	deadline = time.time() + timeout
+	last = None
+	lastChange = time.time()
+	while time.time() < deadline:
+		count = sink.count()
+		if count != last:
+			(last, lastChange) = (count, time.time())
+		arrived = set([ r[1] for r in list(sink.received) ]) & ids
+		if len(arrived) == len(ids) or time.time() - lastChange > idleTimeout:
+			return arrived
+		time.sleep(0.1)
+	return set([ r[1] for r in list(sink.received) ]) & ids
+
+
+def version():
+	""" Return the git description of the proxy's source tree, if available.
+	"""
+	try:
+		return subprocess.check_output([ 'git', 'describe', '--always', '--dirty' ], cwd=proxyDir, stderr=subprocess.DEVNULL).decode().strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def lookup(results, path):
+	for key in path.split('.'):
+		if not isinstance(results, dict) or key not in results:
+			return None
+		results = results[key]
+	return results
+
+
+def compare(results, baseline):
+	""" Compare the main results with those of a baseline run. A negative
+		change is a regression.
+	"""
+	changes = {}
+	for (path, larger) in comparedResults:
+		(old, new) = (lookup(baseline, path), lookup(results, path))
+		change = None
+		if old and new != None:
+			change = (new - old) / float(old) * 100
+			if not larger:
+				change = -change
+		changes[path] = { 'baseline' : old, 'current' : new, 'change' : change }
+	return changes
+
+
+def run(args):
+	sink = upstream.UpstreamSink(0, 0 if args.pop else None, args.latency, args.data_latency, args.error_rate, args.error_reply, args.pop_latency, args.seed)
+	directory = tempfile.mkdtemp(prefix='smtpproxy-bench-')
+	proxyPort = freePort()
+	writeConfig(directory, args, proxyPort, sink)
+	proxy = subprocess.Popen([ sys.executable, os.path.join(proxyDir, 'smtpproxy.py') ], cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+	try:
+		if not waitForPort(proxyPort, 30):
+			raise Exception('The proxy did not start, see ' + os.path.join(directory, 'smtpproxy.log'))
+		load = loadgen.run('127.0.0.1', proxyPort, args.connections, args.messages, args.sizes, args.pipelining, args.frm, 'sink@localhost', args.seed)
+		ids = set(range(1, args.connections * args.messages + 1))
+		arrived = waitForRelay(sink, ids, args.idle_timeout, args.timeout)
+	finally:
+		proxy.terminate()
+		proxy.wait()
+		sink.stop()
+
+	received = [ r for r in sink.received if r[1] in arrived ]
+	seconds = max([ r[0] for r in received ]) - load.started if received else 0
+	results = {
+		'version'		: version(),
+		'python'		: platform.python_version(),
+		'parameters'	: dict([ (k, v) for (k, v) in vars(args).items() if k not in ('baseline', 'output', 'keep') ]),
+		'accept'		: load.toDict(),
+		'relay'			: {
+			'delivered'		: len(arrived),
+			'missing'		: load.sent - len(arrived),
+			'rejected'		: sink.rejected,
+			'connections'	: sink.connections,
+			'popLogins'		: sink.popLogins,
+			'seconds'		: seconds,
+			'throughput'	: len(arrived) / seconds if seconds > 0 else None,
+			'latency'		: loadgen.latencySummary([ r[2] for r in received ]),
+		},
+	}
+	if args.baseline != None:
+		with open(args.baseline) as f:
+			results['comparison'] = compare(results, json.load(f))
+	if args.keep:
+		results['directory'] = directory
+	else:
+		shutil.rmtree(directory, ignore_errors=True)
+	return results
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Benchmark the SMTP proxy with a local upstream sink.')
+	parser.add_argument('--connections', type=int, default=10, help='number of concurrent client connections (default 10)')
+	parser.add_argument('--messages', type=int, default=20, help='mails per connection (default 20)')
+	parser.add_argument('--sizes', default=loadgen.defaultSizes, help='size distribution, size:weight,... (default ' + loadgen.defaultSizes + ')')
+	parser.add_argument('--pipelining', action='store_true', help='pipeline MAIL, RCPT and DATA')
+	parser.add_argument('--from', dest='frm', default='bench@localhost', help='sender address, also the name of the account')
+	parser.add_argument('--engine', default='thread', choices=[ 'thread', 'asyncio' ], help='engine of the proxy (default thread)')
+	parser.add_argument('--handlers', nargs='*', default=[], help='mail handlers to enable (default none)')
+	parser.add_argument('--option', action='append', default=[], help='additional [config] setting of the proxy, e.g. deliveryworkers=8')
+	parser.add_argument('--max-attempts', type=int, default=3, help='delivery attempts of the proxy (default 3)')
+	parser.add_argument('--retry-delay', type=int, default=1, help='retry delay of the proxy, in seconds (default 1)')
+	parser.add_argument('--log-level', default='WARNING', help='log level of the proxy (default WARNING)')
+	parser.add_argument('--latency', type=float, default=0.0, help='delay of every reply of the SMTP sink, in seconds')
+	parser.add_argument('--data-latency', type=float, default=0.0, help='additional delay of the reply to the message data, in seconds')
+	parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of mails that the sink rejects (0..1)')
+	parser.add_argument('--error-reply', default='451 Injected error', help='reply of the sink for rejected mails')
+	parser.add_argument('--pop', action='store_true', help='use POP-before-SMTP with the POP3 sink')
+	parser.add_argument('--pop-latency', type=float, default=0.0, help='delay of every reply of the POP3 sink, in seconds')
+	parser.add_argument('--pop-check-delay', type=int, default=60, help='popcheckdelay of the account (default 60)')
+	parser.add_argument('--seed', type=int, default=1, help='seed for the size distribution and the error injection (default 1)')
+	parser.add_argument('--idle-timeout', type=float, default=15, help='stop waiting for the relay after this many seconds without progress (default 15)')
+	parser.add_argument('--timeout', type=float, default=600, help='maximum time to wait for the relay, in seconds (default 600)')
+	parser.add_argument('--baseline', default=None, help='JSON results of an earlier run to compare with')
+	parser.add_argument('--output', default=None, help='write the results to this file instead of stdout')
+	parser.add_argument('--keep', action='store_true', help='keep the directory of the proxy')
+	args = parser.parse_args()
+	results = json.dumps(run(args), indent=4, sort_keys=True)
+	if args.output != None:
+		with open(args.output, 'w') as f:
+			f.write(results + '\n')
+	else:
+		print(results)
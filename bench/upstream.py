@@ -0,0 +1,203 @@
+#
+# upstream.py
+#
+# Author: Andreas Kraft (akr@mheg.org)
+#
+# DISCLAIMER
+# You are free to use this code in any way you like, subject to the
+# Python disclaimers & copyrights. I make no representations about the
+# suitability of this software for any purpose. It is provided "AS-IS"
+# without warranty of any kind, either express or implied. So there.
+#
+"""	A local stand-in for the remote SMTP and POP3 servers.
+
+	The SMTP sink accepts all mails and throws them away. It records when a
+	mail arrived and, for mails sent by the load generator, the end-to-end
+	latency from the 'X-Bench-Sent' header field. Every reply can be delayed,
+	and a fraction of the mails can be rejected at the end of the DATA
+	command to test the retry handling. The POP3 sink accepts every login.
+
+	Usage: python upstream.py [options]
+"""
+
+import argparse, random, threading, time
+try:
+	import socketserver
+except ImportError:
+	import SocketServer as socketserver
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+	request_queue_size = 128
+
+
+
+class UpstreamSink:
+	""" An SMTP sink and an optional POP3 sink on the local host.
+
+		* smtpPort, popPort - The ports to listen on. 0 picks a free port, and None disables the POP3 sink.
+		* latency - The delay of every SMTP reply, in seconds.
+		* dataLatency - An additional delay of the reply to the message data, in seconds.
+		* errorRate - The fraction of mails that are rejected after the message data (0..1).
+		* errorReply - The reply for rejected mails.
+		* popLatency - The delay of every POP3 reply, in seconds.
+	"""
+
+	def __init__(self, smtpPort = 0, popPort = None, latency = 0.0, dataLatency = 0.0, errorRate = 0.0, errorReply = '451 Injected error', popLatency = 0.0, seed = None):
+		self.latency = latency
+		self.dataLatency = dataLatency
+		self.errorRate = errorRate
+		self.errorReply = errorReply
+		self.popLatency = popLatency
+		self.received = []		# list of (arrival time, mail number or None, end-to-end latency or None, size)
+		self.rejected = 0
+		self.connections = 0
+		self.popLogins = 0
+		self._random = random.Random(seed)
+		self._lock = threading.Lock()
+		self._servers = []
+		self.smtpPort = self._serve(smtpPort, self._smtpHandler())
+		self.popPort = self._serve(popPort, self._popHandler()) if popPort != None else None
+
+
+	def stop(self):
+		for s in self._servers:
+			s.shutdown()
+			s.server_close()
+
+
+	def count(self):
+		""" Return the number of received and rejected mails.
+		"""
+		with self._lock:
+			return (len(self.received), self.rejected)
+
+
+	def _serve(self, port, handler):
+		server = _Server(('127.0.0.1', port), handler)
+		t = threading.Thread(target=server.serve_forever, name='sink-' + str(server.server_address[1]))
+		t.daemon = True
+		t.start()
+		self._servers.append(server)
+		return server.server_address[1]
+
+
+	def _reject(self):
+		with self._lock:
+			return self._random.random() < self.errorRate
+
+
+	def _smtpHandler(self):
+		sink = self
+
+		class Handler(socketserver.StreamRequestHandler):
+
+			def reply(self, text):
+				if sink.latency > 0:
+					time.sleep(sink.latency)
+				self.wfile.write(text.encode('ascii') + b'\r\n')
+
+			def handle(self):
+				with sink._lock:
+					sink.connections += 1
+				self.reply('220 upstream sink ready')
+				while True:
+					line = self.rfile.readline()
+					if not line:
+						return
+					cmd = line[:4].upper()
+					if cmd == b'EHLO':
+						self.reply('250-upstream sink\r\n250-PIPELINING\r\n250 8BITMIME')
+					elif cmd == b'DATA':
+						self.reply('354 End data with <CR><LF>.<CR><LF>')
+						self.data()
+					elif cmd == b'QUIT':
+						self.reply('221 Bye')
+						return
+					elif cmd in (b'HELO', b'MAIL', b'RCPT', b'RSET', b'NOOP'):
+						self.reply('250 OK')
+					else:
+						self.reply('502 Command not implemented')
+
+			def data(self):
+				size = 0
+				seq = None
+				sent = None
+				inHeader = True
+				while True:
+					line = self.rfile.readline()
+					if not line or line == b'.\r\n':
+						break
+					size += len(line)
+					if inHeader:
+						if line == b'\r\n':
+							inHeader = False
+						elif line[:13].lower() == b'x-bench-sent:':
+							sent = float(line[13:].strip())
+						elif line[:11].lower() == b'x-bench-id:':
+							seq = int(line[11:].strip())
+				now = time.time()
+				if sink.dataLatency > 0:
+					time.sleep(sink.dataLatency)
+				if sink._reject():
+					with sink._lock:
+						sink.rejected += 1
+					self.reply(sink.errorReply)
+					return
+				with sink._lock:
+					sink.received.append((now, seq, now - sent if sent != None else None, size))
+				self.reply('250 OK')
+
+		return Handler
+
+
+	def _popHandler(self):
+		sink = self
+
+		class Handler(socketserver.StreamRequestHandler):
+
+			def reply(self, text):
+				if sink.popLatency > 0:
+					time.sleep(sink.popLatency)
+				self.wfile.write(text.encode('ascii') + b'\r\n')
+
+			def handle(self):
+				self.reply('+OK upstream sink ready')
+				while True:
+					line = self.rfile.readline()
+					if not line:
+						return
+					cmd = line[:4].upper()
+					if cmd == b'QUIT':
+						self.reply('+OK Bye')
+						return
+					if cmd == b'PASS':
+						with sink._lock:
+							sink.popLogins += 1
+					self.reply('+OK')
+
+		return Handler
+
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Run a local SMTP and POP3 sink.')
+	parser.add_argument('--smtp-port', type=int, default=2525, help='port of the SMTP sink (default 2525)')
+	parser.add_argument('--pop-port', type=int, default=None, help='port of the POP3 sink (default: none)')
+	parser.add_argument('--latency', type=float, default=0.0, help='delay of every SMTP reply, in seconds')
+	parser.add_argument('--data-latency', type=float, default=0.0, help='additional delay of the reply to the message data, in seconds')
+	parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of mails that are rejected (0..1)')
+	parser.add_argument('--error-reply', default='451 Injected error', help='reply for rejected mails')
+	parser.add_argument('--pop-latency', type=float, default=0.0, help='delay of every POP3 reply, in seconds')
+	args = parser.parse_args()
+	sink = UpstreamSink(args.smtp_port, args.pop_port, args.latency, args.data_latency, args.error_rate, args.error_reply, args.pop_latency)
+	print('SMTP sink on port ' + str(sink.smtpPort) + (', POP3 sink on port ' + str(sink.popPort) if sink.popPort != None else ''))
+	try:
+		while True:
+			time.sleep(10)
+			(received, rejected) = sink.count()
+			print(str(received) + ' mails received, ' + str(rejected) + ' rejected')
+	except KeyboardInterrupt:
+		sink.stop()
@@ -70,6 +70,17 @@ class Config(ConfigParser):
 			res = ConfigParser.getint(self, section, option)
 		return res
 
+	def getfloat(self, section, option, default=None):
+		""" Get an option value for a given section. If the option or section
+			is not found, return the value provided in default.
+
+			The return value is a float.
+		"""
+		res = default
+		if ConfigParser.has_option(self, section, option):
+			res = ConfigParser.getfloat(self, section, option)
+		return res
+
 	def getlist(self, section, option, default=None):
 		""" Get an option value for a given section. If the option or section
 			is not found, return the value provided in default. The value is
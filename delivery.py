@@ -0,0 +1,129 @@
+#
+# delivery.py
+#
+# Author: Andreas Kraft (akr@mheg.org)
+#
+# DISCLAIMER
+# You are free to use this code in any way you like, subject to the
+# Python disclaimers & copyrights. I make no representations about the
+# suitability of this software for any purpose. It is provided "AS-IS"
+# without warranty of any kind, either express or implied. So there.
+#
+"""	A pool of worker threads that deliver scheduled mails concurrently. """
+
+import collections, sys, threading
+
+
+class DeliveryQueue:
+	""" A queue of mails waiting for delivery. Mails are queued per account
+		and handed out round-robin over the accounts. An account never has
+		more mails in delivery at the same time than its limit allows.
+	"""
+
+	def __init__(self):
+		self._cond = threading.Condition()
+		self._queues = collections.OrderedDict()	# key -> deque of (id, item)
+		self._active = {}		# key -> number of mails in delivery
+		self._limits = {}		# key -> concurrency limit
+		self._ids = set()		# ids of queued and active mails
+		self._released = set()	# ids of active mails that were released early
+
+
+	def put(self, key, limit, id, item):
+		""" Queue 'item' for the account 'key', which may deliver at most
+			'limit' mails at the same time. 'id' identifies the mail. Returns
+			False if the mail is already queued or in delivery.
+		"""
+		with self._cond:
+			if id in self._ids:
+				return False
+			self._ids.add(id)
+			self._limits[key] = limit
+			self._queues.setdefault(key, collections.deque()).append((id, item))
+			self._cond.notify()
+			return True
+
+
+	def get(self, maxBatch = 1):
+		""" Wait for mails of an account that is below its limit. Returns a
+			tuple (key, items) with a list of up to 'maxBatch' tuples (id,
+			item) of the same account. The batch counts as one delivery for
+			the account's limit. 'done' must be called after the delivery.
+		"""
+		with self._cond:
+			while True:
+				for key in list(self._queues):
+					if self._active.get(key, 0) < self._limits[key]:
+						q = self._queues.pop(key)
+						items = [ q.popleft() for i in range(min(maxBatch, len(q))) ]
+						if q:
+							self._queues[key] = q	# re-append: round-robin
+						self._active[key] = self._active.get(key, 0) + 1
+						return (key, items)
+				self._cond.wait()
+
+
+	def release(self, id):
+		""" Mark the delivery of a single mail of a batch as finished before
+			the whole batch is done, so that the mail can be queued again,
+			e.g. for its next delivery attempt.
+		"""
+		with self._cond:
+			if id in self._ids:
+				self._ids.discard(id)
+				self._released.add(id)
+
+
+	def done(self, key, ids):
+		""" Mark the delivery of a batch of mails as finished.
+		"""
+		with self._cond:
+			for id in ids:
+				if id in self._released:
+					# Possibly queued again in the meantime
+					self._released.discard(id)
+				else:
+					self._ids.discard(id)
+			self._active[key] -= 1
+			if self._active[key] == 0:
+				del self._active[key]
+			self._cond.notify_all()
+
+
+	def __contains__(self, id):
+		with self._cond:
+			return id in self._ids
+
+
+	def __len__(self):
+		with self._cond:
+			return sum([ len(q) for q in self._queues.values() ])
+
+
+
+class DeliveryWorkers:
+	""" Starts 'count' worker threads that take batches of up to 'maxBatch'
+		mails of the same account from a DeliveryQueue and call
+		'deliver(key, items)' for each batch.
+	"""
+
+	def __init__(self, queue, deliver, count, log, maxBatch = 1):
+		self.queue = queue
+		self._deliver = deliver
+		self._log = log
+		self.maxBatch = maxBatch
+		for i in range(count):
+			t = threading.Thread(target=self._run, name='delivery-' + str(i))
+			t.daemon = True
+			t.start()
+
+
+	def _run(self):
+		while True:
+			(key, items) = self.queue.get(self.maxBatch)
+			try:
+				self._deliver(key, items)
+			except:
+				self._log.logerr('Delivery worker caught exception: ' +  str(sys.exc_info()[0]) +": " + str(sys.exc_info()[1]))
+			finally:
+				self.queue.done(key, [ id for (id, item) in items ])
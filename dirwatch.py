@@ -0,0 +1,82 @@
+#
+# dirwatch.py
+#
+# Author: Andreas Kraft (akr@mheg.org)
+#
+# DISCLAIMER
+# You are free to use this code in any way you like, subject to the
+# Python disclaimers & copyrights. I make no representations about the
+# suitability of this software for any purpose. It is provided "AS-IS"
+# without warranty of any kind, either express or implied. So there.
+#
+"""	Watch a directory for new files with the Linux inotify interface.
+
+	The interface is accessed through ctypes, so no additional package is
+	needed. On systems without inotify the watcher simply can't be started
+	and the caller has to fall back to polling.
+"""
+
+import ctypes, ctypes.util, os, struct, sys, threading
+
+IN_CLOSE_WRITE	= 0x00000008
+IN_MOVED_TO		= 0x00000080
+IN_Q_OVERFLOW	= 0x00004000
+IN_CLOEXEC		= 0o2000000
+
+_eventHeader = struct.Struct('iIII')
+
+
+class DirectoryWatcher:
+	""" Calls 'callback(name)' from a separate thread whenever a file in
+		'directory' is closed after writing or moved into it. 'name' is the
+		file name without the directory, or None if events were lost.
+	"""
+
+	def __init__(self, directory, callback, log):
+		self.directory = directory
+		self._callback = callback
+		self._log = log
+		self._fd = -1
+
+
+	def start(self):
+		""" Start watching. Returns False if inotify is not available.
+		"""
+		try:
+			libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+			fd = libc.inotify_init1(IN_CLOEXEC)
+			if fd < 0:
+				raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+			if libc.inotify_add_watch(fd, os.fsencode(self.directory), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+				os.close(fd)
+				raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+		except (OSError, AttributeError):
+			self._log.logwarn('Cannot watch directory ' + self.directory + ': ' + str(sys.exc_info()[1]))
+			return False
+		self._fd = fd
+		t = threading.Thread(target=self._run, name='dirwatch')
+		t.daemon = True
+		t.start()
+		return True
+
+
+	def _run(self):
+		while True:
+			try:
+				buf = os.read(self._fd, 65536)
+			except OSError:
+				self._log.logerr('Watching directory caught exception: ' + str(sys.exc_info()[1]))
+				return
+			pos = 0
+			while pos + _eventHeader.size <= len(buf):
+				(wd, mask, cookie, length) = _eventHeader.unpack_from(buf, pos)
+				pos += _eventHeader.size
+				name = buf[pos:pos+length].rstrip(b'\0')
+				pos += length
+				try:
+					if mask & IN_Q_OVERFLOW:
+						self._callback(None)
+					elif name:
+						self._callback(os.fsdecode(name))
+				except:
+					self._log.logerr('Directory watch callback caught exception: ' + str(sys.exc_info()[1]))
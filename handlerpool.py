@@ -0,0 +1,275 @@
+#
+# handlerpool.py
+#
+# Author: Andreas Kraft (akr@mheg.org)
+#
+# DISCLAIMER
+# You are free to use this code in any way you like, subject to the
+# Python disclaimers & copyrights. I make no representations about the
+# suitability of this software for any purpose. It is provided "AS-IS"
+# without warranty of any kind, either express or implied. So there.
+#
+"""	A pool of worker processes that run mail handlers.
+
+	Mail handlers that do CPU intensive work can be run in a separate
+	process, so that they don't hold the GIL of the proxy, and a crash or a
+	hanging handler doesn't affect the proxy. Every worker process loads its
+	own instances of the handlers. A worker that exceeds the timeout of a
+	handler is killed and replaced by a new one.
+"""
+
+import io, multiprocessing, sys, threading, time
+
+
+class HandlerTimeout(Exception):
+	""" Raised when a handler didn't finish in time. """
+	pass
+
+
+class HandlerCrashed(Exception):
+	""" Raised when the worker process died while running a handler. """
+	pass
+
+
+
+class HandlerResult:
+	""" The outcome of a handler call in a worker process.
+
+		* result - True, False, or 'modified' if the handler returned a message.
+		* headers - The list of (name, value) header fields if they were changed, or None.
+		* message - The complete message text if the message was changed, or None.
+		* frm, to - The sender and recipients of the mail after the call.
+		* calls - The list of callback calls (method name, argument) made by the handler.
+	"""
+
+	def __init__(self):
+		self.result		= True
+		self.headers	= None
+		self.message	= None
+		self.frm		= None
+		self.to			= None
+		self.calls		= []
+
+
+
+class HandlerPool:
+	""" Runs mail handlers in up to 'size' worker processes.
+
+		* handlers - A dictionary of the handler class names and the names of
+		  the modules that contain them.
+		* handlerDir - The directory with the handler modules.
+	"""
+
+	def __init__(self, handlers, handlerDir, size, log):
+		self._handlers = handlers
+		self._handlerDir = handlerDir
+		self.size = size
+		self._log = log
+		self._ctx = multiprocessing.get_context('spawn')
+		self._idle = []			# list of (process, connection)
+		self._count = 0			# number of worker processes
+		self._cond = threading.Condition()
+
+
+	def start(self):
+		""" Start all worker processes in advance.
+		"""
+		workers = [ self._spawn() for i in range(self.size) ]
+		with self._cond:
+			self._idle += workers
+			self._count += len(workers)
+
+
+	def call(self, name, needs, data, frm, to, timeout = None):
+		""" Run the handler 'name' in a worker process. 'data' is the message
+			(or only its header block) as bytes, or None. Returns a
+			HandlerResult. Raises HandlerTimeout if the handler didn't finish
+			within 'timeout' seconds, including the wait for a free worker,
+			HandlerCrashed if the worker process died, or the exception raised
+			by the handler.
+		"""
+		deadline = time.time() + timeout if timeout else None
+		worker = self._acquire(deadline)
+		if worker == None:
+			raise HandlerTimeout('No worker process for mail handler "' + name + '" became free within ' + str(timeout) + ' seconds')
+		(process, conn) = worker
+		try:
+			conn.send((name, needs, data, frm, to))
+			while True:
+				wait = max(0, deadline - time.time()) if deadline != None else None
+				if not conn.poll(wait):
+					self._kill(worker)
+					worker = None
+					raise HandlerTimeout('Mail handler "' + name + '" timed out after ' + str(timeout) + ' seconds')
+				(kind, value) = conn.recv()
+				if kind == 'log':
+					getattr(self._log, value[0])(value[1])
+					continue
+				if kind == 'error':
+					raise Exception(value)
+				return value
+		except (EOFError, OSError):
+			self._kill(worker)
+			worker = None
+			raise HandlerCrashed('Worker process of mail handler "' + name + '" died (exit code ' + str(process.exitcode) + ')')
+		finally:
+			if worker != None:
+				self._release(worker)
+
+
+	def _acquire(self, deadline = None):
+		""" Take an idle worker, or start a new one if there are less than
+			'size' workers. Returns None if no worker became free before the
+			time 'deadline'.
+		"""
+		with self._cond:
+			while len(self._idle) == 0 and self._count >= self.size:
+				if deadline == None:
+					self._cond.wait()
+				elif deadline <= time.time():
+					return None
+				else:
+					self._cond.wait(deadline - time.time())
+			if len(self._idle) > 0:
+				return self._idle.pop()
+			self._count += 1
+		try:
+			return self._spawn()
+		except:
+			with self._cond:
+				self._count -= 1
+				self._cond.notify()
+			raise
+
+
+	def _release(self, worker):
+		with self._cond:
+			self._idle.append(worker)
+			self._cond.notify()
+
+
+	def _spawn(self):
+		""" Start a new worker process.
+		"""
+		(conn, child) = self._ctx.Pipe()
+		process = self._ctx.Process(target=_worker, args=(child, self._handlers, self._handlerDir), name='handler-worker')
+		process.daemon = True
+		process.start()
+		child.close()
+		return (process, conn)
+
+
+	def _kill(self, worker):
+		""" Terminate a worker process that timed out or died.
+		"""
+		(process, conn) = worker
+		try:
+			process.kill()
+			process.join(5)
+			conn.close()
+		except:
+			pass
+		with self._cond:
+			self._count -= 1
+			self._cond.notify()
+
+
+
+class _WorkerLogger:
+	""" A logger for the handlers in a worker process. The messages are sent
+		to the proxy, which writes them to its log.
+	"""
+
+	def __init__(self, conn):
+		self._conn = conn
+
+	def log(self, msg, *args):
+		self._conn.send(('log', ('log', msg % args if args else msg)))
+
+	def logwarn(self, msg, *args):
+		self._conn.send(('log', ('logwarn', msg % args if args else msg)))
+
+	def logerr(self, msg, *args):
+		self._conn.send(('log', ('logerr', msg % args if args else msg)))
+
+	def logdebug(self, msg, *args):
+		self._conn.send(('log', ('logdebug', msg % args if args else msg)))
+
+
+
+class _WorkerMail:
+	""" The Mail object that is passed to a handler in a worker process.
+	"""
+
+	def __init__(self, frm, to, msg):
+		self.frm	= frm
+		self.to		= to
+		self.msg	= msg
+
+
+
+class _WorkerCallback:
+	""" Records the callback calls of a handler in a worker process.
+	"""
+
+	def __init__(self, mail):
+		self.mail = mail
+		self.calls = []
+
+	def setTo(self, newTo):
+		self.calls.append(('setTo', newTo))
+		self.mail.to = [ newTo ]
+
+	def setFrom(self, newFrom):
+		self.calls.append(('setFrom', newFrom))
+		self.mail.frm = newFrom
+
+
+
+def _worker(conn, handlers, handlerDir):
+	""" The main function of a worker process.
+	"""
+	import headers, MailHandler
+
+	logger = _WorkerLogger(conn)
+	instances = {}
+	sys.path.append(handlerDir)
+	for (name, module) in handlers.items():
+		h = getattr(__import__(module), name)()
+		h.setLogger(logger)
+		instances[name] = h
+
+	while True:
+		try:
+			(name, needs, data, frm, to) = conn.recv()
+		except (EOFError, KeyboardInterrupt):
+			return
+		try:
+			message = None
+			text = None
+			if data != None:
+				fp = io.BytesIO(data)
+				(fields, separator) = headers.readHeader(fp)
+				message = headers.LazyMessage(fields, separator, fp)
+				text = message.text()
+			mail = _WorkerMail(frm, list(to), text)
+			callback = _WorkerCallback(mail)
+			rv = instances[name].handleMessage(message if needs != MailHandler.MailHandler.ENVELOPE else None, mail, callback)
+			result = HandlerResult()
+			if rv is True or rv is False or rv is None:
+				result.result = bool(rv)
+			elif message != None:
+				result.result = 'modified'
+				message.modified(rv)
+			if message != None:
+				changed = message.changed()
+				if changed == 'body':
+					result.message = message.full().as_string()
+				elif changed == 'headers':
+					result.headers = [ (n, str(v)) for (n, v) in message.headers().items() ]
+			result.frm = mail.frm
+			result.to = mail.to
+			result.calls = callback.calls
+			conn.send(('result', result))
+		except:
+			conn.send(('error', str(sys.exc_info()[0]) + ': ' + str(sys.exc_info()[1])))
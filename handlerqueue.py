@@ -0,0 +1,205 @@
+#
+# handlerqueue.py
+#
+# Author: Andreas Kraft (akr@mheg.org)
+#
+# DISCLAIMER
+# You are free to use this code in any way you like, subject to the
+# Python disclaimers & copyrights. I make no representations about the
+# suitability of this software for any purpose. It is provided "AS-IS"
+# without warranty of any kind, either express or implied. So there.
+#
+"""	A queue for the mail handlers that run after a mail was accepted.
+
+	These handlers only have side effects, so they don't need to delay the
+	answer to the client. A job keeps a hard link to the spooled message
+	file, so the message is still available when the mail was already
+	delivered, and a small job file with the envelope and the names of the
+	handlers that still have to be called. Jobs are therefore not lost when
+	the proxy is restarted.
+"""
+
+import heapq, json, os, shutil, sys, threading, time
+
+jobSuffix		= '.job'
+messageSuffix	= '.eml'
+tmpSuffix		= '.tmp'
+
+
+class HandlerJob:
+	""" The handlers that still have to be called for one mail.
+	"""
+
+	def __init__(self, name, frm = '', to = None, handlers = None):
+		self.name		= name			# name of the job, without suffix
+		self.frm		= frm
+		self.to			= to if to != None else []
+		self.handlers	= handlers if handlers != None else []
+		self.attempts	= 0
+
+
+
+class HandlerQueue:
+	""" Runs queued jobs with 'workers' threads, by calling 'run(job,
+		messageFile)'. 'run' returns the list of handler names that failed,
+		which are retried after 'retryDelay' seconds (doubled with every
+		attempt), until 'maxAttempts' attempts were made.
+
+		The queue holds at most 'maxQueued' jobs, including jobs that wait
+		for a retry. A slot must be reserved before a job is submitted.
+	"""
+
+	def __init__(self, directory, run, log, workers = 2, maxQueued = 100, maxAttempts = 3, retryDelay = 30):
+		self.directory = directory
+		self._run = run
+		self._log = log
+		self.maxQueued = maxQueued
+		self.maxAttempts = maxAttempts
+		self.retryDelay = retryDelay
+		self._cond = threading.Condition()
+		self._jobs = []		# heap of (due time, sequence, job)
+		self._seq = 0
+		self._slots = 0		# queued, running and reserved jobs
+		if not os.path.exists(directory):
+			os.makedirs(directory)
+		for i in range(workers):
+			t = threading.Thread(target=self._work, name='handlerqueue-' + str(i))
+			t.daemon = True
+			t.start()
+
+
+	def reserve(self, timeout):
+		""" Reserve a slot for a job. Waits up to 'timeout' seconds while the
+			queue is full. Returns False if no slot became free.
+		"""
+		deadline = time.time() + timeout
+		with self._cond:
+			while self._slots >= self.maxQueued:
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					return False
+				self._cond.wait(remaining)
+			self._slots += 1
+			return True
+
+
+	def cancel(self):
+		""" Give back a reserved slot that isn't used.
+		"""
+		with self._cond:
+			self._slots -= 1
+			self._cond.notify_all()
+
+
+	def submit(self, messageFile, frm, to, handlers):
+		""" Queue a job for the message in 'messageFile', using a reserved slot.
+			The message file is linked (or copied) into the queue directory.
+		"""
+		job = HandlerJob(os.path.basename(messageFile)[:-len(messageSuffix)], frm, to, handlers)
+		try:
+			mfn = self._path(job, messageSuffix)
+			try:
+				os.link(messageFile, mfn)
+			except OSError:
+				shutil.copyfile(messageFile, mfn)
+			self._write(job)
+		except:
+			self.cancel()
+			raise
+		self._queue(job, 0)
+
+
+	def recover(self):
+		""" Queue the jobs that were left in the queue directory, e.g. by a
+			restart. They are queued even if the queue is full. Returns the
+			number of recovered jobs.
+		"""
+		count = 0
+		for e in os.listdir(self.directory):
+			fn = os.path.join(self.directory, e)
+			if e.endswith(tmpSuffix):
+				os.remove(fn)
+				continue
+			if not e.endswith(jobSuffix):
+				continue
+			try:
+				with open(fn, 'rb') as f:
+					d = json.loads(f.read().decode())
+				job = HandlerJob(e[:-len(jobSuffix)], d['frm'], d['to'], d['handlers'])
+				job.attempts = d.get('attempts', 0)
+			except (OSError, ValueError, KeyError):
+				self._log.logerr('Cannot read handler job ' + fn + ': ' + str(sys.exc_info()[1]))
+				continue
+			with self._cond:
+				self._slots += 1
+			self._queue(job, 0)
+			count += 1
+		return count
+
+
+	def __len__(self):
+		with self._cond:
+			return len(self._jobs)
+
+
+	def _queue(self, job, delay):
+		with self._cond:
+			self._seq += 1
+			heapq.heappush(self._jobs, (time.time() + delay, self._seq, job))
+			self._cond.notify_all()
+
+
+	def _work(self):
+		while True:
+			with self._cond:
+				while True:
+					now = time.time()
+					if len(self._jobs) > 0 and self._jobs[0][0] <= now:
+						(_, _, job) = heapq.heappop(self._jobs)
+						break
+					self._cond.wait(self._jobs[0][0] - now if len(self._jobs) > 0 else None)
+			try:
+				failed = self._run(job, self._path(job, messageSuffix))
+			except:
+				self._log.logerr('Handler job caught exception: ' +  str(sys.exc_info()[0]) +": " + str(sys.exc_info()[1]))
+				failed = job.handlers
+			self._finish(job, failed)
+
+
+	def _finish(self, job, failed):
+		""" Remove a finished job, or schedule the failed handlers again.
+		"""
+		job.attempts += 1
+		if len(failed) > 0 and job.attempts < self.maxAttempts:
+			job.handlers = failed
+			delay = self.retryDelay * 2 ** (job.attempts - 1)
+			self._log.log('Mail handlers ' + ', '.join(failed) + ' failed for ' + job.name + ', next attempt in ' + str(delay) + ' seconds')
+			try:
+				self._write(job)
+			except:
+				self._log.logerr('Writing handler job caught exception: ' +  str(sys.exc_info()[0]) +": " + str(sys.exc_info()[1]))
+			self._queue(job, delay)
+			return
+		if len(failed) > 0:
+			self._log.logerr('Mail handlers ' + ', '.join(failed) + ' failed for ' + job.name + ', giving up')
+		for suffix in (jobSuffix, messageSuffix):
+			try:
+				os.remove(self._path(job, suffix))
+			except OSError:
+				pass
+		with self._cond:
+			self._slots -= 1
+			self._cond.notify_all()
+
+
+	def _path(self, job, suffix):
+		return os.path.join(self.directory, job.name + suffix)
+
+
+	def _write(self, job):
+		""" Atomically (re)write the job file.
+		"""
+		fn = self._path(job, jobSuffix)
+		with open(fn + tmpSuffix, 'wb') as f:
+			f.write(json.dumps({ 'frm' : job.frm, 'to' : job.to, 'handlers' : job.handlers, 'attempts' : job.attempts }).encode())
+		os.rename(fn + tmpSuffix, fn)
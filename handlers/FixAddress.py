@@ -10,6 +10,7 @@ import MailHandler
 
 class FixAddress(MailHandler.MailHandler):
 
+	needs	= MailHandler.MailHandler.ENVELOPE
 	logger	= None
 	toToFix = '<name@some.address.com>'
 	newTo 	= '<other.name@new.address.com>'
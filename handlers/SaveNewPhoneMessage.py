@@ -12,6 +12,11 @@ class SaveNewPhoneMessage(MailHandler.MailHandler):
 
 	directory = '/media/sf_DebianExchange/Anrufe'
 	defaultFilename = "message.wav"
+	needs = MailHandler.MailHandler.FULL
+	phase = MailHandler.MailHandler.ASYNC
+	process = True
+	timeout = 60
+	onTimeout = MailHandler.MailHandler.SKIP
 	logger = None
 
 	def isEnabled(self):
@@ -0,0 +1,316 @@
+#
+# headers.py
+#
+# Author: Andreas Kraft (akr@mheg.org)
+#
+# DISCLAIMER
+# You are free to use this code in any way you like, subject to the
+# Python disclaimers & copyrights. I make no representations about the
+# suitability of this software for any purpose. It is provided "AS-IS"
+# without warranty of any kind, either express or implied. So there.
+#
+"""	Rewriting of the header block of a message.
+
+	Only the header block is read and changed. The body of the message is
+	not touched, it stays in the file it was received into and is copied
+	from there unchanged.
+"""
+
+import re
+
+_fieldName = re.compile(br'^([!-9;-~]+)[ \t]*:')
+_lineEnd = re.compile(br'\r\n|\n|\r(?!\n)')
+
+
+def readHeader(fp):
+	""" Read the header block from the binary file object 'fp'. Returns a
+		tuple (fields, separator). 'fields' is a list of the header fields as
+		bytes, each including its continuation lines and ending with CRLF.
+		'separator' is the empty line that separates the header from the
+		body, or b'' if there is none. Afterwards 'fp' is positioned at the
+		start of the body.
+	"""
+	fields = []
+	while True:
+		pos = fp.tell()
+		line = fp.readline()
+		if not line:
+			break
+		if line in (b'\r\n', b'\n'):
+			return (fields, b'\r\n')
+		if line[0:1] in (b' ', b'\t') and len(fields) > 0:
+			fields[-1] += _crlf(line)
+			continue
+		if not _fieldName.match(line):
+			# Not a header line: the body starts without an empty line
+			fp.seek(pos)
+			break
+		fields.append(_crlf(line))
+	return (fields, b'')
+
+
+def fieldName(field):
+	""" Return the lower-case name of the header field 'field', or None.
+	"""
+	m = _fieldName.match(field)
+	return m.group(1).decode('ascii').lower() if m else None
+
+
+def _crlf(line):
+	""" Return 'line' with a CRLF line ending.
+	"""
+	return line.rstrip(b'\r\n') + b'\r\n'
+
+
+def _field(name, value):
+	return (name + ': ' + value).encode('utf-8') + b'\r\n'
+
+
+
+class HeaderRewriter:
+	""" Collects changes of the header fields of a message and applies them
+		in a single pass over the header block.
+	"""
+
+	def __init__(self):
+		self._prepend = []		# fields added at the start, in order
+		self._remove = set()	# lower-case names of removed fields
+		self._replace = {}		# lower-case name -> new field
+
+
+	def prepend(self, name, value):
+		""" Add a header field at the start of the header. Fields that are added
+			later are inserted before fields that were added earlier.
+		"""
+		self._prepend.insert(0, _field(name, value))
+
+
+	def remove(self, name):
+		""" Remove all header fields with the name 'name'. This doesn't affect
+			fields that are added with 'prepend'.
+		"""
+		self._remove.add(name.lower())
+		self._replace.pop(name.lower(), None)
+
+
+	def replace(self, name, value):
+		""" Replace the header fields with the name 'name' by a single field
+			with the value 'value', at the position of the first one. If there
+			is no such field then the field is added at the end of the header.
+		"""
+		self._remove.discard(name.lower())
+		self._replace[name.lower()] = _field(name, value)
+
+
+	def rewrite(self, fields):
+		""" Apply the changes to the list of header fields 'fields', as returned
+			by readHeader(). Returns the new header block as bytes.
+		"""
+		result = list(self._prepend)
+		replaced = set()
+		for f in fields:
+			name = fieldName(f)
+			if name in self._remove:
+				continue
+			if name in self._replace:
+				if name not in replaced:
+					result.append(self._replace[name])
+					replaced.add(name)
+				continue
+			result.append(f)
+		for (name, f) in self._replace.items():
+			if name not in replaced:
+				result.append(f)
+		return b''.join(result)
+
+
+
+class LazyMessage(object):
+	""" An email.message.Message of a received mail that is parsed lazily.
+		Access to the header fields is served by a message that is parsed
+		from the header block only. The complete MIME tree is parsed on the
+		first access to anything else, e.g. the payload.
+
+		Changes of the header fields are tracked. Any other change must be
+		announced with modified(). serialize() returns the message data for
+		storing. Only what was changed is serialized: the header block if
+		only header fields were changed, otherwise the complete message.
+
+		* fields, separator - The header block, as returned by readHeader().
+		* fp - The binary file object with the message. The body starts at
+		  the current position.
+	"""
+
+	# Methods that only need the header fields
+	headerMethods = frozenset([ 'get', 'get_all', 'keys', 'values', 'items', 'get_content_type',
+								'get_content_maintype', 'get_content_subtype', 'get_default_type',
+								'get_param', 'get_params', 'get_filename', 'get_boundary',
+								'get_content_charset' ])
+
+	# Methods that change the header fields
+	headerMutators = frozenset([ 'add_header', 'replace_header', 'set_param', 'del_param', 'set_type' ])
+
+	def __init__(self, fields, separator, fp):
+		self._fields = fields
+		self._separator = separator
+		self._fp = fp
+		self._bodyStart = fp.tell()
+		self._header = None
+		self._full = None
+		self._headersModified = False
+		self._bodyModified = False
+
+
+	def source(self):
+		""" Return the received message as bytes.
+		"""
+		self._fp.seek(self._bodyStart)
+		try:
+			return b''.join(self._fields) + self._separator + self._fp.read()
+		finally:
+			self._fp.seek(self._bodyStart)
+
+
+	def text(self):
+		""" Return the received message as a string.
+		"""
+		return self.source().decode('utf-8', 'replace')
+
+
+	def headers(self):
+		""" Return an email.message.Message with the header fields only.
+		"""
+		if self._full != None:
+			return self._full
+		if self._header == None:
+			import email.parser
+			self._header = email.parser.HeaderParser().parsestr(b''.join(self._fields).decode('utf-8', 'replace'))
+		return self._header
+
+
+	def full(self):
+		""" Return the email.message.Message with the complete MIME tree.
+		"""
+		if self._full == None:
+			import email
+			full = email.message_from_string(self.text())
+			if self._headersModified:
+				# Carry over the changes made to the header fields so far
+				for name in set(full.keys()):
+					del full[name]
+				for (name, value) in self.headers().items():
+					full[name] = value
+			self._full = full
+		return self._full
+
+
+	def modified(self, message = None):
+		""" Announce that the message was changed, e.g. the payload or one of
+			its parts. If 'message' is given then it replaces the message. A
+			handler that returns this object announces it this way, too.
+		"""
+		if message != None and message is not self:
+			self._full = message
+		elif self._full == None:
+			# Nothing but the header fields can have been changed. Changes
+			# through this object are tracked already.
+			if message == None and self._header != None:
+				self._headersModified = True
+			return
+		self._bodyModified = True
+
+
+	def changed(self):
+		""" Return what was changed: None, 'headers' or 'body'. A change of the
+			body also includes changes of the header fields.
+		"""
+		if self._bodyModified:
+			return 'body'
+		if self._headersModified:
+			return 'headers'
+		return None
+
+
+	def setHeaders(self, items):
+		""" Replace all header fields by the list of (name, value) tuples
+			'items'.
+		"""
+		h = self.headers()
+		for name in set(h.keys()):
+			del h[name]
+		for (name, value) in items:
+			h[name] = value
+		self._headersModified = True
+
+
+	def toBytes(self, headersOnly = False):
+		""" Return the message in its current state as bytes, or only its
+			header block.
+		"""
+		(fields, separator, fp) = self.serialize()
+		data = b''.join(fields) + separator
+		if not headersOnly:
+			data += fp.read()
+		self._fp.seek(self._bodyStart)
+		return data
+
+
+	def serialize(self):
+		""" Return the message for storing as a tuple (fields, separator, fp),
+			like the arguments of the constructor. The body is read from 'fp'
+			from its current position. The message is serialized only if it
+			was changed.
+		"""
+		import io
+		if self._bodyModified:
+			data = _lineEnd.sub(b'\r\n', self._full.as_string().encode('utf-8', 'replace'))
+			fp = io.BytesIO(data)
+			(fields, separator) = readHeader(fp)
+			return (fields, separator, fp)
+		self._fp.seek(self._bodyStart)
+		if self._headersModified:
+			data = b''.join([ _field(name, str(value).strip()) for (name, value) in self.headers().items() ])
+			(fields, _) = readHeader(io.BytesIO(_lineEnd.sub(b'\r\n', data)))
+			return (fields, self._separator, self._fp)
+		return (self._fields, self._separator, self._fp)
+
+
+	def __getattr__(self, name):
+		if name.startswith('_'):
+			raise AttributeError(name)
+		if name in self.headerMethods:
+			return getattr(self.headers(), name)
+		if name in self.headerMutators:
+			self._headersModified = True
+			return getattr(self.headers(), name)
+		return getattr(self.full(), name)
+
+
+	def __getitem__(self, name):
+		return self.headers()[name]
+
+
+	def __setitem__(self, name, value):
+		self._headersModified = True
+		self.headers()[name] = value
+
+
+	def __delitem__(self, name):
+		self._headersModified = True
+		del self.headers()[name]
+
+
+	def __contains__(self, name):
+		return name in self.headers()
+
+
+	def __len__(self):
+		return len(self.headers())
+
+
+	def __iter__(self):
+		return iter(self.headers())
+
+
+	def __str__(self):
+		return str(self.full())
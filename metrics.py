@@ -0,0 +1,282 @@
+#
+# metrics.py
+#
+# Author: Andreas Kraft (akr@mheg.org)
+#
+# DISCLAIMER
+# You are free to use this code in any way you like, subject to the
+# Python disclaimers & copyrights. I make no representations about the
+# suitability of this software for any purpose. It is provided "AS-IS"
+# without warranty of any kind, either express or implied. So there.
+#
+"""	Counters, gauges and histograms of the proxy's activity.
+
+	The metrics are always collected, which only costs a few dictionary
+	updates. They can be exported in the Prometheus text format with an HTTP
+	server on a local port (see 'startServer').
+"""
+
+import sys, threading, time
+
+# The default buckets of histograms, in seconds
+defaultBuckets = ( 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60 )
+
+_metrics = []		# all metrics, in order of creation
+_lock = threading.Lock()
+
+
+def _labelString(names, values, extra = None):
+	pairs = [ (n, v) for (n, v) in zip(names, values) ]
+	if extra != None:
+		pairs.append(extra)
+	if len(pairs) == 0:
+		return ''
+	return '{' + ','.join([ n + '="' + str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"' for (n, v) in pairs ]) + '}'
+
+
+def _number(value):
+	if value == float('inf'):
+		return '+Inf'
+	if isinstance(value, float) and value.is_integer():
+		return str(int(value))
+	return repr(value) if isinstance(value, float) else str(value)
+
+
+
+class Metric:
+	""" Base class of the metrics. A metric has a name, a help text and an
+		optional list of label names. Values are recorded per combination of
+		label values, which are passed as positional arguments.
+	"""
+
+	type = None
+
+	def __init__(self, name, help, labels = None):
+		self.name = name
+		self.help = help
+		self.labels = labels if labels != None else []
+		self._values = {}	# tuple of label values -> value
+		with _lock:
+			_metrics.append(self)
+
+
+	def _key(self, values):
+		if len(values) != len(self.labels):
+			raise ValueError('Metric ' + self.name + ' needs the labels ' + ', '.join(self.labels))
+		return tuple(values)
+
+
+	def expose(self):
+		""" Return the metric in the Prometheus text format.
+		"""
+		lines = [ '# HELP ' + self.name + ' ' + self.help, '# TYPE ' + self.name + ' ' + self.type ]
+		with _lock:
+			items = sorted(self._values.items())
+		for (key, value) in items:
+			lines.append(self.name + _labelString(self.labels, key) + ' ' + _number(value))
+		return lines
+
+
+
+class Counter(Metric):
+	""" A value that only increases.
+	"""
+
+	type = 'counter'
+
+	def inc(self, *labels, **kw):
+		""" Increase the counter for the label values by 'amount' (default 1).
+		"""
+		key = self._key(labels)
+		with _lock:
+			self._values[key] = self._values.get(key, 0) + kw.get('amount', 1)
+
+
+
+class Gauge(Metric):
+	""" A value that can go up and down. A gauge without labels can also be
+		read from a function when it is exposed.
+	"""
+
+	type = 'gauge'
+
+	def __init__(self, name, help, labels = None, function = None):
+		Metric.__init__(self, name, help, labels)
+		self.function = function
+
+
+	def set(self, value, *labels):
+		key = self._key(labels)
+		with _lock:
+			self._values[key] = value
+
+
+	def inc(self, *labels, **kw):
+		key = self._key(labels)
+		with _lock:
+			self._values[key] = self._values.get(key, 0) + kw.get('amount', 1)
+
+
+	def dec(self, *labels, **kw):
+		self.inc(*labels, amount=-kw.get('amount', 1))
+
+
+	def expose(self):
+		if self.function != None:
+			try:
+				value = self.function()
+				if value != None:
+					self.set(value)
+			except:
+				pass
+		return Metric.expose(self)
+
+
+
+class Histogram(Metric):
+	""" Counts observed values, e.g. durations, in buckets.
+	"""
+
+	type = 'histogram'
+
+	def __init__(self, name, help, labels = None, buckets = defaultBuckets):
+		Metric.__init__(self, name, help, labels)
+		self.buckets = sorted(buckets)
+
+
+	def observe(self, value, *labels):
+		key = self._key(labels)
+		with _lock:
+			h = self._values.get(key)
+			if h == None:
+				h = self._values[key] = [ [ 0 ] * len(self.buckets), 0, 0.0 ]	# bucket counts, count, sum
+			for (i, b) in enumerate(self.buckets):
+				if value <= b:
+					h[0][i] += 1
+					break
+			h[1] += 1
+			h[2] += value
+
+
+	def time(self, *labels):
+		""" Return a context manager that observes the time spent in its
+			block.
+		"""
+		return _Timer(self, labels)
+
+
+	def expose(self):
+		lines = [ '# HELP ' + self.name + ' ' + self.help, '# TYPE ' + self.name + ' ' + self.type ]
+		with _lock:
+			items = sorted([ (k, (list(h[0]), h[1], h[2])) for (k, h) in self._values.items() ])
+		for (key, (counts, count, total)) in items:
+			cumulative = 0
+			for (b, c) in zip(self.buckets, counts):
+				cumulative += c
+				lines.append(self.name + '_bucket' + _labelString(self.labels, key, ('le', _number(float(b)))) + ' ' + str(cumulative))
+			lines.append(self.name + '_bucket' + _labelString(self.labels, key, ('le', '+Inf')) + ' ' + str(count))
+			lines.append(self.name + '_count' + _labelString(self.labels, key) + ' ' + str(count))
+			lines.append(self.name + '_sum' + _labelString(self.labels, key) + ' ' + _number(total))
+		return lines
+
+
+
+class _Timer:
+
+	def __init__(self, histogram, labels):
+		self._histogram = histogram
+		self._labels = labels
+
+	def __enter__(self):
+		self._start = time.time()
+		return self
+
+	def __exit__(self, *args):
+		self._histogram.observe(time.time() - self._start, *self._labels)
+		return False
+
+
+
+def expose():
+	""" Return all metrics in the Prometheus text format.
+	"""
+	with _lock:
+		metrics = list(_metrics)
+	lines = []
+	for m in metrics:
+		lines += m.expose()
+	return '\n'.join(lines) + '\n'
+
+
+def startServer(port, address, log, actions = None):
+	""" Serve the metrics at http://address:port/metrics from a separate
+		thread. 'actions' is an optional dictionary of further paths and the
+		functions that are called for them. The actions change the state of
+		the proxy, so they are only run for POST requests. A function gets
+		the dictionary of the query and form parameters and returns the
+		text of the response, or None for an error. It raises a ValueError
+		for wrong parameters.
+	"""
+	try:
+		from http.server import BaseHTTPRequestHandler, HTTPServer
+		from socketserver import ThreadingMixIn
+		from urllib.parse import parse_qsl
+	except ImportError:
+		from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+		from SocketServer import ThreadingMixIn
+		from urlparse import parse_qsl
+	actions = actions if actions != None else {}
+
+	class Handler(BaseHTTPRequestHandler):
+
+		def do_GET(self):
+			path = self.path.partition('?')[0]
+			if path in actions:
+				self.send_response(405)
+				self.send_header('Allow', 'POST')
+				self.send_header('Content-Length', '0')
+				self.end_headers()
+			elif path in ('/', '/metrics'):
+				self.reply(expose())
+			else:
+				self.send_error(404)
+
+		def do_POST(self):
+			(path, _, query) = self.path.partition('?')
+			length = int(self.headers.get('Content-Length') or 0)
+			form = self.rfile.read(length).decode('utf-8', 'replace') if length > 0 else ''
+			if path not in actions:
+				self.send_error(404)
+				return
+			parameters = dict(parse_qsl(query))
+			parameters.update(parse_qsl(form))
+			try:
+				text = actions[path](parameters)
+			except ValueError:
+				self.send_error(400, str(sys.exc_info()[1]))
+				return
+			if text == None:
+				self.send_error(409)
+				return
+			self.reply(text)
+
+		def reply(self, text):
+			body = text.encode('utf-8')
+			self.send_response(200)
+			self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+			self.send_header('Content-Length', str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+
+		def log_message(self, format, *args):
+			log.logdebug('Metrics request: ' + format, *args)
+
+	class Server(ThreadingMixIn, HTTPServer):
+		daemon_threads = True
+		allow_reuse_address = True
+
+	server = Server((address, port), Handler)
+	t = threading.Thread(target=server.serve_forever, name='metrics')
+	t.daemon = True
+	t.start()
+	return server
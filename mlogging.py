@@ -12,13 +12,27 @@
 """	Wrapper class for the logging subsystem. """
 
 
-import	logging, logging.handlers, time
+import	atexit, logging, logging.handlers, sys, threading, time
+try:
+	import queue
+except ImportError:
+	import Queue as queue
 
 class	Logging:
-	""" Wrapper class for the logging subsystem. This class wraps the 
-		initialization of the logging subsystem and provides convenience 
-		methods for printing log, error and warning messages to a 
+	""" Wrapper class for the logging subsystem. This class wraps the
+		initialization of the logging subsystem and provides convenience
+		methods for printing log, error and warning messages to a
 		logfile and to the console.
+
+		All methods accept %-style arguments after the message. The message
+		is only formatted if its level is enabled, e.g.
+		log.logdebug('Received: %s %s', cmd, data).
+
+		In asynchronous mode ('asynchronous' is True) the messages are put
+		into a queue and formatted and written by a separate thread, which
+		writes all queued messages at once. The caller never waits for the
+		disk or the console. When the queue is full, messages are dropped
+		and the number of dropped messages is logged later.
 	"""
 	# some logging defaults
 	_logFile	= 'log.log'
@@ -27,70 +41,158 @@ class	Logging:
 	_logLevel	= logging.INFO
 	_isinit		= False
 
+	_prefixes	= { logging.DEBUG : 'DEBUG: ', logging.INFO : '', logging.WARNING : 'Warning: ', logging.ERROR : 'ERROR: ' }
+	_batchSize	= 256
+
 
-	def __init__(self, logFile = _logFile, logSize = _logSize, logCount = _logCount, logLevel = _logLevel):
+	def __init__(self, logFile = _logFile, logSize = _logSize, logCount = _logCount, logLevel = _logLevel, console = True, asynchronous = False, queueSize = 10000):
 		"""Init the logging system.
 		"""
 
 		if self._isinit == True:	return
-				
+
 		self.logger			= logging.getLogger('logging')
 		logfp				= logging.handlers.RotatingFileHandler(logFile, maxBytes=logSize, backupCount=logCount)
 		logformatter		= logging.Formatter('%(asctime)s %(levelname)s %(message)s')
 		logfp.setFormatter(logformatter)
-		self.logger.addHandler(logfp) 
+		self.logger.addHandler(logfp)
 		self.logLevel = logLevel
 		logfp.setLevel(logLevel)
 		self.logger.setLevel(logLevel)
+		self.console = console
+		self.dropped = 0
+		self._handler = logfp
+		self._queue = None
+		if asynchronous:
+			self._queue = queue.Queue(queueSize)
+			self._writer = threading.Thread(target=self._write, name='logging')
+			self._writer.daemon = True
+			self._writer.start()
+			atexit.register(self.flush)
 		self._isinit = True
-	
 
-	def log(self, msg):
+
+	def log(self, msg, *args):
 		"""Print a log message with level INFO.
 		"""
-		
-		try:
-			if self.logLevel <= logging.INFO:
-				print( "(" + time.ctime(time.time()) + ") " + msg)
-				if self._isinit:
-					self.logger.info(msg) 
-		except:
-			pass
+		if self.logLevel <= logging.INFO:
+			self._log(logging.INFO, msg, args)
 
 
-	def logdebug(self, msg):
+	def logdebug(self, msg, *args):
 		"""Print a log message with level DEBUG.
 		"""
-		
-		try:
-			if self.logLevel <= logging.DEBUG:
-				print("DEBUG: (" + time.ctime(time.time()) + ") " + msg)
-				if self._isinit:
-					self.logger.debug(msg) 
-		except:
-			pass
+		if self.logLevel <= logging.DEBUG:
+			self._log(logging.DEBUG, msg, args)
 
 
-	def logerr(self, msg):
+	def logerr(self, msg, *args):
 		"""Print a log message with level ERROR.
 		"""
-		
-		try:
-			if self.logLevel <= logging.ERROR:
-				print("ERROR: (" + time.ctime(time.time()) + ") " + msg)
-				if self._isinit:
-					self.logger.error(msg) 
-		except:
-			pass
-	
-	def logwarn(self, msg):
+		if self.logLevel <= logging.ERROR:
+			self._log(logging.ERROR, msg, args)
+
+
+	def logwarn(self, msg, *args):
 		"""Print a log message with level WARNING.
 		"""
-		
+		if self.logLevel <= logging.WARNING:
+			self._log(logging.WARNING, msg, args)
+
+
+	def flush(self, timeout = 5):
+		"""Wait until the queued messages are written, at most 'timeout'
+		   seconds.
+		"""
+		if self._queue == None:
+			return
+		event = threading.Event()
 		try:
-			if self.logLevel <= logging.WARNING:
-				print("Warning: (" + time.ctime(time.time()) + ") " + msg)
-				if self._isinit:
-					self.logger.warning(msg) 
+			self._queue.put(event, True, timeout)
+			event.wait(timeout)
 		except:
 			pass
+
+
+	def afterFork(self):
+		"""Restart the writer thread in a forked process, which doesn't
+		   inherit the threads of its parent.
+		"""
+		if self._queue == None:
+			return
+		self._queue = queue.Queue(self._queue.maxsize)
+		self.dropped = 0
+		self._writer = threading.Thread(target=self._write, name='logging')
+		self._writer.daemon = True
+		self._writer.start()
+
+
+	def _log(self, level, msg, args):
+		""" Write a message, or queue it in asynchronous mode.
+		"""
+		if self._queue == None:
+			try:
+				if args:
+					msg = msg % args
+				if self.console:
+					print(self._prefixes[level] + "(" + time.ctime(time.time()) + ") " + msg)
+				if self._isinit:
+					self.logger.log(level, msg)
+			except:
+				pass
+			return
+		try:
+			self._queue.put_nowait((time.time(), level, msg, args))
+		except queue.Full:
+			self.dropped += 1
+
+
+	def _write(self):
+		""" Thread that writes the queued messages in batches.
+		"""
+		while True:
+			batch = [ self._queue.get() ]
+			try:
+				while len(batch) < self._batchSize:
+					batch.append(self._queue.get_nowait())
+			except queue.Empty:
+				pass
+			lines = []
+			console = []
+			events = []
+			if self.dropped > 0:
+				(dropped, self.dropped) = (self.dropped, 0)
+				batch.append((time.time(), logging.WARNING, '%d log messages were dropped', (dropped,)))
+			for entry in batch:
+				if isinstance(entry, threading.Event):
+					events.append(entry)
+					continue
+				(created, level, msg, args) = entry
+				try:
+					if args:
+						msg = msg % args
+					record = logging.LogRecord(self.logger.name, level, __file__, 0, msg, None, None)
+					record.created = created
+					record.msecs = (created - int(created)) * 1000
+					lines.append(self._handler.format(record) + '\n')
+					if self.console:
+						console.append(self._prefixes[level] + "(" + time.ctime(created) + ") " + msg + '\n')
+				except:
+					pass
+			try:
+				if console:
+					sys.stdout.write(''.join(console))
+					sys.stdout.flush()
+				if lines:
+					self._handler.acquire()
+					try:
+						self._handler.stream.write(''.join(lines))
+						self._handler.stream.flush()
+						if self._handler.maxBytes > 0 and self._handler.stream.tell() >= self._handler.maxBytes:
+							self._handler.doRollover()
+					finally:
+						self._handler.release()
+			except:
+				pass
+			for e in events:
+				e.set()
@@ -0,0 +1,192 @@
+#
+# popauth.py
+#
+# Author: Andreas Kraft (akr@mheg.org)
+#
+# DISCLAIMER
+# You are free to use this code in any way you like, subject to the
+# Python disclaimers & copyrights. I make no representations about the
+# suitability of this software for any purpose. It is provided "AS-IS"
+# without warranty of any kind, either express or implied. So there.
+#
+"""	A cache of the POP-before-SMTP authentication state of the mail accounts.
+
+	The POP3 logins are performed by background threads, never by the
+	delivery workers. A login makes the SMTP server usable for the account
+	from 'waitAfter' seconds after the login until 'popcheckdelay' seconds
+	after it. While an account is in use its login is refreshed before it
+	expires, so that deliveries don't have to wait for it.
+"""
+
+import sys, threading, time
+import metrics
+
+logins = metrics.Counter('smtpproxy_pop_logins_total', 'POP-before-SMTP logins, per account and result.', [ 'account', 'result' ])
+
+
+class PopAuthError(Exception):
+	""" Raised when the last POP-before-SMTP authentication of an account
+		failed.
+	"""
+	pass
+
+
+
+class PopAuthState:
+	""" The authentication state of one mail account.
+	"""
+
+	def __init__(self, account):
+		self.account	= account		# the MailAccount
+		self.validFrom	= 0				# the SMTP server can be used from ...
+		self.validUntil	= 0				# ... until this time
+		self.lastUsed	= 0				# time of the last check by a delivery
+		self.refreshing	= False			# True while a login is in progress
+		self.error		= None			# error of the last failed login
+		self.errorTime	= 0
+
+
+
+class PopAuthCache:
+	""" Keeps the POP-before-SMTP authentication state per mail account.
+
+		* waitAfter - The time to wait after a POP3 login before the SMTP server
+		  is used, in seconds.
+		* onReady - An optional function that is called without arguments when
+		  a login of an account that had no valid authentication succeeded.
+		* retryAfter - After a failed login a new one is not attempted before
+		  this time has passed, in seconds.
+		* timeout - The socket timeout for the POP3 connection, in seconds.
+	"""
+
+	# A login is refreshed this many seconds (plus 'waitAfter') before the
+	# previous one expires.
+	refreshMargin = 5
+
+
+	def __init__(self, log, waitAfter = 5, onReady = None, retryAfter = 60, timeout = 30):
+		self._log = log
+		self.waitAfter = waitAfter
+		self.retryAfter = retryAfter
+		self.timeout = timeout
+		self._onReady = onReady
+		self._states = {}		# account name -> PopAuthState
+		self._cond = threading.Condition()
+		t = threading.Thread(target=self._refresh, name='popauth')
+		t.daemon = True
+		t.start()
+
+
+	def check(self, account):
+		""" Check whether the SMTP server of an account can be used now. Returns
+			None if it can, or the time when the deliveries should be tried
+			again, because a login is in progress. A login is started if
+			necessary. Raises a PopAuthError if the last login failed.
+		"""
+		now = time.time()
+		with self._cond:
+			state = self._states.get(account.name)
+			if state == None:
+				state = self._states[account.name] = PopAuthState(account)
+			state.account = account
+			state.lastUsed = now
+			if state.validFrom <= now < state.validUntil:
+				return None
+			if now < state.validFrom:
+				return state.validFrom
+			if state.error != None and now - state.errorTime < self.retryAfter:
+				raise PopAuthError(state.error)
+			self._start(state)
+			return now + self.waitAfter + 1
+
+
+	def forget(self, key = None):
+		""" Forget the authentication state of all accounts, or only of the
+			account with the name 'key'.
+		"""
+		with self._cond:
+			if key == None:
+				self._states = {}
+			else:
+				self._states.pop(key, None)
+
+
+	def _start(self, state):
+		""" Start a login for an account in a new thread, unless one is already
+			in progress. Must be called with the lock held.
+		"""
+		if state.refreshing:
+			return
+		state.refreshing = True
+		t = threading.Thread(target=self._login, args=(state,), name='popauth-' + state.account.name)
+		t.daemon = True
+		t.start()
+
+
+	def _login(self, state):
+		""" Perform the POP3 login for an account and update its state.
+		"""
+		import poplib
+
+		account = state.account
+		self._log.log('Performing Pop-before-SMTP for ' + account.name)
+		error = None
+		try:
+			if account.rpopssl:
+				M = poplib.POP3_SSL(account.rpophost, account.rpopport, timeout=self.timeout)
+			else:
+				M = poplib.POP3(account.rpophost, account.rpopport, timeout=self.timeout)
+			try:
+				M.user(account.rpopuser)
+				M.pass_(account.rpoppass)
+			finally:
+				M.quit()
+		except:
+			error = str(sys.exc_info()[1])
+			self._log.logerr('POP-before-SMTP caught exception: ' +  str(sys.exc_info()[0]) +": " + error)
+
+		logins.inc(account.name, 'ok' if error == None else 'error')
+		now = time.time()
+		notify = False
+		with self._cond:
+			state.refreshing = False
+			if error != None:
+				state.error = 'POP-before-SMTP: ' + error
+				state.errorTime = now
+				return
+			state.error = None
+			if state.validFrom <= now + self.waitAfter <= state.validUntil:
+				# The previous login is still valid until the new one is
+				state.validUntil = now + account.rpopcheckdelay
+			else:
+				state.validFrom = now + self.waitAfter
+				state.validUntil = now + account.rpopcheckdelay
+				notify = True
+			self._cond.notify()
+		if notify and self._onReady != None:
+			# Wake up the scheduler when the deferred mails can be sent
+			t = threading.Timer(self.waitAfter, self._onReady)
+			t.daemon = True
+			t.start()
+
+
+	def _refresh(self):
+		""" Thread that renews the logins of accounts that are in use before
+			they expire.
+		"""
+		with self._cond:
+			while True:
+				now = time.time()
+				timeout = 60
+				for state in list(self._states.values()):
+					if state.refreshing or state.error != None or state.validUntil <= now:
+						continue
+					if now - state.lastUsed > state.account.rpopcheckdelay:
+						# Not used anymore. Log in again on demand only.
+						continue
+					refreshAt = state.validUntil - self.waitAfter - self.refreshMargin
+					if refreshAt <= now:
+						self._start(state)
+					else:
+						timeout = min(timeout, refreshAt - now)
+				self._cond.wait(max(1, timeout))
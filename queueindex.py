@@ -0,0 +1,165 @@
+#
+# queueindex.py
+#
+# Author: Andreas Kraft (akr@mheg.org)
+#
+# DISCLAIMER
+# You are free to use this code in any way you like, subject to the
+# Python disclaimers & copyrights. I make no representations about the
+# suitability of this software for any purpose. It is provided "AS-IS"
+# without warranty of any kind, either express or implied. So there.
+#
+"""	A persistent index of the scheduled mails in the message directory.
+
+	The index is an SQLite database in the message directory. It records for
+	every scheduled mail the account, the number of failed delivery attempts,
+	the last error and the time of the next attempt, so that the scheduler
+	only needs to look at the mails that are due. The envelope files in the
+	message directory remain the authoritative data; the index can always be
+	rebuilt from them.
+"""
+
+import os, sqlite3, sys, threading, time
+import spool
+
+
+class QueueIndex:
+	""" The index of scheduled mails. Mails are identified by the name of their
+		envelope file (without the directory).
+	"""
+
+	def __init__(self, directory, name = 'queue.db'):
+		self.directory = directory
+		self._lock = threading.Lock()
+		self._db = sqlite3.connect(os.path.join(directory, name), timeout=30, check_same_thread=False, isolation_level=None)
+		self._db.execute('PRAGMA journal_mode=WAL')
+		self._db.execute('PRAGMA synchronous=NORMAL')
+		self._db.execute('CREATE TABLE IF NOT EXISTS mails (name TEXT PRIMARY KEY, account TEXT, attempts INTEGER, nextattempt REAL, lasterror TEXT, created REAL, size INTEGER)')
+		self._db.execute('CREATE INDEX IF NOT EXISTS mails_nextattempt ON mails (nextattempt)')
+		if 'size' not in [ r[1] for r in self._db.execute('PRAGMA table_info(mails)') ]:
+			# Index of an older version
+			self._db.execute('ALTER TABLE mails ADD COLUMN size INTEGER DEFAULT 0')
+			for (name,) in self._db.execute('SELECT name FROM mails').fetchall():
+				self._db.execute('UPDATE mails SET size = ? WHERE name = ?', (self._size(name), name))
+
+
+	def _size(self, name):
+		""" Return the size of the message file of the mail 'name'.
+		"""
+		try:
+			return os.path.getsize(spool.messageFile(os.path.join(self.directory, name)))
+		except OSError:
+			return 0
+
+
+	def add(self, name, envelope, replace = True):
+		""" Add a mail to the index, or update it. With 'replace' set to False
+			a mail that is already indexed is left as it is. Returns True if
+			the index was changed.
+		"""
+		size = self._size(name)
+		with self._lock:
+			return self._db.execute('INSERT OR ' + ('REPLACE' if replace else 'IGNORE') + ' INTO mails (name, account, attempts, nextattempt, lasterror, created, size) VALUES (?, ?, ?, ?, ?, ?, ?)',
+									(name, envelope.account, envelope.attempts, envelope.nextAttempt, envelope.lastError, envelope.created, size)).rowcount > 0
+
+
+	def remove(self, name):
+		""" Remove a mail from the index.
+		"""
+		with self._lock:
+			self._db.execute('DELETE FROM mails WHERE name = ?', (name,))
+
+
+	def reschedule(self, name, envelope):
+		""" Update the delivery state of a mail from its envelope.
+		"""
+		with self._lock:
+			self._db.execute('UPDATE mails SET attempts = ?, nextattempt = ?, lasterror = ? WHERE name = ?', (envelope.attempts, envelope.nextAttempt, envelope.lastError, name))
+
+
+	def due(self, names):
+		""" Make the mails with the given names due for delivery now, e.g.
+			because their delivery was interrupted.
+		"""
+		now = time.time()
+		with self._lock:
+			self._db.executemany('UPDATE mails SET nextattempt = ? WHERE name = ?', [ (now, n) for n in names ])
+
+
+	def close(self):
+		with self._lock:
+			self._db.close()
+
+
+	def take(self, limit, hold):
+		""" Return the names of up to 'limit' mails that are due for delivery,
+			oldest first. The next attempt of the returned mails is moved
+			'hold' seconds into the future, so that they are not returned
+			again while they are in delivery, but become due again if the
+			delivery never finishes (e.g. because the process crashed).
+		"""
+		now = time.time()
+		with self._lock:
+			self._db.execute('BEGIN IMMEDIATE')
+			try:
+				names = [ r[0] for r in self._db.execute('SELECT name FROM mails WHERE nextattempt <= ? ORDER BY nextattempt LIMIT ?', (now, limit)) ]
+				self._db.executemany('UPDATE mails SET nextattempt = ? WHERE name = ?', [ (now + hold, n) for n in names ])
+				self._db.execute('COMMIT')
+			except:
+				self._db.execute('ROLLBACK')
+				raise
+		return names
+
+
+	def nextDue(self):
+		""" Return the time of the next due delivery attempt, or None if the
+			index is empty.
+		"""
+		with self._lock:
+			return self._db.execute('SELECT MIN(nextattempt) FROM mails').fetchone()[0]
+
+
+	def count(self):
+		""" Return the number of scheduled mails.
+		"""
+		with self._lock:
+			return self._db.execute('SELECT COUNT(*) FROM mails').fetchone()[0]
+
+
+	def usage(self):
+		""" Return the number of scheduled mails and the total size of their
+			message files in bytes.
+		"""
+		with self._lock:
+			(count, size) = self._db.execute('SELECT COUNT(*), SUM(size) FROM mails').fetchone()
+		return (count, size or 0)
+
+
+	def oldest(self):
+		""" Return the receive time of the oldest scheduled mail, or None.
+		"""
+		with self._lock:
+			return self._db.execute('SELECT MIN(created) FROM mails').fetchone()[0]
+
+
+	def rebuild(self, log):
+		""" Synchronize the index with the envelope files in the message
+			directory. Mails without an index entry are added, and entries
+			without an envelope file are removed. Returns the number of
+			changes.
+		"""
+		names = set([ e for e in os.listdir(self.directory) if e.endswith(spool.envelopeSuffix) ])
+		with self._lock:
+			indexed = set([ r[0] for r in self._db.execute('SELECT name FROM mails') ])
+		changes = 0
+		for n in names - indexed:
+			try:
+				self.add(n, spool.readEnvelope(os.path.join(self.directory, n)))
+				changes += 1
+			except (OSError, ValueError):
+				log.logerr('Cannot index mail ' + n + ': ' + str(sys.exc_info()[1]))
+		for n in indexed - names:
+			if not os.path.exists(os.path.join(self.directory, n)):
+				self.remove(n)
+				changes += 1
+		return changes
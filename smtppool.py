@@ -0,0 +1,184 @@
+#
+# smtppool.py
+#
+# Author: Andreas Kraft (akr@mheg.org)
+#
+# DISCLAIMER
+# You are free to use this code in any way you like, subject to the
+# Python disclaimers & copyrights. I make no representations about the
+# suitability of this software for any purpose. It is provided "AS-IS"
+# without warranty of any kind, either express or implied. So there.
+#
+"""	A pool of authenticated connections to the remote SMTP servers. """
+
+import sys, threading, time
+
+
+class PooledConnection:
+	""" An open smtplib connection together with its bookkeeping data.
+	"""
+
+	def __init__(self, key, server, generation = None):
+		self.key		= key			# name of the mail account
+		self.generation	= generation	# see SMTPConnectionPool.drain()
+		self.server		= server		# the smtplib.SMTP object
+		self.messages	= 0				# number of messages sent so far
+		self.lastUsed	= time.time()
+		self.reused		= False			# True if taken from the pool
+
+
+
+class SMTPConnectionPool:
+	""" Keeps idle connections to the remote SMTP servers per mail account, so
+		that consecutive deliveries for the same account reuse one
+		authenticated session instead of connecting, negotiating TLS and
+		logging in for every message.
+
+		* connect - A function that is called with a MailAccount and returns a
+		  connected and authenticated smtplib.SMTP object.
+		* maxIdle - The maximum number of idle connections kept per account. 0
+		  disables pooling.
+		* idleTimeout - Idle connections are closed after this time, in seconds.
+		* maxMessages - A connection is closed after it was used for this number
+		  of messages.
+	"""
+
+	# Idle connections are checked with a NOOP command before they are
+	# reused when they were idle for longer than this time, in seconds.
+	checkAfter = 2
+
+
+	def __init__(self, connect, log, maxIdle = 4, idleTimeout = 30, maxMessages = 100):
+		self._connect = connect
+		self._log = log
+		self.maxIdle = maxIdle
+		self.idleTimeout = idleTimeout
+		self.maxMessages = maxMessages
+		self._idle = {}		# account name -> list of PooledConnection
+		self._generations = {}	# account name -> number of drains
+		self._drains = 0		# number of drains of all accounts
+		self._lock = threading.Lock()
+		if maxIdle > 0:
+			t = threading.Thread(target=self._reap, name='smtppool')
+			t.daemon = True
+			t.start()
+
+
+	def acquire(self, account):
+		""" Return a PooledConnection for the account. An idle connection is
+			reused if a healthy one is available, otherwise a new connection
+			is opened.
+		"""
+		while True:
+			with self._lock:
+				idle = self._idle.get(account.name)
+				conn = idle.pop() if idle else None
+			if conn == None:
+				break
+			if time.time() - conn.lastUsed > self.idleTimeout:
+				self._close(conn)
+				continue
+			if time.time() - conn.lastUsed > self.checkAfter:
+				try:
+					(code, _) = conn.server.noop()
+					if code != 250:
+						raise Exception('NOOP returned ' + str(code))
+				except:
+					self._log.logdebug('Discarding stale connection for ' + account.name + ': ' + str(sys.exc_info()[1]))
+					self._close(conn)
+					continue
+			conn.reused = True
+			return conn
+		generation = self._generation(account.name)
+		return PooledConnection(account.name, self._connect(account), generation)
+
+
+	def finished(self, conn, ok = True):
+		""" Record the end of a mail transaction on a connection. If the
+			transaction failed then the session is reset. Returns False if the
+			connection can't be used for another transaction, because it
+			can't be reset or has reached 'maxMessages'. It is closed then.
+		"""
+		conn.messages += 1
+		conn.lastUsed = time.time()
+		if not ok:
+			try:
+				conn.server.rset()
+			except:
+				self.discard(conn)
+				return False
+		if conn.messages >= self.maxMessages:
+			self._close(conn)
+			return False
+		return True
+
+
+	def release(self, conn):
+		""" Return a connection to the pool. The connection is closed if the
+			pool for the account is full, or if the account was drained while
+			the connection was in use.
+		"""
+		conn.reused = False
+		with self._lock:
+			idle = self._idle.setdefault(conn.key, [])
+			if len(idle) < self.maxIdle and conn.generation == self._generation(conn.key):
+				idle.append(conn)
+				return
+		self._close(conn)
+
+
+	def discard(self, conn):
+		""" Drop a broken connection.
+		"""
+		try:
+			conn.server.close()
+		except:
+			pass
+
+
+	def drain(self, key = None):
+		""" Close all idle connections, or only those for the account with the
+			name 'key'. Connections that are in use at this time are closed
+			when they are released.
+		"""
+		with self._lock:
+			if key == None:
+				conns = [ c for l in self._idle.values() for c in l ]
+				self._idle = {}
+				self._drains += 1
+			else:
+				conns = self._idle.pop(key, [])
+				self._generations[key] = self._generations.get(key, 0) + 1
+		for c in conns:
+			self._close(c)
+
+
+	def _generation(self, key):
+		""" Return the generation of the connections of the account 'key'. It
+			changes with every drain of the account.
+		"""
+		return (self._drains, self._generations.get(key, 0))
+
+
+	def _close(self, conn):
+		""" Close a connection politely.
+		"""
+		try:
+			conn.server.quit()
+		except:
+			self.discard(conn)
+
+
+	def _reap(self):
+		""" Thread that closes connections that were idle for too long.
+		"""
+		while True:
+			time.sleep(max(1, self.idleTimeout / 2))
+			expired = []
+			now = time.time()
+			with self._lock:
+				for key, idle in self._idle.items():
+					expired += [ c for c in idle if now - c.lastUsed > self.idleTimeout ]
+					idle[:] = [ c for c in idle if now - c.lastUsed <= self.idleTimeout ]
+			for c in expired:
+				self._close(c)
@@ -14,8 +14,6 @@
 #	TODO
 #	make removing of files in case of an error configuratble
 #	Document handlers
-#	Mail handlers: specify the order of the handlers to be called
-#	Mail handlers: handle the returned and possible modified email
 #	Implement SMTP authenticiation
 #
 """smtpproxy.py - A Python SMTP Proxy Server.
@@ -36,10 +34,47 @@ The basic configuration of the server.
 
 	[config]
 	port=<int>           : The port to listen on. Optional. The default is 25.
-	sleeptime=<int>      : The time to wait for the relaying thread to wait between checks, in seconds. Optional. The default is 30.
+	sleeptime=<int>      : The time to wait for the relaying thread to wait between checks, in seconds. New mails are picked up immediately, so this is only a fallback. Optional. The default is 30.
+	watchdir=<bool>      : Watch the message directory with inotify to pick up mails that are written by other processes immediately. Optional. The default is true.
 	debuglevel=<int>     : Set the debuglevel for various functions. The default is 0 (no debug output).
-	waitafterpop=<int>   : The time to wait after pop authentication.
-	deleteonerror=<bool> : Delete a mail when an error occurs
+	waitafterpop=<int>   : The time to wait after pop authentication before a mail is sent. Mails are deferred in the meantime, the delivery workers don't wait.
+	deleteonerror=<bool> : Delete a mail when an error occurs, after 'maxattempts' delivery attempts. Otherwise the mail is kept and retried.
+	maxattempts=<int>    : The number of failed delivery attempts after which a mail is deleted when 'deleteonerror' is true. Optional. The default is 1.
+	retrydelay=<int>     : The time to wait before the first retry of a failed delivery, in seconds. The delay doubles with every further attempt. Optional. The default is 60.
+	retrymaxdelay=<int>  : The maximum time between two delivery attempts, in seconds. Optional. The default is 3600.
+	spoolthreshold=<int> : Received message data up to this size (in bytes) is kept in memory, larger messages are spilled to a temporary file. Optional. The default is 1048576.
+	spoolsync=<bool>     : Flush a received mail to disk before it is acknowledged, so that it survives a crash of the system. The mails of concurrent connections are flushed together. Optional. The default is true.
+	maxmessagesize=<int> : The maximum size of a received mail in bytes, announced with the ESMTP SIZE extension. Larger mails are refused with 552. 0 means no limit. Optional. The default is 0.
+	deliveryworkers=<int>: The number of threads that deliver mails to the remote SMTP servers concurrently. Optional. The default is 4.
+	accountworkers=<int> : The maximum number of mails of one account that are delivered at the same time. Optional. The default is 2.
+	batchsize=<int>      : The maximum number of queued mails of the same account that are sent as successive transactions over one connection by a delivery worker. Optional. The default is 50.
+	smtppoolsize=<int>   : The number of idle connections to a remote SMTP server that are kept open per account for reuse. 0 disables connection reuse. Optional. The default is 4.
+	smtpidletimeout=<int>: The time after which an idle connection to a remote SMTP server is closed, in seconds. Optional. The default is 30.
+	smtpmaxmessages=<int>: The number of mails sent over one connection to a remote SMTP server before it is closed. Optional. The default is 100.
+	smtptimeout=<int>    : The time to wait for a remote SMTP server when connecting and for each reply, in seconds. Optional. The default is 60.
+	receiverprocesses=<int>: Run the proxy in supervisor mode with this number of receiver processes, which share the SMTP port with SO_REUSEPORT. 0 runs everything in one process. Optional. The default is 0.
+	deliveryprocesses=<int>: The number of delivery processes in supervisor mode. Optional. The default is 1.
+	backlog=<int>        : The number of connections that wait to be accepted by the SMTP server. Optional. The default is 128.
+	maxsessions=<int>    : The maximum number of concurrent SMTP connections. Further connections are rejected with 421. 0 means no limit. Optional. The default is 0.
+	maxsessionsperip=<int>: The maximum number of concurrent SMTP connections from one client IP address. 0 means no limit. Optional. The default is 0.
+	commandtimeout=<int> : The time to wait for the next command of a client before the connection is closed, in seconds. 0 means no timeout. Optional. The default is 300.
+	datatimeout=<int>    : The time to wait for more message data of a client before the connection is closed, in seconds. 0 means no timeout. Optional. The default is 180.
+	maxqueuedmails=<int> : New connections and mails are temporarily rejected (421/451) while more mails than this are waiting for delivery. 0 means no limit. Optional. The default is 0.
+	maxqueuedbytes=<int> : New connections and mails are temporarily rejected (421/451) while the waiting mails are larger than this in total, in bytes. 0 means no limit. Optional. The default is 0.
+	engine=<str>         : The connection handling of the SMTP server. Either "thread" (one thread per connection) or "asyncio" (all connections on one event loop, requires Python 3.7). Optional. The default is "thread".
+	handlers=<list>      : The names of the mail handler classes that are called for a received mail, separated by spaces, in calling order. Optional. By default all enabled handlers are called in the order of their names.
+	handlerprocesses=<int>: The number of worker processes for mail handlers that run in a separate process. 0 runs them in the proxy process. Optional. The default is 2.
+	handlerworkers=<int> : The number of threads that call the mail handlers that run after a mail was accepted. Optional. The default is 2.
+	handlerqueuesize=<int>: The maximum number of mails that wait for these handlers. Optional. The default is 100.
+	handlerqueuewait=<int>: The time to wait for room in the queue before a mail is rejected with a temporary error, in seconds. Optional. The default is 30.
+	handlerattempts=<int>: The number of attempts to call a failed handler. Optional. The default is 3.
+	handlerretrydelay=<int>: The time before a failed handler is called again, in seconds. The delay doubles with every attempt. Optional. The default is 30.
+	metricsport=<int>    : The port of an HTTP server that serves metrics in the Prometheus text format at /metrics. Optional. The default is 0 (no metrics server).
+	metricsaddress=<str> : The address the metrics server listens on. The server has no authentication. Optional. The default is 127.0.0.1.
+	tracesample=<float>  : The fraction of the received mails (0..1) whose stage times are written to the trace file. Optional. The default is 0 (no tracing).
+	tracefile=<str>      : The file the traces are appended to, one JSON object per line. Optional. The default is 'smtpproxy.trace'.
+	profileseconds=<int> : The duration of a profiler capture, which is started by the signal SIGUSR1 or by a POST request of the /profile path of the metrics server. Optional. The default is 30.
+	profiledir=<str>     : The directory the profiler captures are written to. Optional. The default is the current directory.
 
 The configuration of the logging sub-system.
 
@@ -48,6 +83,8 @@ The configuration of the logging sub-system.
 	size=<int>           : Size of the logfile before splitting it up into a new logfile. Optional. The default is 1000000.
 	count=<int>          : Number of logfiles to keep. Optional. The default is 10.
 	level=<str>          : One of DEBUG, INFO, WARNING, ERROR or NONE. In case of NONE, only critical errors are logged. Optional. The default is INFO.
+	console=<bool>       : Also print the log messages to the console. Optional. The default is true.
+	async=<bool>         : Write the log messages by a separate thread, in batches, so that logging never blocks. Optional. The default is false.
 
 The configuration for the sender's mail accounts. This section can be appear more
 than once in the configuration file. Actually, for each sender's mail account
@@ -64,7 +101,7 @@ one section must be configured.
 	popssl=<bool>		 : Indicates whether the POP connection should be using SSL. The default is true.
 	popusername=<str>    : The username for the POP3 account. Mandatory only if popbeforesmtp is set to true.
 	poppassword=<str>    : The password for the POP3 account. Mandatory only if popbeforesmtp is set to true.
-	popcheckdelay=<int>  : The time to wait before it is needed to reauthenticate again with the POP3 server, in seconds. Optional. The default is 60.
+	popcheckdelay=<int>  : The time to wait before it is needed to reauthenticate again with the POP3 server, in seconds. While the account is in use the authentication is renewed in the background before this time has passed. It must be greater than waitafterpop + 5. Optional. The default is 60.
 	smtpusername=<str>   : The username for the SMTP account. This must be provided if the SMTP server needs authentication.
 	smtppassword=<str>   : The password for the SMTP account. This must be provided if the SMTP server needs authentication.
 	localhostname=<str>  : The hostname used by the proxy to identify the host it is running on to the remote SMTP server. Optional.
@@ -72,6 +109,8 @@ one section must be configured.
 	returnpath=<str>     : Specifies a bounce email address for a message. Optional.
 	replyto=<str>        : Specifies a reply email address for a message response. Optional.
 	forcefrom=<str>      : Specifies a from email address for a message. Optional.
+	workers=<int>        : The maximum number of mails of this account that are delivered at the same time. Optional. The default is the value of 'accountworkers'.
+	maxsize=<int>        : The maximum size of a mail of this account, in bytes. Only a limit that is smaller than 'maxmessagesize' has an effect. Optional. By default only 'maxmessagesize' applies.
 
 	use=<str>            : The name of another account configuration. If this is set then the configuration data of that account is taken instead.
 
@@ -79,8 +118,8 @@ one section must be configured.
 """
 
 from hmac import new
-import logging, os, pickle, sys, time, email, types, tempfile, ssl
-import config, mlogging, smtps
+import collections, io, logging, os, pickle, re, signal, socket, sys, time, email, types, ssl, threading
+import accounts, config, mlogging, smtps, smtppool, spool, delivery, dirwatch, queueindex, popauth, headers, MailHandler, handlerpool, handlerqueue, metrics, tracing, supervisor
 if sys.version_info[0] > 2:
     from _thread import *
 else:
@@ -111,10 +150,14 @@ class MailAccount:
 		* returnpath - Specifies a bounce email address for a message. The default is None.
 		* replyto - Specifies a reply email address for a message response. The default is None.
 		* useconfig - The name of another account configuration. If this is set then the configuration data of that account is taken instead.
+		* workers - The maximum number of mails of this account that are delivered at the same time. The default is None (use the global setting).
+		* maxsize - The maximum size of a mail of this account in bytes. The default is None (use the global setting).
+		* name - The name of the account's configuration section.
 	"""
 
 	def __init__(self):
 		"""Initialize instance variables."""
+		self.name				= None
 		self.rsmtphost			= None
 		self.rsmtpport			= 0
 		self.rsmtpsecurity		= 'none'
@@ -133,44 +176,136 @@ class MailAccount:
 		self.replyto			= None
 		self.forcefrom			= None
 		self.useconfig			= None
+		self.workers			= None
+		self.maxsize			= None
 
 
 
 class Mail:
 	""" This calss holds a received e-mail. It holds all the necessary
-		attributes of a mail. Istances of this class are written temporarly to
-		the filesystem and scheduled for later sending.
+		attributes of a mail while it is processed by the mail handlers. The
+		mail is then written temporarly to the filesystem (see spool.py) and
+		scheduled for later sending.
 	"""
 
 	def __init__(self):
 		""" Initialize intstance variables."""
-		self.msg	= None
 		self.to		= []
 		self.frm	= ''
+		self._source = None		# function that returns the message text
+
+
+	def __getattr__(self, name):
+		""" The message text 'msg' is only read from the received data when a
+			mail handler accesses it.
+		"""
+		if name == 'msg':
+			source = self.__dict__.get('_source')
+			self.msg = source() if source != None else None
+			return self.msg
+		raise AttributeError(name)
 
 
 # Internal variables
 receivedHeader		= 'Python SMTP Proxy'	# The identifier of the SMTP proxy server that is inserted in the e-mail header.
 smtpconfig			= None
-mailaccounts		= {}
+accountResolver		= accounts.AccountResolver({})	# the mail accounts, replaced as a whole on a reload
+reloadLock			= threading.Lock()
 configFile 			= 'smtpproxy.ini'
 port				= 25
 msgdir				= ''
 sleeptime			= 30
 waitafterpop		= 5
-popchecktime		= 0
 debuglevel			= 0
 deleteonerror		= True
+engine				= 'thread'
+spoolthreshold		= 1024 * 1024
+maxmessagesize		= 0					# maximum size of a received mail, 0 = no limit
+spoolsync			= True				# flush received mails to disk before they are acknowledged
+spoolCommitter		= None
+smtppoolsize		= 4
+smtpidletimeout		= 30
+smtpmaxmessages		= 100
+smtptimeout			= 60
+smtpPool			= None
+popAuth				= None
+deliveryworkers		= 4
+accountworkers		= 2
+deliveryQueue		= None
+watchdir			= True
+spoolEvent			= threading.Event()	# set when a new mail is spooled
+spoolRescan			= threading.Event()	# set when the message directory must be rescanned
+newMails			= set()				# envelope files written by other processes
+newMailsLock		= threading.Lock()
+queueIndex			= None
+maxattempts			= 1
+retrydelay			= 60
+retrymaxdelay		= 3600
+batchsize			= 50
+claimhold			= 600				# time until a mail that is in delivery is scheduled again
+leasetimeout		= 3600				# time after which the claim of a mail that wasn't renewed is broken
+receiverprocesses	= 0					# number of receiver processes, 0 = no supervisor
+deliveryprocesses	= 1
+maxqueuedmails		= 0					# tempfail new mails above this number of spooled mails, 0 = no limit
+maxqueuedbytes		= 0					# tempfail new mails above this size of the spool, 0 = no limit
+spoolUsageCache		= (0, 0, 0)			# (time, mails, bytes) of the last check of the spool
+spoolUsageLock		= threading.Lock()
+spoolUsageInterval	= 2
+
+# Admission control of the SMTP server
+backlog				= 128
+maxsessions			= 0
+maxsessionsperip	= 0
+commandtimeout		= 300
+datatimeout			= 180
 
 # Mail handler
 mailHandlerDir = os.path.dirname(os.path.abspath(__file__)) + '/handlers'
-mailHandlers = {}
+mailHandlers = collections.OrderedDict()	# the handler chain, in calling order
+handlerOrder = None
+handlerprocesses = 2
+handlerPool = None
+handlerQueue = None
+handlerQueueName = 'handlerqueue'
+handlerworkers = 2
+handlerqueuesize = 100
+handlerqueuewait = 30
+handlerattempts = 3
+handlerretrydelay = 30
+
+# Metrics
+metricsport = 0				# port of the metrics HTTP server, 0 = off
+metricsaddress = '127.0.0.1'
+
+# Tracing and profiling
+tracesample = 0.0			# fraction of the mails that are traced
+tracefile = 'smtpproxy.trace'
+tracer = tracing.Tracer(tracefile)
+profileseconds = 30
+profiledir = '.'
+profiler = None
+connectionsTotal = metrics.Counter('smtpproxy_connections_total', 'SMTP connections accepted by the proxy.')
+connectionsRejected = metrics.Counter('smtpproxy_connections_rejected_total', 'SMTP connections rejected because the spool is full.')
+mailsDeferred = metrics.Counter('smtpproxy_mails_deferred_total', 'Mails temporarily rejected because the spool is full.')
+sessionsActive = metrics.Gauge('smtpproxy_sessions_active', 'Open SMTP sessions.')
+mailsReceived = metrics.Counter('smtpproxy_mails_received_total', 'Mails received and scheduled for sending, per account.', [ 'account' ])
+mailsRelayed = metrics.Counter('smtpproxy_mails_relayed_total', 'Mails sent to the remote SMTP server, per account.', [ 'account' ])
+upstreamErrors = metrics.Counter('smtpproxy_upstream_errors_total', 'Failed sends to the remote SMTP server, per account and SMTP reply code.', [ 'account', 'code' ])
+queueDepth = metrics.Gauge('smtpproxy_queue_mails', 'Mails in the message directory waiting for delivery.', function=lambda: queueIndex.count() if queueIndex != None else None)
+queueOldest = metrics.Gauge('smtpproxy_queue_oldest_age_seconds', 'Age of the oldest mail waiting for delivery.', function=lambda: oldestMailAge())
+handlerQueueDepth = metrics.Gauge('smtpproxy_handler_queue_mails', 'Mails waiting for the mail handlers that run after a mail was accepted.', function=lambda: len(handlerQueue) if handlerQueue != None else None)
+dataSeconds = metrics.Histogram('smtpproxy_data_receive_seconds', 'Time to receive the message data from the client.')
+handlerSeconds = metrics.Histogram('smtpproxy_handler_seconds', 'Time spent in a mail handler.', [ 'handler' ])
+spoolSeconds = metrics.Histogram('smtpproxy_spool_write_seconds', 'Time to write a received mail to the message directory.')
+sendSeconds = metrics.Histogram('smtpproxy_send_seconds', 'Time to send a mail to the remote SMTP server, per account.', [ 'account' ])
 
 # logging defaults
 logFile		= 'smtpproxy.log'
 logSize		= 1000000
 logCount	= 10
 logLevel	= logging.INFO
+logConsole	= True
+logAsync	= False
 
 
 class SMTPProxyService(smtps.SMTPServerInterface):
@@ -184,15 +319,70 @@ class SMTPProxyService(smtps.SMTPServerInterface):
 		"""	Initialize the instance.
 		"""
 		self.mail = Mail()
+		self.sizeLimit = None
+		self.dataStarted = None
+		self.connectTime = time.time()
+		self.trace = tracing.nullTrace
+		connectionsTotal.inc()
+		sessionsActive.inc()
+
+
+	def closed(self):
+		"""	The connection was closed.
+		"""
+		sessionsActive.dec()
+
+
+	def connected(self, address):
+		"""	A client connected. It is asked to come back later while the spool
+			is full.
+		"""
+		if spoolFull():
+			connectionsRejected.inc()
+			return '421 4.3.2 Service temporarily unavailable, try again later'
+
+
+	def maxMessageSize(self):
+		"""	Return the size limit of the account of the current mail.
+		"""
+		return self.sizeLimit
+
+
+	def dataStart(self):
+		"""	The client starts to send the message data.
+		"""
+		self.dataStarted = time.time()
+		self.trace.stamp('data')
+
+
+	def reset(self, args):
+		"""	Discard the current mail transaction.
+		"""
+		self.mail = Mail()
+		self.sizeLimit = None
+		self.trace = tracing.nullTrace
 
 
 	def mailFrom(self, args):
 		"""	Receive the from: part (sender) of the e-mail.
 		"""
 
-		# Stash who its from for later
+		# A new mail transaction starts. Stash who its from for later
+		self.mail = Mail()
+		if spoolFull():
+			mailsDeferred.inc()
+			return '451 4.3.1 Insufficient system resources, try again later'
 		self.mail.frm = smtps.stripAddress(args)
 
+		# The account may accept only smaller mails than the server
+		account = getMailAccount(self.mail.frm) or getMailAccount('default')
+		self.sizeLimit = account.maxsize if account != None else None
+		size = smtps.mailParameters(args).get('SIZE')
+		if self.sizeLimit and size != None and int(size) > self.sizeLimit:
+			return smtps.SMTPServerEngine.sizeResponse
+		self.trace = tracer.trace(self.connectTime)
+		self.trace.stamp('mail')
+
 
 	def rcptTo(self, args):
 		"""	Receive the to; part (receipient) of the e-mail.
@@ -203,34 +393,76 @@ class SMTPProxyService(smtps.SMTPServerInterface):
 
 
 	def data(self, args):
+		""" Receive the remaining part of the e-mail as a string. The mail is
+			processed by dataFile().
+		"""
+		return self.dataFile(io.BytesIO(args.encode('utf-8') + b'\r\n'))
+
+
+	def dataFile(self, fp):
 		""" Receive the remeining part of the e-mail (beside of the from: and
 			to: received earlier, ie. the remaining header and the body part
-			of the e-mail).
+			of the e-mail) in the binary file object 'fp'.
 			A new received: header is added to the header.
 			An optional return-path: header is added to the header.
 			An optional reply-to: header is added to the header.
-			Finally, the e-mail is stored in the file system.
+			An optional from: header replaces the existing ones.
+			Finally, the e-mail is stored in the file system. Only the header
+			is rewritten, the body is copied unchanged from 'fp'.
 		"""
 
 		import email.utils
 		global	msgdir, receivedHeader
 
-		self.mail.msg = ( args )
-
-		# call the mail handlers to process this message
-		# TODO: specify the order of the handlers to be called
-		# TODO: handle the returned and possible modified email
-		try:
-			msg = email.message_from_string(self.mail.msg)
-			for h in mailHandlers:
+		if self.dataStarted != None:
+			dataSeconds.observe(time.time() - self.dataStarted)
+			self.dataStarted = None
+		trace = self.trace
+		trace.stamp('dataend')
+		(fields, separator) = headers.readHeader(fp)
+		bodyStart = fp.tell()
+		self.rewriter = headers.HeaderRewriter()
+
+		# call the chain of mail handlers to process this message. The message
+		# is only parsed as far as the handlers need it, and all handlers
+		# work on the same message object. It is serialized once at the end,
+		# and only if a handler changed it.
+		syncHandlers = [ h for h in mailHandlers if getattr(mailHandlers[h], 'phase', MailHandler.MailHandler.SYNC) == MailHandler.MailHandler.SYNC ]
+		asyncHandlers = [ h for h in mailHandlers if h not in syncHandlers ]
+		if len(syncHandlers) > 0:
+			message = headers.LazyMessage(fields, separator, fp)
+			self.mail._source = message.text
+			for h in syncHandlers:
 				# Call all mail handlers. If any of the mail handlers
 				# returns False then the mail is not further processed and
-				# discarded.
-				if not mailHandlers[h].handleMessage(msg, self.mail, self):
+				# discarded. A handler that returns a message changed it.
+				try:
+					result = callMailHandler(h, mailHandlers[h], message, self.mail, self)
+				except (handlerpool.HandlerTimeout, handlerpool.HandlerCrashed):
+					mlog.logerr(str(sys.exc_info()[1]))
+					policy = getattr(mailHandlers[h], 'onTimeout', MailHandler.MailHandler.ACCEPT)
+					if policy == MailHandler.MailHandler.TEMPFAIL:
+						return '451 Requested action aborted: error in processing'
+					if policy == MailHandler.MailHandler.SKIP:
+						continue
+					break
+				except:
+					mlog.logerr('Message handler caught exception: ' +  str(sys.exc_info()[0]) +": " + str(sys.exc_info()[1]))
+					break
+				if result is True:
+					continue
+				if result is False or result is None:
 					mlog.log('MailHandler "' + mailHandlers[h].__class__.__name__ + '" canceled processing. Mail discarded.')
+					trace.set('result', 'discarded')
+					tracer.finish(trace)
 					return
-		except:
-			mlog.logerr('Message handler caught exception: ' +  str(sys.exc_info()[0]) +": " + str(sys.exc_info()[1]))
+				message.modified(result)
+			try:
+				(fields, separator, fp) = message.serialize()
+			except:
+				mlog.logerr('Serializing message caught exception: ' +  str(sys.exc_info()[0]) +": " + str(sys.exc_info()[1]))
+				fp.seek(bodyStart)
+			trace.stamp('handlers')
 
 		# Get account data
 
@@ -244,37 +476,62 @@ class SMTPProxyService(smtps.SMTPServerInterface):
 
 
 		# Add headers at the start!
-		self.mail.msg = 'Received: (' + receivedHeader + ') ' + email.utils.formatdate() + '\n' + self.mail.msg
-		#self.mail.msg = ("From: %s\r\nTo: %s\r\n%s" % (self.mail.frm, ", ".join(self.mail.to), args))
+		self.rewriter.prepend('Received', '(' + receivedHeader + ') ' + email.utils.formatdate())
 		if account.returnpath != None:
-			self.mail.msg = 'Return-Path: ' + account.returnpath + '\n' + self.mail.msg
+			self.rewriter.prepend('Return-Path', account.returnpath)
 		if account.replyto != None:
-			self.mail.msg = 'Reply-To: ' + account.replyto + '\n' + self.mail.msg
+			self.rewriter.prepend('Reply-To', account.replyto)
 		if account.forcefrom != None:
-			newmsg = ''
-			for line in self.mail.msg.split('\n'):
-				if not line.startswith('From:'):
-					newmsg += line + '\n'
-			self.mail.msg = newmsg
-			self.mail.msg = 'From: ' + account.forcefrom + '\n' + self.mail.msg
+			self.rewriter.remove('From')
+			self.rewriter.prepend('From', account.forcefrom)
+		# The handlers that run after the mail was accepted need room in
+		# their queue. If there is none then the client has to slow down.
+		if len(asyncHandlers) > 0 and handlerQueue != None:
+			if not handlerQueue.reserve(handlerqueuewait):
+				mlog.logerr('Mail handler queue is full. Mail rejected.')
+				return '451 Requested action aborted: local error in processing'
+		else:
+			asyncHandlers = []
 		# Save message
 		try:
-			(file, fn) = tempfile.mkstemp(suffix='.msg', dir=msgdir)
-			pickle.dump(self.mail, os.fdopen(file, 'wb'))
+			header = self.rewriter.rewrite(fields) + separator
+			envelope = spool.Envelope(self.mail.frm, self.mail.to, account.name)
+			if trace.sampled:
+				# For a delivery by another process, e.g. in supervisor mode
+				trace.set('account', account.name)
+				envelope.trace = trace.state()
+			with spoolSeconds.time():
+				fn = spool.store(msgdir, [ header, fp ], envelope, spoolCommitter)
 		except:
 			mlog.logerr('Saving mail caught exception: ' +  str(sys.exc_info()[0]) +": " + str(sys.exc_info()[1]))
-			return
-		mlog.log('Mail scheduled for sending (' + fn + ')')
-
+			if len(asyncHandlers) > 0:
+				handlerQueue.cancel()
+			trace.set('result', 'failed')
+			tracer.finish(trace)
+			return '451 Requested action aborted: local error in processing'
+		if len(asyncHandlers) > 0:
+			try:
+				handlerQueue.submit(spool.messageFile(fn), self.mail.frm, self.mail.to, asyncHandlers)
+			except:
+				mlog.logerr('Queueing mail for handlers caught exception: ' +  str(sys.exc_info()[0]) +": " + str(sys.exc_info()[1]))
+		try:
+			queueIndex.add(os.path.basename(fn), envelope)
+		except:
+			mlog.logerr('Indexing mail caught exception: ' +  str(sys.exc_info()[0]) +": " + str(sys.exc_info()[1]))
+			spoolRescan.set()
+		mailsReceived.inc(account.name)
+		trace.stamp('spooled')
+		trace.set('mail', os.path.basename(fn))
+		tracer.stored(os.path.basename(fn), trace)
+		mlog.log('Mail scheduled for sending (%s)', fn)
+		spoolEvent.set()
 
 
 	def setTo(self, newTo):
 		""" Callback for changing the to: field of a message.
 		"""
-		msg = email.message_from_string(self.mail.msg)
-		msg.replace_header('To', newTo)
+		self.rewriter.replace('To', newTo)
 		self.mail.to = [ newTo ]
-		self.mail.msg =  str(msg)
 
 
 	def setFrom(self, newFrom):
@@ -285,63 +542,384 @@ class SMTPProxyService(smtps.SMTPServerInterface):
 
 
 
-def	sendMail(mail, filename = None):
-	""" Send an e-mail to a real SMTP server, depending on the sender's
-		configuration. First, the configuration is checked, then (if
-		necessary), a POP-before-SMTP authentication is performed before
-		actually sending the mail.
+class AcceptedMailCallback:
+	""" The callback object for the mail handlers that run after a mail was
+		accepted. The mail can't be changed anymore.
 	"""
 
-	import poplib, smtplib
-	global popchecktime, mailaccounts, waitafterpop, debuglevel
+	def setTo(self, newTo):
+		mlog.logwarn('setTo() is ignored for a mail that was already accepted')
+
+
+	def setFrom(self, newFrom):
+		mlog.logwarn('setFrom() is ignored for a mail that was already accepted')
+
+
 
-	# find mail configuration for the sender's mail account
-	account = getMailAccount(mail.frm)
+def callMailHandler(name, handler, message, mail, callback):
+	""" Call a mail handler, in a worker process if the handler asks for
+		it. Returns the handler's result.
+	"""
+	needs = getattr(handler, 'needs', MailHandler.MailHandler.FULL)
+	if handlerPool == None or not getattr(handler, 'process', False):
+		with handlerSeconds.time(name):
+			return handler.handleMessage(message if needs != MailHandler.MailHandler.ENVELOPE else None, mail, callback)
+
+	data = None
+	if needs != MailHandler.MailHandler.ENVELOPE:
+		data = message.toBytes(needs == MailHandler.MailHandler.HEADERS)
+	with handlerSeconds.time(name):
+		r = handlerPool.call(name, needs, data, mail.frm, mail.to, getattr(handler, 'timeout', None))
+	mail.frm = r.frm
+	mail.to = r.to
+	for (method, arg) in r.calls:
+		getattr(callback, method)(arg)
+	if r.message != None:
+		message.modified(email.message_from_string(r.message))
+	elif r.headers != None:
+		message.setHeaders(r.headers)
+	return True if r.result == 'modified' else r.result
+
+
+def runAcceptedHandlers(job, messageFile):
+	""" Call the mail handlers that run after a mail was accepted. This
+		function is called by the workers of the handler queue. Their
+		results and changes of the mail are ignored. Returns the names of
+		the handlers that failed and should be called again.
+	"""
+	failed = []
+	with open(messageFile, 'rb') as fp:
+		(fields, separator) = headers.readHeader(fp)
+		message = headers.LazyMessage(fields, separator, fp)
+		callback = AcceptedMailCallback()
+		for h in job.handlers:
+			if h not in mailHandlers:
+				mlog.logerr('Mail handler "' + h + '" is not available anymore')
+				continue
+			mail = Mail()
+			mail.frm = job.frm
+			mail.to = list(job.to)
+			mail._source = message.text
+			try:
+				callMailHandler(h, mailHandlers[h], message, mail, callback)
+			except (handlerpool.HandlerTimeout, handlerpool.HandlerCrashed):
+				mlog.logerr(str(sys.exc_info()[1]))
+				if getattr(mailHandlers[h], 'onTimeout', MailHandler.MailHandler.ACCEPT) == MailHandler.MailHandler.TEMPFAIL:
+					failed.append(h)
+			except:
+				mlog.logerr('Message handler "' + h + '" caught exception: ' +  str(sys.exc_info()[0]) +": " + str(sys.exc_info()[1]))
+				failed.append(h)
+	return failed
+
+
+def resolveAccount(envelope, filename):
+	""" Find the mail account for a scheduled mail, falling back to the default
+		account. Returns None if there is none.
+	"""
+	account = getMailAccount(envelope.frm)
 	if account == None:
-		mlog.logerr('No account data found for ' + mail.frm + ' (' + filename + ')' + ', switching to default account')
+		mlog.logerr('No account data found for ' + envelope.frm + ' (' + filename + ')' + ', switching to default account')
 		account = getMailAccount('default')
 		if account == None:
 			mlog.logerr('No default account data found (' + filename + ')')
-			return False
+	return account
 
-	# First do POP-Before-SMTP, if necessary
-	if account.rPBS and (popchecktime + account.rpopcheckdelay) < time.time():
+
+def	sendMail(envelope, filename = None):
+	""" Send an e-mail to a real SMTP server, depending on the sender's
+		configuration. 'envelope' is the spool.Envelope of the mail, and
+		'filename' the name of its envelope file. Returns True if the mail
+		was sent.
+	"""
+	account = resolveAccount(envelope, filename)
+	if account == None:
+		envelope.lastError = 'No account data found'
+		return False
+	return sendMails(account, [ (envelope, filename) ])[0]
+
+
+def sendMails(account, mails, finished = None):
+	""" Send a batch of e-mails of the same account to the account's real SMTP
+		server. The mails are sent as successive transactions over a single
+		connection. A required POP-before-SMTP authentication must already
+		have been done (see 'popAuth'). The connection is taken from, and returned to, the
+		connection pool. A failed mail doesn't end the session: the
+		transaction is reset and the next mail is sent. When the server can't
+		be reached then the remaining mails fail without further connection
+		attempts. 'mails' is a list of tuples (spool.Envelope, envelope file
+		name). Returns a list with a boolean result for each mail. If 'finished' is given then it is
+		called as finished(envelope file name, envelope, result) as soon as
+		each mail was sent, so that a sent mail isn't sent again when the
+		process dies before the end of the batch.
+	"""
+
+	import smtplib
+	global smtpPool
+
+	results = []
+	conn = None
+	connectError = None
+	renewed = time.time()
+	for (i, (envelope, filename)) in enumerate(mails):
+		if time.time() - renewed > leasetimeout / 4:
+			# Don't let the claims of the waiting mails of a long batch expire
+			for (e, fn) in mails[i:]:
+				spool.renew(fn)
+			renewed = time.time()
+		frm = envelope.frm
+		if account.forcefrom != None:
+			frm = account.forcefrom
+		mlog.log('Sending mail from: %s to: %s', frm, ','.join(envelope.to))
+		msgfile = spool.messageFile(filename)
+		started = time.time()
+		trace = pendingTrace(envelope, filename)
+		trace.stamp('delivery')
+		if connectError != None:
+			envelope.lastError = connectError
+			finishTrace(trace, filename, envelope, envelope.lastError)
+			results.append(False)
+			if finished != None:
+				finished(filename, envelope, False)
+			continue
 		try:
-			mlog.log("Performing Pop-before-SMTP")
+			if conn == None:
+				conn = smtpPool.acquire(account)
+			try:
+				sendMessage(conn.server, frm, envelope.to, msgfile)
+			except smtplib.SMTPServerDisconnected:
+				if not conn.reused:
+					raise
+				# The remote server closed the pooled connection in the meantime
+				mlog.logdebug('Pooled connection was closed, reconnecting')
+				smtpPool.discard(conn)
+				conn = None
+				conn = smtpPool.acquire(account)
+				sendMessage(conn.server, frm, envelope.to, msgfile)
+		except (smtplib.SMTPSenderRefused, smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError):
+			# The session is still usable after a reset
+			mlog.logerr('SMTP caught exception: ' +  str(sys.exc_info()[0]) +": " + str(sys.exc_info()[1]))
+			envelope.lastError = str(sys.exc_info()[1])
+			upstreamErrors.inc(account.name, smtpErrorCode(sys.exc_info()[1]))
+			finishTrace(trace, filename, envelope, envelope.lastError)
+			if not smtpPool.finished(conn, False):
+				conn = None
+			results.append(False)
+			if finished != None:
+				finished(filename, envelope, False)
+			continue
+		except:
+			# TODO: check Greylist errror
+			mlog.logerr('SMTP caught exception: ' +  str(sys.exc_info()[0]) +": " + str(sys.exc_info()[1]))
+			envelope.lastError = str(sys.exc_info()[1])
+			upstreamErrors.inc(account.name, smtpErrorCode(sys.exc_info()[1]))
+			finishTrace(trace, filename, envelope, envelope.lastError)
+			if conn != None:
+				smtpPool.discard(conn)
+				conn = None
+			else:
+				# Connecting failed. Don't try again for every mail of the batch.
+				connectError = envelope.lastError
+			results.append(False)
+			if finished != None:
+				finished(filename, envelope, False)
+			continue
+		sendSeconds.observe(time.time() - started, account.name)
+		mailsRelayed.inc(account.name)
+		finishTrace(trace, filename, envelope)
+		if not smtpPool.finished(conn):
+			conn = None
+		results.append(True)
+		if finished != None:
+			finished(filename, envelope, True)
+	if conn != None:
+		smtpPool.release(conn)
+	return results
+
+
+def pendingTrace(envelope, filename):
+	""" Return the trace of a mail that is about to be delivered. It was
+		either stored by this process, or it is taken from the envelope
+		when the mail was received by another process. Then the time the
+		envelope was written is the time of the 'spooled' stage.
+	"""
+	name = os.path.basename(filename)
+	if envelope.trace == None:
+		return tracer.pending(name)
+	try:
+		stored = os.path.getmtime(filename)
+	except OSError:
+		stored = None
+	trace = tracer.pending(name, envelope.trace, stored)
+	if trace.sampled:
+		trace.set('mail', name)
+	return trace
+
+
+def finishTrace(trace, filename, envelope, error = None):
+	""" Write the trace of a mail after its (first) delivery attempt. The
+		trace is removed from the envelope, so that further attempts are not
+		traced.
+	"""
+	envelope.trace = None
+	if not trace.sampled:
+		return
+	trace.stamp('delivered' if error == None else 'failed')
+	trace.set('result', 'ok' if error == None else error)
+	try:
+		tracer.finish(trace, os.path.basename(filename))
+	except:
+		mlog.logerr('Writing trace caught exception: ' +  str(sys.exc_info()[0]) +": " + str(sys.exc_info()[1]))
 
-			M = poplib.POP3_SSL(account.rpophost, account.rpopport)
-			M.user(account.rpopuser)
-			M.pass_(account.rpoppass)
-			M.quit()
 
-			popchecktime = time.time()
+def startProfiler(seconds):
+	""" Start a capture of the profiler. Returns a message for the requester,
+		or None if a capture is already running. Raises a ValueError if
+		'seconds' is not a positive number.
+	"""
+	seconds = int(seconds)
+	if seconds <= 0:
+		raise ValueError('The duration must be a positive number of seconds')
+	fn = profiler.start(seconds)
+	if fn == None:
+		return None
+	return 'Profiling for ' + str(seconds) + ' seconds to ' + fn + '\n'
+
+
+def smtpErrorCode(e):
+	""" Return the SMTP reply code of a failed send as a string, for the
+		metrics. Errors without a reply code, e.g. network errors, are
+		reported as 'none'.
+	"""
+	code = getattr(e, 'smtp_code', None)
+	if code == None and isinstance(getattr(e, 'recipients', None), dict) and len(e.recipients) > 0:
+		code = list(e.recipients.values())[0][0]
+	return str(code) if code != None else 'none'
+
+
+def spoolFull():
+	""" Check whether the number or the size of the spooled mails is above
+		the configured limits. The usage is taken from the queue index, at
+		most every 'spoolUsageInterval' seconds. While another thread updates
+		it the previous values are used, so that the asyncio engine's event
+		loop doesn't wait.
+	"""
+	global spoolUsageCache
 
-			time.sleep(waitafterpop)
+	if maxqueuedmails <= 0 and maxqueuedbytes <= 0:
+		return False
+	(checked, count, size) = spoolUsageCache
+	now = time.time()
+	if now - checked > spoolUsageInterval and queueIndex != None and spoolUsageLock.acquire(False):
+		try:
+			(count, size) = queueIndex.usage()
+			spoolUsageCache = (now, count, size)
 		except:
-			mlog.logerr('POP-before-SMTP caught exception: ' +  str(sys.exc_info()[0]) +": " + str(sys.exc_info()[1]))
-			return False
+			mlog.logerr('Checking the spool usage caught exception: ' +  str(sys.exc_info()[0]) +": " + str(sys.exc_info()[1]))
+		finally:
+			spoolUsageLock.release()
+	return (maxqueuedmails > 0 and count >= maxqueuedmails) or (maxqueuedbytes > 0 and size >= maxqueuedbytes)
+
+
+def oldestMailAge():
+	""" Return the age of the oldest scheduled mail in seconds, for the
+		metrics.
+	"""
+	if queueIndex == None:
+		return None
+	oldest = queueIndex.oldest()
+	return time.time() - oldest if oldest != None else 0
+
+
+def sendMessage(server, frm, to, msgfile):
+	""" Send the message in the file 'msgfile' in one SMTP transaction. Unlike
+		smtplib's sendmail() the message is not read into a string, but mapped
+		into memory and written to the socket directly. The file must
+		contain CRLF line endings. Like sendmail() a missing CRLF at the end
+		of the message is added. Raises the same exceptions as sendmail().
+	"""
+
+	import mmap, smtplib
+
+	server.ehlo_or_helo_if_needed()
+	(code, resp) = server.mail(frm)
+	if code != 250:
+		if code == 421:
+			server.close()
+		raise smtplib.SMTPSenderRefused(code, resp, frm)
+	senderrs = {}
+	for r in to:
+		(code, resp) = server.rcpt(r)
+		if code not in (250, 251):
+			senderrs[r] = (code, resp)
+		if code == 421:
+			server.close()
+			raise smtplib.SMTPRecipientsRefused(senderrs)
+	if len(senderrs) == len(to):
+		raise smtplib.SMTPRecipientsRefused(senderrs)
+
+	server.putcmd('data')
+	(code, resp) = server.getreply()
+	if code != 354:
+		raise smtplib.SMTPDataError(code, resp)
+	terminator = b'\r\n.\r\n'
+	with open(msgfile, 'rb') as f:
+		size = os.fstat(f.fileno()).st_size
+		if size > 0:
+			with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+				view = memoryview(m)
+				try:
+					# Dot-stuffing: a line starting with a dot gets an additional one
+					pos = 0
+					if m[0:1] == b'.':
+						server.sock.sendall(b'.')
+					while pos < size:
+						idx = m.find(b'\r\n.', pos)
+						if idx < 0:
+							server.sock.sendall(view[pos:])
+							break
+						server.sock.sendall(view[pos:idx+3])
+						server.sock.sendall(b'.')
+						pos = idx + 3
+					if m[size-2:size] == b'\r\n':
+						terminator = b'.\r\n'
+				finally:
+					view.release()
+	server.sock.sendall(terminator)
+	(code, resp) = server.getreply()
+	if code != 250:
+		raise smtplib.SMTPDataError(code, resp)
+
+
+def openSMTPConnection(account):
+	""" Open a new connection to the SMTP server of an account. Security is
+		negotiated and the login is performed, if configured. Returns the
+		smtplib.SMTP object.
+
+		Nagle's algorithm is disabled for the connection. sendMessage() writes
+		a message in several parts and then waits for the reply, which would
+		otherwise be delayed until the server acknowledges the last part.
+	"""
+
+	import smtplib
 
-	# Send mail
+	mlog.logdebug('Connecting to %s, port: %s', account.rsmtphost, account.rsmtpport)
+
+	smtpFunc = smtplib.SMTP
+	if account.rsmtpsecurity == 'ssl':
+		smtpFunc = smtplib.SMTP_SSL
+		mlog.log("Using SSL")
+
+	if account.localhostname != None:
+		server = smtpFunc(account.rsmtphost, account.rsmtpport, account.localhostname, timeout=smtptimeout)
+	else:
+		server = smtpFunc(account.rsmtphost, account.rsmtpport, timeout=smtptimeout)
 	try:
-		if account.forcefrom != None:
-			mail.frm = account.forcefrom
-		mlog.log("Sending mail from: " + mail.frm + " to: " + ",".join(mail.to))
-		mlog.logdebug("Port: " + str(account.rsmtpport))
-		
-		smtpFunc = smtplib.SMTP
-		if account.rsmtpsecurity == 'ssl':
-			smtpFunc = smtplib.SMTP_SSL
-			mlog.log("Using SSL")
-
-		if account.localhostname != None:
-			server = smtpFunc(account.rsmtphost, account.rsmtpport, account.localhostname)
-		else:
-			server = smtpFunc(account.rsmtphost, account.rsmtpport)
+		server.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 		server.set_debuglevel(debuglevel)
 		server.ehlo()
 		if account.rsmtpsecurity == 'tls':
 			mlog.log("Using TLS")
-			if account.rsmtpweaktls:				
+			if account.rsmtpweaktls:
 				context=ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
 				context.set_ciphers('DEFAULT@SECLEVEL=1')
 				server.starttls(context=context)
@@ -360,13 +938,10 @@ def	sendMail(mail, filename = None):
 				mlog.log("authentication. Code = " + str(code) + ", response = " + resp)
 				if code == 535:
 					mlog.logerr('Authentication error')
-		server.sendmail(mail.frm, mail.to, mail.msg)
-		server.quit()
 	except:
-		# TODO: check Greylist errror
-		mlog.logerr('SMTP caught exception: ' +  str(sys.exc_info()[0]) +": " + str(sys.exc_info()[1]))
-		return False
-	return True
+		server.close()
+		raise
+	return server
 
 
 def encode_plain(user, password):
@@ -377,53 +952,221 @@ def encode_plain(user, password):
 
 def getMailAccount(frm):
 	""" Find and return the mail account data for a from: address, or None.
+		See accounts.py for the matching of the addresses.
 	"""
-	account = None
-	if frm in mailaccounts.keys():
-		account = mailaccounts[frm]
-		if account.useconfig != None:
-			if account.useconfig in mailaccounts.keys():
-				account = mailaccounts[account.useconfig]
-			else:
-				mlog.logerr('No account data found for referenced configuration ' + account.useconfig + ' (' + filename + ')')
-				return None
-	return account
+	return accountResolver.resolve(frm)
 
 
 def handleScheduledMails():
-	""" This function is executed as a thread. It handles the sending of scheduled
-		e-mails asynchronously.
+	""" This function is executed as a thread. It hands the scheduled e-mails
+		that are due to the delivery workers. It wakes up as soon as a new
+		mail is spooled, either by this process or (when the directory can be
+		watched) by an external writer, or when the next delivery attempt is
+		due. When the directory can't be watched then it is scanned for new
+		mails every 'sleeptime' seconds.
 	"""
-	global	sleeptime, msgdir
+	global	sleeptime, msgdir, watchdir, queueIndex
+
+	watching = False
+	if watchdir:
+		watching = dirwatch.DirectoryWatcher(msgdir, spoolChanged, mlog).start()
+		if watching:
+			mlog.log('Watching ' + msgdir + ' for new mails')
 
+	lastScan = time.time()
 	while True:
-		ld = os.listdir(msgdir)
+		spoolEvent.clear()
+		if not watching and time.time() - lastScan >= sleeptime:
+			spoolRescan.set()
+		if spoolRescan.is_set():
+			spoolRescan.clear()
+			queueIndex.rebuild(mlog)
+			lastScan = time.time()
+		indexNewMails()
+		scheduleMails()
+
+		# finally, wait till a new mail arrives or the next attempt is due
+		timeout = sleeptime
+		nextDue = queueIndex.nextDue()
+		if nextDue != None:
+			timeout = max(0, min(timeout, nextDue - time.time()))
+		spoolEvent.wait(timeout)
+
+
+def spoolChanged(name):
+	""" Called by the directory watcher when a file in the message directory
+		was written or moved there. 'name' is None when events were lost.
+	"""
+	if name == None:
+		spoolRescan.set()
+		spoolEvent.set()
+	elif name.endswith(spool.envelopeSuffix):
+		with newMailsLock:
+			newMails.add(name)
+		spoolEvent.set()
+
+
+def indexNewMails():
+	""" Add mails that were written to the message directory by other processes
+		to the queue index.
+	"""
+	global	newMails
+
+	with newMailsLock:
+		names = newMails
+		newMails = set()
+	for n in names:
+		try:
+			# A mail that is already indexed is kept as it is. Its envelope
+			# was rewritten by a delivery, which updated the index itself,
+			# and the index may hold it while it is in delivery.
+			queueIndex.add(n, spool.readEnvelope(msgdir + '/' + n), False)
+		except:
+			# Removed again
+			pass
+
+
+def scheduleMails():
+	""" Queue the scheduled e-mails that are due for delivery.
+	"""
+	global	msgdir, deliveryQueue, accountworkers, queueIndex
+
+	resolver = accountResolver
+	for e in queueIndex.take(max(100, deliveryworkers * 20), claimhold):
+		fn = msgdir +  '/' + e
+		if fn in deliveryQueue:
+			continue
+		try:
+			envelope = spool.readEnvelope(fn)
+		except:
+			if not os.path.exists(fn):
+				# Delivered by another process in the meantime
+				queueIndex.remove(e)
+				continue
+			mlog.logerr('Reading mail caught exception: ' +  str(sys.exc_info()[0]) +": " + str(sys.exc_info()[1]))
+			if deleteonerror and spool.claim(fn, leasetimeout):
+				mlog.log("Can't process mail. Removing " + fn)
+				spool.remove(fn)
+				queueIndex.remove(e)
+			continue
+		account = resolver.account(envelope.account) if envelope.account != None else None
+		if account == None:
+			account = resolver.resolve(envelope.frm)
+		if account == None:
+			account = resolver.resolve('default')
+		if account != None:
+			deliveryQueue.put(account.name, account.workers if account.workers != None else accountworkers, fn, envelope)
+		else:
+			deliveryQueue.put(None, accountworkers, fn, envelope)
+
+
+def deliverMails(key, items):
+	""" Deliver a batch of scheduled e-mails of the same account. This
+		function is called by the delivery workers. 'items' is a list of
+		tuples (envelope file name, spool.Envelope). The mails are claimed
+		first, so that no other worker delivers the same mail.
+	"""
+	account = accountResolver.account(key) if key != None else None
+	if account == None and len(items) > 0:
+		account = resolveAccount(items[0][1], items[0][0])
+
+	# POP-before-SMTP authentication is done in the background. Until it is
+	# done the mails are deferred, without counting a delivery attempt.
+	error = None
+	if account != None and account.rPBS:
+		try:
+			when = popAuth.check(account)
+		except popauth.PopAuthError:
+			when = None
+			error = str(sys.exc_info()[1])
+		if when != None:
+			mlog.logdebug('Waiting for POP-before-SMTP of %s, deferring %d mail(s)', account.name, len(items))
+			for (fn, envelope) in items:
+				envelope.nextAttempt = when
+				queueIndex.reschedule(os.path.basename(fn), envelope)
+			spoolEvent.set()
+			return
+
+	mails = [ (envelope, fn) for (fn, envelope) in items if spool.claim(fn, leasetimeout) ]
+	if len(mails) == 0:
+		return
+	if account == None or error != None:
+		for (envelope, fn) in mails:
+			envelope.lastError = error if error != None else 'No account data found'
+		for (envelope, fn) in mails:
+			finishDelivery(fn, envelope, False)
+	else:
+		sendMails(account, mails, finishDelivery)
+	if len(deliveryQueue) < deliveryworkers:
+		# Fetch more due mails
+		spoolEvent.set()
+
+
+def finishDelivery(fn, envelope, ok):
+	""" Finish the delivery of a mail of a batch. The mail is released from
+		the delivery queue right away, so that a failed mail whose next
+		attempt is due before the end of the batch is scheduled again. It is
+		released before it is rescheduled: until then it is held in the
+		queue index and can't be taken by the scheduler.
+	"""
+	deliveryQueue.release(fn)
+	finishMail(fn, envelope, ok)
+
+
+def finishMail(fn, envelope, ok):
+	""" Remove a claimed mail after a successful delivery. When the delivery
+		failed then the next attempt is scheduled with an exponential backoff,
+		until 'maxattempts' is reached.
+	"""
+	name = os.path.basename(fn)
+	if ok:
+		mlog.log('Removing scheduled file %s', fn)
+		spool.remove(fn)
+		queueIndex.remove(name)
+		return
+	envelope.attempts += 1
+	if deleteonerror and envelope.attempts >= maxattempts:
+		mlog.log("Can't process mail. Removing " + fn)
+		spool.remove(fn)
+		queueIndex.remove(name)
+	else:
+		delay = min(retrymaxdelay, retrydelay * 2 ** min(envelope.attempts - 1, 30))
+		envelope.nextAttempt = time.time() + delay
+		mlog.log('Delivery of ' + fn + ' failed ' + str(envelope.attempts) + ' time(s), next attempt in ' + str(int(delay)) + ' seconds')
+		try:
+			spool.writeEnvelope(fn, envelope)
+			queueIndex.reschedule(name, envelope)
+		finally:
+			# Also after an error, so that the mail is taken again after 'claimhold'
+			spool.release(fn)
+
+
+def migrateLegacyMails():
+	""" Convert mails that were scheduled by an older version of the proxy
+		(pickled Mail objects in '.msg' files) to the current spool format.
+	"""
+	global	msgdir
+
+	for e in os.listdir(msgdir):
+		if not e.endswith('.msg'):
+			continue
+		fn = msgdir +  '/' + e
+		if not spool.claim(fn):
+			continue
+		try:
+			with open(fn, 'rb') as f:
+				mail = pickle.load(f)
+			msg = re.sub(r'(?:\r\n|\n|\r(?!\n))', '\r\n', mail.msg)
+			if not msg.endswith('\r\n'):
+				msg += '\r\n'
+			newfn = spool.store(msgdir, msg.encode('utf-8'), spool.Envelope(mail.frm, mail.to))
+			os.remove(fn)
+			mlog.log('Converted scheduled mail ' + fn + ' to ' + newfn)
+		except:
+			mlog.logerr('Converting mail ' + fn + ' caught exception: ' +  str(sys.exc_info()[0]) +": " + str(sys.exc_info()[1]))
+		finally:
+			spool.release(fn)
 
-		for e in ld:
-			ok = True
-			try:
-				fn = msgdir +  '/' + e
-				try:
-					mail = pickle.load(open(fn,'rb'))
-					if sendMail(mail, fn) == False:
-						ok = False
-						continue
-				except:
-					mlog.logerr('Reading mail caught exception: ' +  str(sys.exc_info()[0]) +": " + str(sys.exc_info()[1]))
-					ok = False
-					break
-			finally:
-				if ok:
-					mlog.log("Removing scheduled file " + fn)
-					os.remove(fn)
-				else:
-					if deleteonerror:
-						mlog.log("Can't process mail. Removing " + fn)
-						os.remove(fn)
-
-		# finally, sleep till next time
-		#mlog.log("------------------")
-		time.sleep(sleeptime)
 
 #############################################################################
 
@@ -432,7 +1175,7 @@ def readConfig():
 		working directory.
 	"""
 
-	global smtpconfig, mailaccounts, port, msgdir,sleeptime, waitafterpop, debuglevel, deleteonerror
+	global smtpconfig, accountResolver, port, msgdir,sleeptime, waitafterpop, debuglevel, deleteonerror, engine, spoolthreshold, spoolsync, maxmessagesize, smtppoolsize, smtpidletimeout, smtpmaxmessages, smtptimeout, deliveryworkers, accountworkers, watchdir, maxattempts, retrydelay, retrymaxdelay, batchsize, handlerOrder, handlerprocesses, handlerworkers, handlerqueuesize, handlerqueuewait, handlerattempts, handlerretrydelay, metricsport, metricsaddress, tracesample, tracefile, profileseconds, profiledir, receiverprocesses, deliveryprocesses, backlog, maxsessions, maxsessionsperip, commandtimeout, datatimeout, maxqueuedmails, maxqueuedbytes
 
 	if os.path.exists(configFile) == False:
 		print('Configuration file "' + configFile +'" doesn''t exist. Exiting.')
@@ -444,19 +1187,84 @@ def readConfig():
 	port = smtpconfig.getint('config', 'port', default=port)							# port of the smtp proxy
 	msgdir = smtpconfig.get('config', 'msgdir', default="./msgs")					# directory where to store temporary messages
 	sleeptime = smtpconfig.getint('config', 'sleeptime', default=sleeptime)				# sleep time for sending thread
+	watchdir = smtpconfig.getboolean('config', 'watchdir', default=watchdir)				# watch msgdir for new mails
 	waitafterpop = smtpconfig.getint('config', 'waitafterpop', default=waitafterpop)	# time to wait after pop authentication
 	debuglevel = smtpconfig.getint('config', 'debuglevel', default=debuglevel)			# debuglevel for various functions
 	deleteonerror = smtpconfig.getboolean('config', 'deleteonerror', default=deleteonerror)	# delete mail on error
+	maxattempts = smtpconfig.getint('config', 'maxattempts', default=maxattempts)		# delivery attempts before deleting a mail
+	retrydelay = smtpconfig.getint('config', 'retrydelay', default=retrydelay)			# delay before the first retry
+	retrymaxdelay = smtpconfig.getint('config', 'retrymaxdelay', default=retrymaxdelay)	# maximum delay between retries
+	spoolthreshold = smtpconfig.getint('config', 'spoolthreshold', default=spoolthreshold)	# max size of received data kept in memory
+	maxmessagesize = smtpconfig.getint('config', 'maxmessagesize', default=maxmessagesize)	# max size of a received mail
+	spoolsync = smtpconfig.getboolean('config', 'spoolsync', default=spoolsync)		# flush received mails to disk
+	deliveryworkers = smtpconfig.getint('config', 'deliveryworkers', default=deliveryworkers)	# number of delivery threads
+	accountworkers = smtpconfig.getint('config', 'accountworkers', default=accountworkers)	# concurrent deliveries per account
+	batchsize = smtpconfig.getint('config', 'batchsize', default=batchsize)				# mails sent over one connection in a row
+	smtppoolsize = smtpconfig.getint('config', 'smtppoolsize', default=smtppoolsize)		# idle smtp connections per account
+	smtpidletimeout = smtpconfig.getint('config', 'smtpidletimeout', default=smtpidletimeout)	# idle timeout for smtp connections
+	smtptimeout = smtpconfig.getint('config', 'smtptimeout', default=smtptimeout)		# timeout for the network operations of smtp connections
+	smtpmaxmessages = smtpconfig.getint('config', 'smtpmaxmessages', default=smtpmaxmessages)	# max mails per smtp connection
+	handlerOrder = smtpconfig.getlist('config', 'handlers', default=handlerOrder)		# order of the mail handlers
+	handlerprocesses = smtpconfig.getint('config', 'handlerprocesses', default=handlerprocesses)	# worker processes for mail handlers
+	handlerworkers = smtpconfig.getint('config', 'handlerworkers', default=handlerworkers)	# threads for handlers after acceptance
+	handlerqueuesize = smtpconfig.getint('config', 'handlerqueuesize', default=handlerqueuesize)	# max mails waiting for these handlers
+	handlerqueuewait = smtpconfig.getint('config', 'handlerqueuewait', default=handlerqueuewait)	# wait for room in the queue
+	handlerattempts = smtpconfig.getint('config', 'handlerattempts', default=handlerattempts)	# attempts of failed handlers
+	handlerretrydelay = smtpconfig.getint('config', 'handlerretrydelay', default=handlerretrydelay)	# delay before the first retry
+	metricsport = smtpconfig.getint('config', 'metricsport', default=metricsport)		# port of the metrics server
+	metricsaddress = smtpconfig.get('config', 'metricsaddress', default=metricsaddress)	# address of the metrics server
+	tracesample = smtpconfig.getfloat('config', 'tracesample', default=tracesample)		# fraction of the traced mails
+	tracefile = smtpconfig.get('config', 'tracefile', default=tracefile)				# file of the traces
+	profileseconds = smtpconfig.getint('config', 'profileseconds', default=profileseconds)	# duration of a profiler capture
+	profiledir = smtpconfig.get('config', 'profiledir', default=profiledir)			# directory of the profiler captures
+	receiverprocesses = smtpconfig.getint('config', 'receiverprocesses', default=receiverprocesses)	# receiver processes
+	deliveryprocesses = smtpconfig.getint('config', 'deliveryprocesses', default=deliveryprocesses)	# delivery processes
+	backlog = smtpconfig.getint('config', 'backlog', default=backlog)					# queue of connections that wait to be accepted
+	maxsessions = smtpconfig.getint('config', 'maxsessions', default=maxsessions)		# concurrent connections
+	maxsessionsperip = smtpconfig.getint('config', 'maxsessionsperip', default=maxsessionsperip)	# concurrent connections per client
+	commandtimeout = smtpconfig.getint('config', 'commandtimeout', default=commandtimeout)	# idle time between commands
+	datatimeout = smtpconfig.getint('config', 'datatimeout', default=datatimeout)		# idle time during the message data
+	maxqueuedmails = smtpconfig.getint('config', 'maxqueuedmails', default=maxqueuedmails)	# backpressure by spooled mails
+	maxqueuedbytes = smtpconfig.getint('config', 'maxqueuedbytes', default=maxqueuedbytes)	# backpressure by spool size
+	engine = smtpconfig.get('config', 'engine', default=engine)						# connection handling of the smtp server
+	if engine not in [ 'thread', 'asyncio' ]:
+		print('Wrong configuration: unknown engine "' + engine + '"')
+		return False
 
 
 	# Read accounts
+	try:
+		accountResolver = readAccounts(smtpconfig)
+	except ValueError as e:
+		print('Wrong configuration: ' + str(e))
+		return False
+
+	# make temporary directory
+	try:
+		if os.path.exists(msgdir) == False:
+			os.makedirs(msgdir)
+	except:
+		print('Can''t create message directory ' + msgdir)
+		return False
+
+	return True
+
+
+def readAccounts(smtpconfig):
+	""" Read the sender's mail accounts from the configuration. Returns the
+		AccountResolver for them, whose 'accounts' are the dictionary of the
+		accounts by their section names. Raises a ValueError if the
+		configuration of an account is wrong.
+	"""
+	table = {}
 	for s in smtpconfig.sections():
 		if s not in [ 'logging', 'config' ]:
 			account = MailAccount()
+			account.name = s
 
 			account.useconfig = smtpconfig.get(s, 'use', default=account.useconfig)
 			if account.useconfig != None:
-				mailaccounts[s] = account
+				table[s] = account
 				continue
 
 			account.rsmtphost = smtpconfig.get(s, 'smtphost', default=account.rsmtphost)
@@ -476,48 +1284,76 @@ def readConfig():
 			account.returnpath = smtpconfig.get(s, 'returnpath', default=account.returnpath)
 			account.replyto = smtpconfig.get(s, 'replyto', default=account.replyto)
 			account.forcefrom = smtpconfig.get(s, 'forcefrom', default=account.forcefrom)
+			account.workers = smtpconfig.getint(s, 'workers', default=account.workers)
+			account.maxsize = smtpconfig.getint(s, 'maxsize', default=account.maxsize)
 
 
 			# check config
 			if account.rsmtphost == None:
-				mlog.logerr('Wrong configuration: smtphost is missing')
-				return False
+				raise ValueError('smtphost is missing (' + s + ')')
 			if account.rPBS:
 				if account.rpophost == None:
-					mlog.logerr('Wrong configuration: pophost is missing')
-					return False
+					raise ValueError('pophost is missing (' + s + ')')
 				if account.rpopuser == None:
-					mlog.logerr('Wrong configuration: popuser is missing')
-					return False
+					raise ValueError('popuser is missing (' + s + ')')
 				if account.rpoppass == None:
-					mlog.logerr('Wrong configuration: poppass is missing')
-					return False
+					raise ValueError('poppass is missing (' + s + ')')
+				if account.rpopcheckdelay <= waitafterpop + popauth.PopAuthCache.refreshMargin:
+					# The login would be refreshed as soon as it is done
+					raise ValueError('popcheckdelay must be greater than waitafterpop + ' + str(popauth.PopAuthCache.refreshMargin) + ' (' + s + ')')
 			if account.rsmtpport == 0:	# Different default port depending on security type
 				if account.rsmtpsecurity == 'none' or account.rsmtpsecurity == 'tls':
 					account.rsmtpport = 25
 				else:	# ssl
 					account.rsmtpport = 465
-			mailaccounts[s] = account
+			table[s] = account
+	return accounts.AccountResolver(table)
 
-	# make temporary directory
-	try:
-		if os.path.exists(msgdir) == False:
-			os.makedirs(msgdir)
-	except:
-		print('Can''t create message directory ' + msgdir)
-		return False
 
-	return True
+def reloadConfig():
+	""" Read the mail accounts from the configuration file again and replace
+		the current ones. Sessions and deliveries that already started go on
+		with the previous account data. Pooled connections and POP-before-SMTP
+		logins of changed or removed accounts are dropped; busy connections
+		are closed when their delivery is finished. All other settings need a
+		restart. Returns a message for the requester.
+	"""
+	global accountResolver
+
+	with reloadLock:
+		try:
+			newconfig = config.Config()
+			if len(newconfig.read([configFile])) == 0:
+				raise ValueError("Can't read " + configFile)
+			resolver = readAccounts(newconfig)
+		except:
+			mlog.logerr('Configuration not reloaded: ' + str(sys.exc_info()[1]))
+			return 'Configuration not reloaded: ' + str(sys.exc_info()[1]) + '\n'
+		(current, table) = (accountResolver.accounts, resolver.accounts)
+		changed = [ n for n in current if n not in table or vars(current[n]) != vars(table[n]) ]
+		added = [ n for n in table if n not in current ]
+		# The accounts and their rules are replaced at once
+		accountResolver = resolver
+		for n in changed:
+			if smtpPool != None:
+				smtpPool.drain(n)
+			if popAuth != None:
+				popAuth.forget(n)
+	message = 'Reloaded ' + str(len(table)) + ' accounts (' + str(len(changed)) + ' changed or removed, ' + str(len(added)) + ' added)'
+	mlog.log(message)
+	return message + '\n'
 
 
 def initLogging():
 	"""Init the logging system.
 	"""
-	global smtpconfig, logFile, logSize, logCount, logLevel
+	global smtpconfig, logFile, logSize, logCount, logLevel, logConsole, logAsync
 
 	logFile = smtpconfig.get('logging', 'file', default=logFile)
 	logSize = smtpconfig.getint('logging', 'size', default=logSize)
 	logCount = smtpconfig.getint('logging', 'count', default=logCount)
+	logConsole = smtpconfig.getboolean('logging', 'console', default=logConsole)
+	logAsync = smtpconfig.getboolean('logging', 'async', default=logAsync)
 	str = smtpconfig.get('logging', 'level', default='INFO')
 	if str == 'NONE':
 		logLevel = logging.CRITICAL
@@ -536,18 +1372,164 @@ def loadMailHandlers():
 	""" Import all mail handler from the specified directory, instanciate them, assign the logger,
 		and put them into the list of mail handlers.
 	"""
+	global mailHandlers, handlerPool, handlerQueue
+
+	loaded = {}
 	sys.path.append(mailHandlerDir)
-	for py in [f[:-3] for f in os.listdir(mailHandlerDir) if f.endswith('.py') and f != '__init__.py']:
+	for py in sorted([f[:-3] for f in os.listdir(mailHandlerDir) if f.endswith('.py') and f != '__init__.py']):
 		mod = __import__(py)
 		classlist = [o for o in getmembers(mod, isclass)]
 		for c in classlist:
 			h = c[1]()
 			if h.isEnabled():
 				h.setLogger(mlog)
-				mailHandlers[c[0]] = h
-				mlog.log('Loaded mail handler "' + c[0] + '"')
+				loaded[c[0]] = h
 	sys.path.remove(mailHandlerDir)
 
+	# Order the handlers as configured, or by name
+	if handlerOrder == None:
+		names = sorted(loaded.keys())
+	else:
+		names = handlerOrder
+		for n in sorted(set(loaded.keys()) - set(names)):
+			mlog.log('Mail handler "' + n + '" is not configured and not used')
+	mailHandlers = collections.OrderedDict()
+	for n in names:
+		if n not in loaded:
+			mlog.logerr('Configured mail handler "' + n + '" is not available or not enabled')
+			continue
+		mailHandlers[n] = loaded[n]
+		mlog.log('Loaded mail handler "' + n + '"')
+
+	# Start the worker processes for the handlers that run in a process
+	processHandlers = dict([ (n, h.__class__.__module__) for (n, h) in mailHandlers.items() if getattr(h, 'process', False) ])
+	if len(processHandlers) > 0 and handlerprocesses > 0:
+		handlerPool = handlerpool.HandlerPool(processHandlers, mailHandlerDir, handlerprocesses, mlog)
+		handlerPool.start()
+		mlog.log('Started ' + str(handlerprocesses) + ' mail handler processes')
+
+	# Start the queue for the handlers that run after a mail was accepted
+	if len([ h for h in mailHandlers.values() if getattr(h, 'phase', MailHandler.MailHandler.SYNC) == MailHandler.MailHandler.ASYNC ]) > 0:
+		handlerQueue = handlerqueue.HandlerQueue(msgdir + '/' + handlerQueueName, runAcceptedHandlers, mlog, handlerworkers, handlerqueuesize, handlerattempts, handlerretrydelay)
+		if handlerQueue.recover() > 0:
+			mlog.log('Recovered queued mails for the mail handlers')
+
+
+def openSpool():
+	""" Recover the message directory after a restart and open the queue
+		index.
+	"""
+	global queueIndex
+
+	if len(spool.recoverLeases(msgdir, maxAge=leasetimeout)) > 0:
+		mlog.log('Recovered stale mail claims in ' + msgdir)
+	spool.removeOrphans(msgdir)
+	migrateLegacyMails()
+	queueIndex = queueindex.QueueIndex(msgdir)
+	queueIndex.rebuild(mlog)
+
+
+def startDelivery():
+	""" Start the threads that deliver the scheduled mails.
+	"""
+	global smtpPool, popAuth, deliveryQueue
+
+	smtpPool = smtppool.SMTPConnectionPool(openSMTPConnection, mlog, smtppoolsize, smtpidletimeout, smtpmaxmessages)
+	popAuth = popauth.PopAuthCache(mlog, waitafterpop, spoolEvent.set)
+	deliveryQueue = delivery.DeliveryQueue()
+	delivery.DeliveryWorkers(deliveryQueue, deliverMails, deliveryworkers, mlog, batchsize)
+	start_new_thread(handleScheduledMails, ())
+
+
+def startServices(portOffset = 0):
+	""" Start tracing, the profiler and the metrics server. In supervisor
+		mode each process serves its metrics on the port 'metricsport' +
+		'portOffset'.
+	"""
+	global tracer, profiler
+
+	tracer = tracing.Tracer(tracefile, tracesample)
+	profiler = tracing.Profiler(profiledir, mlog)
+	if hasattr(signal, 'SIGUSR1'):
+		signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.start(profileseconds))
+	if hasattr(signal, 'SIGHUP'):
+		# The reload may block on the network, so it isn't done in the handler
+		signal.signal(signal.SIGHUP, lambda signum, frame: start_new_thread(reloadConfig, ()))
+	if metricsport > 0:
+		metrics.startServer(metricsport + portOffset, metricsaddress, mlog, { '/profile' : lambda query: startProfiler(query.get('seconds', profileseconds)),
+																			  '/reload' : lambda query: reloadConfig() })
+		mlog.log('Serving metrics on ' + metricsaddress + ':' + str(metricsport + portOffset))
+
+
+def serveSMTP(reusePort = False):
+	""" Run the SMTP server. This function doesn't return.
+	"""
+	global spoolCommitter
+
+	if spoolsync:
+		spoolCommitter = spool.Committer()
+	options = smtps.SMTPServerOptions()
+	options.spoolThreshold = spoolthreshold
+	options.maxMessageSize = maxmessagesize
+	options.reusePort = reusePort
+	options.backlog = backlog
+	options.maxSessions = maxsessions
+	options.maxSessionsPerIP = maxsessionsperip
+	options.commandTimeout = commandtimeout
+	options.dataTimeout = datatimeout
+	if engine == 'asyncio':
+		import smtpsasync
+		s = smtpsasync.AsyncSMTPServer(port, mlog, options)
+	else:
+		s = smtps.SMTPServer(port, mlog, options)
+	s.serve(SMTPProxyService)
+
+
+def runReceiver(number):
+	""" The main function of a receiver process in supervisor mode. All
+		receivers share the SMTP port, and every receiver has its own queue
+		for the mail handlers that run after a mail was accepted.
+	"""
+	global queueIndex, handlerQueueName
+
+	mlog.afterFork()
+	handlerQueueName = 'handlerqueue-' + str(number)
+	if loadMailHandlers() == False:
+		sys.exit(1)
+	queueIndex = queueindex.QueueIndex(msgdir)
+	startServices(1 + number)
+	serveSMTP(True)
+
+
+def runDelivery(number):
+	""" The main function of a delivery process in supervisor mode. The
+		delivery processes share the queue index; a mail that is due is
+		taken from it by one of them and claimed with a lease before it is
+		sent.
+	"""
+	global queueIndex
+
+	mlog.afterFork()
+	queueIndex = queueindex.QueueIndex(msgdir)
+	startServices(1 + receiverprocesses + number)
+	startDelivery()
+	while True:
+		time.sleep(3600)
+
+
+def workerExited(name, number, pid):
+	""" Called by the supervisor when a process exited. The mails that the
+		process was delivering are released and made due again.
+	"""
+	names = spool.recoverLeases(msgdir, pid)
+	if len(names) > 0:
+		mlog.log('Recovered ' + str(len(names)) + ' mail claims of process ' + str(pid))
+		index = queueindex.QueueIndex(msgdir)
+		try:
+			index.due(names)
+		finally:
+			index.close()
+
 
 if __name__ == '__main__':
 
@@ -555,15 +1537,36 @@ if __name__ == '__main__':
 		sys.exit(1)
 	if initLogging() == False:
 		sys.exit(1)
-	mlog = mlogging.Logging(logFile, logSize, logCount, logLevel)
+	mlog = mlogging.Logging(logFile, logSize, logCount, logLevel, logConsole, logAsync)
+
+	if receiverprocesses > 0:
+		# Supervisor mode. The message directory is prepared before the
+		# processes are started, and the supervisor itself doesn't keep any
+		# open files or threads that the processes would inherit.
+		mlog.log('Starting SMTP Proxy on port ' + str(port) + ' with ' + str(receiverprocesses) + ' receiver and ' + str(deliveryprocesses) + ' delivery processes')
+		try:
+			openSpool()
+			queueIndex.close()
+			queueIndex = None
+		except:
+			mlog.logerr('Caught unknown exception: ' +  str(sys.exc_info()[0]) +": " + str(sys.exc_info()[1]))
+			sys.exit(1)
+		signals = [ getattr(signal, n) for n in ('SIGUSR1', 'SIGHUP') if hasattr(signal, n) ]
+		s = supervisor.Supervisor(mlog, workerExited, signals)
+		s.add('receiver', runReceiver, receiverprocesses)
+		s.add('delivery', runDelivery, deliveryprocesses)
+		s.run()
+		sys.exit(0)
+
 	if loadMailHandlers() == False:
 		sys.exit(1)
 
 	mlog.log('Starting SMTP Proxy on port ' + str(port))
 	try:
-		start_new_thread(handleScheduledMails, ())
-		s = smtps.SMTPServer(port, mlog)
-		s.serve(SMTPProxyService)
+		openSpool()
+		startDelivery()
+		startServices()
+		serveSMTP()
 	except:
 		mlog.logerr('Caught unknown exception: ' +  str(sys.exc_info()[0]) +": " + str(sys.exc_info()[1]))
 		pass
@@ -34,7 +34,7 @@ A couple of helper functions are defined that manipulate from & to
 addresses.
 """
 
-import sys, socket
+import sys, socket, tempfile, threading
 
 if sys.version_info[0] > 2:
     from _thread import *
@@ -73,12 +73,53 @@ class SMTPServerInterface:
 	def data(self, args):
 		return None
 
+	def dataFile(self, fp):
+		"""
+		Called with a binary file object that holds the complete,
+		dot-unstuffed message, positioned at the start. The default
+		implementation reads the message into a string and calls
+		'data'. Applications that handle large messages should
+		override this method and read from 'fp' instead.
+		"""
+		msg = fp.read().decode('utf-8', 'replace')
+		if msg.endswith('\r\n'):
+			msg = msg[:-2]
+		return self.data(msg)
+
 	def quit(self, args):
 		return None
 
 	def reset(self, args):
 		return None
 
+	def dataStart(self):
+		"""
+		Called when the client starts to send the message data.
+		"""
+		return None
+
+	def connected(self, address):
+		"""
+		Called for a new connection from the client IP 'address',
+		before the greeting is sent. A returned response (e.g. a 421
+		reply) rejects the connection.
+		"""
+		return None
+
+	def closed(self):
+		"""
+		Called when the connection is closed.
+		"""
+		return None
+
+	def maxMessageSize(self):
+		"""
+		Return the maximum size (in bytes) of the message data of the
+		current mail, or None if only the server's limit applies. It
+		is called when the client starts to send the message data.
+		"""
+		return None
+
 #
 # Some helper functions for manipulating from & to addresses etc.
 #
@@ -94,6 +135,18 @@ def stripAddress(address):
 	end = address.find('>')
 	return address[start:end]
 
+def mailParameters(args):
+	"""
+	Return the ESMTP parameters after the address of a MAIL or RCPT
+	command as a dictionary with upper case keys. Parameters without
+	a value are mapped to None.
+	"""
+	params = {}
+	for p in args[args.find('>') + 1:].split():
+		(key, sep, value) = p.partition('=')
+		params[key.upper()] = value if sep else None
+	return params
+
 def splitTo(address):
 	"""
 	Return 'address' as undressed (host, fulladdress) tuple.
@@ -108,6 +161,176 @@ def splitTo(address):
 	return (address[sep:end], address[start:end],)
 
 
+#
+# Tunable parameters of the server engines.
+#
+class SMTPServerOptions:
+	"""
+	A container for the parameters of the server engines. An instance
+	can be passed to the SMTPServer, which hands it to each engine.
+
+	* spoolThreshold - Message data up to this size (in bytes) is held
+	  in memory. Larger messages are spilled to a temporary file.
+	* spoolDir - The directory for spilled message data. The default is
+	  the system's temporary directory.
+	* recvSize - The size of the buffer for a single socket read.
+	* maxLineLength - The maximum length of a command line.
+	* reusePort - Set SO_REUSEPORT on the listening socket, so that several
+	  processes can listen on the same port.
+	* backlog - The size of the queue of connections that wait to be accepted.
+	* maxSessions - The maximum number of concurrent connections. 0 means no limit.
+	* maxSessionsPerIP - The maximum number of concurrent connections from one
+	  client IP address. 0 means no limit.
+	* commandTimeout - The time to wait for the next command from a client,
+	  in seconds. 0 means no timeout.
+	* dataTimeout - The time to wait for the next message data from a client,
+	  in seconds. 0 means no timeout.
+	* maxMessageSize - The maximum size of the message data in bytes, which
+	  is announced with the SIZE extension. 0 means no limit.
+	"""
+
+	def __init__(self):
+		self.spoolThreshold	= 1024 * 1024
+		self.spoolDir		= None
+		self.recvSize		= 65536
+		self.maxLineLength	= 4096
+		self.reusePort		= False
+		self.backlog		= 128
+		self.maxSessions	= 0
+		self.maxSessionsPerIP	= 0
+		self.commandTimeout	= 300
+		self.dataTimeout	= 180
+		self.maxMessageSize	= 0
+
+
+class SessionLimiter:
+	"""
+	Counts the open connections, in total and per client IP address,
+	and rejects new connections above the limits of the options.
+	"""
+
+	def __init__(self, options):
+		self.options = options if options else SMTPServerOptions()
+		self.sessions = 0
+		self._perIP = {}
+		self._lock = threading.Lock()
+
+	def acquire(self, address):
+		"""
+		Count a new connection from 'address'. Returns None if it is
+		admitted, or the response that rejects it.
+		"""
+		with self._lock:
+			if self.options.maxSessions > 0 and self.sessions >= self.options.maxSessions:
+				return '421 Too many connections, try again later'
+			count = self._perIP.get(address, 0)
+			if self.options.maxSessionsPerIP > 0 and count >= self.options.maxSessionsPerIP:
+				return '421 Too many connections from your address, try again later'
+			self.sessions += 1
+			self._perIP[address] = count + 1
+			return None
+
+	def release(self, address):
+		"""Count a closed connection from 'address'."""
+		with self._lock:
+			self.sessions -= 1
+			count = self._perIP.get(address, 0) - 1
+			if count > 0:
+				self._perIP[address] = count
+			else:
+				self._perIP.pop(address, None)
+
+
+#
+# Receives the DATA part of a message.
+#
+class DataReceiver:
+	"""
+	Receives the client DATA of one message. Chunks of arbitrary size
+	are fed in as bytes. Dot-stuffing is removed and the terminating
+	<CRLF>.<CRLF> is detected, also when it is split across chunks.
+
+	The message is written to a SpooledTemporaryFile. It is kept in
+	memory up to 'spoolThreshold' bytes and then spilled to disk, so
+	the memory used per message is bounded and every received byte is
+	copied only once.
+
+	When the message gets larger than 'limit' bytes then the data that
+	follows is only counted and not stored anymore, and 'exceeded' is
+	set.
+	"""
+
+	def __init__(self, options, limit = 0):
+		self.fp = tempfile.SpooledTemporaryFile(max_size=options.spoolThreshold, dir=options.spoolDir)
+		self.size = 0
+		self.limit = limit
+		self.exceeded = False
+		self.remainder = b''	# bytes received after the terminator
+		self._carry = b''
+		self._bol = True		# at the beginning of a line
+
+	def feed(self, data):
+		"""
+		Feed a chunk of data. Returns True when the terminator has
+		been received, False otherwise. Any bytes following the
+		terminator are stored in 'remainder'.
+		"""
+		if self._carry:
+			data = self._carry + data
+			self._carry = b''
+		with memoryview(data) as view:
+			pos = 0
+			end = len(data)
+			while pos < end:
+				if self._bol:
+					# Only a line starting with a dot needs special handling
+					if data[pos:pos+1] != b'.':
+						self._bol = False
+						continue
+					if data[pos:pos+3] == b'.\r\n':
+						self.remainder = data[pos+3:]
+						self.fp.seek(0)
+						return True
+					if end - pos < 3 and b'.\r\n'.startswith(data[pos:]):
+						# Can't decide yet, wait for more data
+						self._carry = data[pos:]
+						return False
+					pos += 1		# remove the stuffed dot
+					self._bol = False
+				else:
+					idx = data.find(b'\r\n.', pos)
+					if idx < 0:
+						# Keep a trailing partial line end for the next chunk
+						stop = end
+						if data.endswith(b'\r\n'):
+							stop = end - 2
+						elif data.endswith(b'\r'):
+							stop = end - 1
+						stop = max(stop, pos)
+						self._write(view[pos:stop])
+						self._carry = data[stop:]
+						return False
+					self._write(view[pos:idx+2])
+					pos = idx + 2
+					self._bol = True
+			return False
+
+	def close(self):
+		self.fp.close()
+
+	def _write(self, data):
+		self.size += len(data)
+		if self.exceeded:
+			return
+		if self.limit > 0 and self.size > self.limit:
+			# Drop what was stored so far, the message is refused anyway
+			self.exceeded = True
+			self.fp.seek(0)
+			self.fp.truncate()
+			return
+		self.fp.write(data)
+
+
 #
 # A specialization of SMTPServerInterface for debug, that just prints its args.
 #
@@ -156,11 +379,23 @@ class SMTPServerEngine:
 	ST_AUTH = 10
 	ST_PASS = 11
 
-	def __init__(self, socket, impl, log):
+	# Results of 'process'
+	PROC_READ = 0		# all complete input is processed, more is needed
+	PROC_MESSAGE = 1	# a message is complete, 'finishData' must be called
+	PROC_CLOSE = 2		# the connection must be closed
+
+	timeoutResponse = '421 Timeout, closing connection'
+	sizeResponse = '552 5.3.4 Message size exceeds fixed maximum message size'
+
+	def __init__(self, socket, impl, log, options = None):
 		self.impl = impl;
 		self.socket = socket;
 		self.state = SMTPServerEngine.ST_INIT
 		self.log = log
+		self.options = options if options else SMTPServerOptions()
+		self.receiver = None
+		self.inbuf = bytearray()
+		self.responses = []
 
 	def chug(self):
 		"""
@@ -170,34 +405,121 @@ class SMTPServerEngine:
 		construction time.
 		"""
 
-		self.socket.send('220 Python smtps\r\n'.encode())
-		while 1:
-			data = ''
-			completeLine = 0
-			# Make sure an entire line is received before handing off
-			# to the state engine. Thanks to John Hall for pointing
-			# this out.
-			while not completeLine:
-				lump = self.socket.recv(1024).decode()
-				if len(lump):
-					data += lump
-					if (len(data) >= 2) and data[-2:] == '\r\n':
-						completeLine = 1
-						if self.state != SMTPServerEngine.ST_DATA:
-							rsp, keep = self.doCommand(data)
-						else:
-							rsp = self.doData(data)
-							if rsp == None:
-								continue
-						rsp_b = rsp + '\r\n'
-						self.socket.send(rsp_b.encode())
-						if keep == 0:
-							self.socket.close()
-							return
-				else:
+		try:
+			(rsp, keep) = self.greeting(self.socket.getpeername()[0])
+			self.socket.sendall((rsp + '\r\n').encode())
+			if not keep:
+				self.socket.close()
+				return
+			while 1:
+				status = self.process()
+				if status == SMTPServerEngine.PROC_MESSAGE:
+					self.responses.append(self.finishData())
+					continue
+				# All responses to pipelined commands are sent at once
+				out = self.takeResponses()
+				if out:
+					self.socket.sendall(out)
+				if status == SMTPServerEngine.PROC_CLOSE:
+					self.socket.close()
+					return
+				self.socket.settimeout(self.readTimeout())
+				try:
+					lump = self.socket.recv(self.options.recvSize)
+				except socket.timeout:
+					# A stalled client doesn't keep the connection forever
+					self.resetData()
+					self.socket.sendall((SMTPServerEngine.timeoutResponse + '\r\n').encode())
+					self.socket.close()
+					return
+				if not len(lump):
 					# EOF
+					self.resetData()
 					return
-		return
+				self.inbuf += lump
+		except socket.error:
+			self.resetData()
+			self.socket.close()
+
+	def greeting(self, address):
+		"""
+		Return the greeting for a new connection from the client IP
+		'address', and whether the connection is kept.
+		"""
+		rv = self.impl.connected(address)
+		if rv:
+			return (rv, 0)
+		return ('220 Python smtps', 1)
+
+	def readTimeout(self):
+		"""
+		Return the time to wait for more input from the client in the
+		current state, or None for no timeout.
+		"""
+		if self.state == SMTPServerEngine.ST_DATA:
+			timeout = self.options.dataTimeout
+		else:
+			timeout = self.options.commandTimeout
+		return timeout if timeout > 0 else None
+
+	def process(self):
+		"""
+		Process all complete command lines and DATA in the input
+		buffer. The responses are collected and can be retrieved with
+		'takeResponses'. Returns one of PROC_READ, PROC_MESSAGE and
+		PROC_CLOSE.
+		"""
+		inbuf = self.inbuf
+		while inbuf:
+			if self.state == SMTPServerEngine.ST_DATA:
+				done = self.feedData(inbuf)
+				del inbuf[:]
+				if done:
+					inbuf += self.receiver.remainder
+					return SMTPServerEngine.PROC_MESSAGE
+				return SMTPServerEngine.PROC_READ
+			idx = inbuf.find(b'\n')
+			if idx < 0:
+				if len(inbuf) > self.options.maxLineLength:
+					del inbuf[:]
+					self.responses.append('500 Line too long')
+				return SMTPServerEngine.PROC_READ
+			line = bytes(inbuf[:idx+1])
+			del inbuf[:idx+1]
+			rsp, keep = self.doCommand(line.decode('utf-8', 'replace'))
+			self.responses.append(rsp)
+			if keep == 0:
+				del inbuf[:]
+				return SMTPServerEngine.PROC_CLOSE
+		return SMTPServerEngine.PROC_READ
+
+	def takeResponses(self):
+		"""Return all collected responses as bytes, and clear them."""
+		if not self.responses:
+			return b''
+		out = ''.join([ r + '\r\n' for r in self.responses ]).encode()
+		self.responses = []
+		return out
+
+	def ehloResponse(self):
+		"""Return the EHLO response, including the supported extensions."""
+		lines = [ 'Python smtps' ] + self.extensions()
+		return '\r\n'.join([ '250-' + l for l in lines[:-1] ] + [ '250 ' + lines[-1] ])
+
+	def extensions(self):
+		"""Return the list of ESMTP extensions announced in the EHLO response."""
+		if self.options.maxMessageSize > 0:
+			return [ 'PIPELINING', 'SIZE ' + str(self.options.maxMessageSize) ]
+		return [ 'PIPELINING', 'SIZE' ]
+
+	def messageSizeLimit(self):
+		"""
+		Return the maximum size of the message data of the current mail,
+		the smaller one of the server's and the application's limit.
+		0 means no limit.
+		"""
+		limits = [ l for l in [ self.options.maxMessageSize, self.impl.maxMessageSize() ] if l ]
+		return min(limits) if limits else 0
 
 	def doCommand(self, data):
 		"""Process a single SMTP Command"""
@@ -208,14 +530,16 @@ class SMTPServerEngine:
 		keep = 1
 		rv = None
 
-		self.log.logdebug('Received: ' + cmd + ' ' + data)
+		self.log.logdebug('Received: %s %s', cmd, data)
 
 		if cmd == "HELO" or cmd == "EHLO":
 			self.state = SMTPServerEngine.ST_HELO
 			rv = self.impl.helo(data)
+			if not rv and cmd == "EHLO":
+				rv = self.ehloResponse()
 		elif cmd == "RSET":
 			rv = self.impl.reset(data)
-			self.dataAccum = ""
+			self.resetData()
 			#self.state = SMTPServerEngine.ST_INIT
 			self.state = SMTPServerEngine.ST_HELO
 		elif cmd == "NOOP":
@@ -226,18 +550,29 @@ class SMTPServerEngine:
 		elif cmd == "MAIL":
 			if self.state != SMTPServerEngine.ST_HELO:
 				return ("503 Bad command sequence", 1)
-			self.state = SMTPServerEngine.ST_MAIL
+			size = mailParameters(data).get('SIZE')
+			if size != None:
+				# The client announced the size of the message
+				if not size.isdigit():
+					return ("501 Syntax error in parameters", 1)
+				if self.options.maxMessageSize > 0 and int(size) > self.options.maxMessageSize:
+					return (SMTPServerEngine.sizeResponse, 1)
 			rv = self.impl.mailFrom(data)
+			if not rv or rv[0] not in '45':
+				self.state = SMTPServerEngine.ST_MAIL
 		elif cmd == "RCPT":
 			if (self.state != SMTPServerEngine.ST_MAIL) and (self.state != SMTPServerEngine.ST_RCPT):
 				return ("503 Bad command sequence", 1)
-			self.state = SMTPServerEngine.ST_RCPT
 			rv = self.impl.rcptTo(data)
+			if not rv or rv[0] not in '45':
+				self.state = SMTPServerEngine.ST_RCPT
 		elif cmd == "DATA":
 			if self.state != SMTPServerEngine.ST_RCPT:
 				return ("503 Bad command sequence", 1)
 			self.state = SMTPServerEngine.ST_DATA
-			self.dataAccum = ""
+			self.resetData()
+			self.receiver = DataReceiver(self.options, self.messageSizeLimit())
+			self.impl.dataStart()
 			return ("354 OK, Enter data, terminated with a \\r\\n.\\r\\n", 1)
 
 	# TODO: Handle authentication in the sequence
@@ -266,22 +601,41 @@ class SMTPServerEngine:
 		else:
 			return("250 OK", keep)
 
-	def doData(self, data):
+	def feedData(self, data):
 		"""
-		Process SMTP Data. Accumulates client DATA until the
-		terminator is found.
+		Feed a chunk of client DATA (bytes). Returns True when the
+		terminator was received. Data following the terminator is
+		available in the receiver's 'remainder'.
 		"""
-		self.dataAccum = self.dataAccum + data
-		if len(self.dataAccum) > 4 and self.dataAccum[-5:] == '\r\n.\r\n':
-			self.dataAccum = self.dataAccum[:-5]
-			rv = self.impl.data(self.dataAccum)
+		return self.receiver.feed(data)
+
+	def finishData(self):
+		"""
+		Hand the received message to the application and return the
+		response for the client.
+		"""
+		if self.receiver.exceeded:
+			# The message is refused without handing it to the application
+			self.log.logdebug('Message of %d bytes exceeds the limit of %d bytes', self.receiver.size, self.receiver.limit)
+			self.resetData()
 			self.state = SMTPServerEngine.ST_HELO
-			if rv:
-				return rv
-			else:
-				return "250 OK - Data and terminator. found"
+			self.impl.reset('RSET')
+			return SMTPServerEngine.sizeResponse
+		try:
+			rv = self.impl.dataFile(self.receiver.fp)
+		finally:
+			self.resetData()
+		self.state = SMTPServerEngine.ST_HELO
+		if rv:
+			return rv
 		else:
-			return None
+			return "250 OK - Data and terminator. found"
+
+	def resetData(self):
+		"""Discard a partially or completely received message."""
+		if self.receiver:
+			self.receiver.close()
+			self.receiver = None
 
 class SMTPServer:
 	"""
@@ -291,11 +645,15 @@ class SMTPServer:
 	SMTPServerInterface.
 	"""
 
-	def __init__(self, port, log = None):
+	def __init__(self, port, log = None, options = None):
+		self._options = options if options else SMTPServerOptions()
+		self._limiter = SessionLimiter(self._options)
 		self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 		self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		if self._options.reusePort:
+			self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 		self._socket.bind(("", port))
-		self._socket.listen(5)
+		self._socket.listen(self._options.backlog)
 		self._log = log
 
 	def serve(self, Implclass = SMTPServerInterfaceDebug):
@@ -305,13 +663,33 @@ class SMTPServer:
 			connection."""
 		while 1:
 			nsd = self._socket.accept()
-			engine = SMTPServerEngine(nsd[0], Implclass(), self._log)
-			start_new_thread(self.handleConnection, (engine, ))
-
-	def handleConnection(self, engine):
+			address = nsd[1][0]
+			rv = self._limiter.acquire(address)
+			if rv:
+				# Rejected without starting a thread
+				try:
+					nsd[0].sendall((rv + '\r\n').encode())
+				except socket.error:
+					pass
+				nsd[0].close()
+				continue
+			try:
+				engine = SMTPServerEngine(nsd[0], Implclass(), self._log, self._options)
+				start_new_thread(self.handleConnection, (engine, address))
+			except:
+				self._limiter.release(address)
+				nsd[0].close()
+				raise
+
+	def handleConnection(self, engine, address = None):
 		""" Internal function that is called as a new thread to chug the
 			connection."""
-		engine.chug()
+		try:
+			engine.chug()
+		finally:
+			engine.impl.closed()
+			if address != None:
+				self._limiter.release(address)
 
 
 
@@ -0,0 +1,163 @@
+#
+# smtpsasync.py
+#
+# Author: Andreas Kraft (akr@mheg.org)
+#
+# DISCLAIMER
+# You are free to use this code in any way you like, subject to the
+# Python disclaimers & copyrights. I make no representations about the
+# suitability of this software for any purpose. It is provided "AS-IS"
+# without warranty of any kind, either express or implied. So there.
+#
+"""smtpsasync.py - An asyncio based connection manager for smtps.py.
+
+This module provides the same service as smtps.SMTPServer, but all client
+connections are multiplexed on a single asyncio event loop instead of
+starting a new thread for every accepted socket. Idle and slow clients
+therefore only cost a socket and a small buffer, which allows a single
+process to serve many thousand concurrent connections.
+
+The RFC821 state machine itself is not duplicated: every connection drives
+an ordinary smtps.SMTPServerEngine, so the SMTPServerInterface callbacks
+('helo', 'mailFrom', 'rcptTo', 'data', 'quit', 'reset') are called exactly
+as with the threaded server. Existing SMTPServerInterface sub-classes can
+be used unchanged. The callback for a completely received message ('data'
+or 'dataFile') may block (e.g. for file system access), so it is executed
+in the loop's default thread pool executor.
+
+This module requires Python 3.7 or newer.
+"""
+
+import asyncio, sys
+import smtps
+
+
+class AsyncSMTPServerEngine:
+	"""	Drives a smtps.SMTPServerEngine for a single client connection from
+		an asyncio stream pair.
+	"""
+
+	def __init__(self, reader, writer, impl, log, options = None):
+		self.reader = reader
+		self.writer = writer
+		self.engine = smtps.SMTPServerEngine(None, impl, log, options)
+		self.log = log
+
+
+	async def chug(self):
+		"""	Chug the engine, till QUIT is received from the client or the
+			connection is closed.
+		"""
+		loop = asyncio.get_running_loop()
+		engine = self.engine
+		try:
+			peer = self.writer.get_extra_info('peername')
+			(rsp, keep) = engine.greeting(peer[0] if peer else '')
+			self.writer.write((rsp + '\r\n').encode())
+			await self.writer.drain()
+			if not keep:
+				return
+			while 1:
+				status = engine.process()
+				if status == smtps.SMTPServerEngine.PROC_MESSAGE:
+					# The complete message is handed to the application,
+					# which may block.
+					engine.responses.append(await loop.run_in_executor(None, engine.finishData))
+					continue
+				# All responses to pipelined commands are sent at once
+				out = engine.takeResponses()
+				if out:
+					self.writer.write(out)
+					await self.writer.drain()
+				if status == smtps.SMTPServerEngine.PROC_CLOSE:
+					break
+				try:
+					lump = await asyncio.wait_for(self.reader.read(engine.options.recvSize), engine.readTimeout())
+				except asyncio.TimeoutError:
+					# A stalled client doesn't keep the connection forever
+					self.writer.write((smtps.SMTPServerEngine.timeoutResponse + '\r\n').encode())
+					await self.writer.drain()
+					break
+				if not lump:
+					# EOF
+					break
+				engine.inbuf += lump
+		except (ConnectionError, asyncio.IncompleteReadError):
+			pass
+		except:
+			if self.log:
+				self.log.logerr('Connection caught exception: ' +  str(sys.exc_info()[0]) +": " + str(sys.exc_info()[1]))
+		finally:
+			engine.resetData()
+			self.writer.close()
+			engine.impl.closed()
+
+
+
+class AsyncSMTPServer:
+	"""	An asyncio SMTP Server connection manager. Listens for incoming SMTP
+		connections on a given port. For each connection, an
+		AsyncSMTPServerEngine is chugged as a task on the event loop, passing
+		a new instance of SMTPServerInterface.
+	"""
+
+	def __init__(self, port, log = None, options = None):
+		self._port = port
+		self._log = log
+		self._options = options if options else smtps.SMTPServerOptions()
+		self._limiter = smtps.SessionLimiter(self._options)
+		self._raiseFileLimit()
+
+
+	def serve(self, Implclass = smtps.SMTPServerInterfaceDebug):
+		"""	Listen for connections and run a new AsyncSMTPServerEngine for
+			each of them. Implclass is the implementation class of
+			SMTPServerInterface that is instantiated for each new connection.
+			This method blocks forever.
+		"""
+		asyncio.run(self._serve(Implclass))
+
+
+	async def _serve(self, Implclass):
+		async def handleConnection(reader, writer):
+			peer = writer.get_extra_info('peername')
+			address = peer[0] if peer else ''
+			rv = self._limiter.acquire(address)
+			if rv:
+				writer.write((rv + '\r\n').encode())
+				try:
+					await writer.drain()
+				except ConnectionError:
+					pass
+				writer.close()
+				return
+			try:
+				await AsyncSMTPServerEngine(reader, writer, Implclass(), self._log, self._options).chug()
+			finally:
+				self._limiter.release(address)
+
+		server = await asyncio.start_server(handleConnection, host='', port=self._port, reuse_address=True, reuse_port=self._options.reusePort, backlog=self._options.backlog)
+		async with server:
+			await server.serve_forever()
+
+
+	def _raiseFileLimit(self):
+		"""	Every connection needs a file descriptor. Raise the soft limit of
+			open files to the hard limit, if possible.
+		"""
+		try:
+			import resource
+			soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+			if soft < hard:
+				resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+		except:
+			if self._log:
+				self._log.logwarn('Cannot raise the open files limit: ' + str(sys.exc_info()[1]))
+
+
+
+if __name__ == '__main__':
+	port = 25
+	if len(sys.argv) == 2:
+		port = int(sys.argv[1])
+	AsyncSMTPServer(port).serve()
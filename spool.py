@@ -0,0 +1,456 @@
+#
+# spool.py
+#
+# Author: Andreas Kraft (akr@mheg.org)
+#
+# DISCLAIMER
+# You are free to use this code in any way you like, subject to the
+# Python disclaimers & copyrights. I make no representations about the
+# suitability of this software for any purpose. It is provided "AS-IS"
+# without warranty of any kind, either express or implied. So there.
+#
+"""	Helper functions for the message spool directory.
+
+	Every scheduled mail is stored as two files with the same name: the
+	message itself, exactly as it is sent to the remote SMTP server, in a
+	'.eml' file, and a small envelope file '.env' with the sender, the
+	recipients and the delivery state. The envelope is written last (and
+	atomically), so a mail is complete as soon as its envelope file exists.
+	With a Committer both files are flushed to disk before the envelope gets
+	its final name, so a stored mail also survives a crash of the system.
+
+	A scheduled mail is claimed by a delivery worker before it is sent. The
+	claim is a lease file next to the mail file. It is written under a
+	temporary name first and then linked to its final name, which fails if
+	the lease already exists, so only one worker (in this or in any other
+	process that shares the directory) can hold it, and a lease is never
+	seen without its content. The lease file contains the process id of its
+	owner, which allows to recover leases of crashed processes. Its
+	modification time is the time it was taken or last renewed. A lease that
+	is older than a limit is broken as well, because its process id may have
+	been reused by another process after a restart, or the lease may have
+	been left behind by an error of a process that is still running.
+"""
+
+import ctypes, ctypes.util, errno, json, os, shutil, sys, tempfile, threading, time
+
+messageSuffix	= '.eml'
+envelopeSuffix	= '.env'
+leaseSuffix		= '.lease'
+tmpSuffix		= '.tmp'
+
+
+class Envelope:
+	""" The envelope of a scheduled mail. It holds the following fields:
+
+		* frm - The sender's address.
+		* to - The list of recipient addresses.
+		* account - The name of the mail account that was selected for the sender.
+		* attempts - The number of failed delivery attempts.
+		* nextAttempt - The time of the next delivery attempt (seconds since the epoch).
+		* lastError - The error of the last failed delivery attempt, or None.
+		* created - The time the mail was received.
+		* trace - The state of the trace of a sampled mail until its first delivery attempt, or None (see tracing.py).
+	"""
+
+	version = 1
+	fields = [ 'frm', 'to', 'account', 'attempts', 'nextAttempt', 'lastError', 'created', 'trace' ]
+
+	def __init__(self, frm = '', to = None, account = None):
+		""" Initialize instance variables."""
+		self.frm			= frm
+		self.to				= to if to != None else []
+		self.account		= account
+		self.attempts		= 0
+		self.nextAttempt	= 0
+		self.lastError		= None
+		self.created		= time.time()
+		self.trace			= None
+
+
+	def toBytes(self):
+		d = dict([ (f, getattr(self, f)) for f in self.fields ])
+		d['version'] = self.version
+		return json.dumps(d, sort_keys=True).encode()
+
+
+	@classmethod
+	def fromBytes(cls, data):
+		d = json.loads(data.decode())
+		envelope = cls()
+		for f in cls.fields:
+			if f in d:
+				setattr(envelope, f, d[f])
+		return envelope
+
+
+
+def store(directory, message, envelope, committer = None):
+	""" Store a new mail in 'directory'. 'message' is either bytes, a binary
+		file object, whose content is copied from the current position, or a
+		list of those parts. The envelope is written after the message.
+		With a 'committer' the function returns only after the mail was
+		flushed to disk. Returns the name of the envelope file.
+	"""
+	(fd, mfn) = tempfile.mkstemp(suffix=messageSuffix, dir=directory)
+	fn = mfn[:-len(messageSuffix)] + envelopeSuffix
+	tmp = fn + tmpSuffix
+	try:
+		with os.fdopen(fd, 'wb') as f:
+			for part in (message if isinstance(message, list) else [ message ]):
+				if isinstance(part, (bytes, bytearray)):
+					f.write(part)
+				else:
+					shutil.copyfileobj(part, f, 65536)
+		if committer != None:
+			with open(tmp, 'wb') as f:
+				f.write(envelope.toBytes())
+			committer.commit(directory, [ mfn, tmp ], tmp, fn)
+		else:
+			writeEnvelope(fn, envelope)
+	except:
+		for n in (mfn, tmp):
+			try:
+				os.remove(n)
+			except OSError:
+				pass
+		# The envelope may have got its name before the commit failed
+		if os.path.exists(fn) and claim(fn):
+			remove(fn)
+		raise
+	return fn
+
+
+def writeEnvelope(fn, envelope):
+	""" Atomically (re)write the envelope file 'fn'.
+	"""
+	tmp = fn + tmpSuffix
+	with open(tmp, 'wb') as f:
+		f.write(envelope.toBytes())
+	os.rename(tmp, fn)
+
+
+def readEnvelope(fn):
+	""" Read and return the Envelope from the envelope file 'fn'.
+	"""
+	with open(fn, 'rb') as f:
+		return Envelope.fromBytes(f.read())
+
+
+def messageFile(fn):
+	""" Return the name of the message file that belongs to the envelope file
+		'fn'.
+	"""
+	return fn[:-len(envelopeSuffix)] + messageSuffix
+
+
+def removeOrphans(directory, age = 3600):
+	""" Remove message and temporary files that have no envelope file and are
+		older than 'age' seconds. They are left over when a process crashed
+		while storing a mail. Returns the number of removed files.
+	"""
+	count = 0
+	now = time.time()
+	for e in os.listdir(directory):
+		fn = os.path.join(directory, e)
+		if e.endswith(messageSuffix):
+			if os.path.exists(fn[:-len(messageSuffix)] + envelopeSuffix):
+				continue
+		elif not e.endswith(tmpSuffix):
+			continue
+		try:
+			if now - os.path.getmtime(fn) > age:
+				os.remove(fn)
+				count += 1
+		except OSError:
+			pass
+	return count
+
+
+class CommitError(Exception):
+	""" Raised when a mail couldn't be flushed to disk.
+	"""
+	pass
+
+
+
+class _Commit:
+	""" A store that waits for the committer.
+	"""
+
+	def __init__(self, directory, files, tmp, fn):
+		self.directory	= directory
+		self.files		= files		# files to flush
+		self.tmp		= tmp		# the envelope is renamed from ...
+		self.fn			= fn		# ... to this name after the flush
+		self.done		= False
+		self.error		= None
+
+
+
+class Committer:
+	""" Makes stored mails durable before they are acknowledged. The stores
+		that wait at the same time are committed together by a separate
+		thread ("group commit"), so that the disk is not flushed once per
+		mail: the files of all waiting stores are flushed, with one syncfs()
+		of the file system for a larger batch (Linux) or one fsync() per file
+		otherwise, then the envelopes are renamed to their final names, and
+		finally the directory is flushed once for all of them.
+	"""
+
+	# A batch with at least this many files is flushed with syncfs()
+	syncfsFiles = 8
+
+	def __init__(self):
+		self._cond = threading.Condition()
+		self._pending = []
+		self.batches = 0		# number of commits
+		self.mails = 0			# number of committed mails
+		self._syncfs = None
+		try:
+			libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+			self._syncfs = libc.syncfs
+		except (OSError, AttributeError):
+			pass
+		t = threading.Thread(target=self._run, name='spoolcommit')
+		t.daemon = True
+		t.start()
+
+
+	def commit(self, directory, files, tmp, fn):
+		""" Flush 'files' in 'directory' to disk, rename the envelope file
+			'tmp' to 'fn', and flush the directory. Blocks until this is done.
+			Raises a CommitError if it failed.
+		"""
+		c = _Commit(directory, files, tmp, fn)
+		with self._cond:
+			self._pending.append(c)
+			self._cond.notify_all()
+			while not c.done:
+				self._cond.wait()
+		if c.error != None:
+			raise CommitError(c.error)
+
+
+	def _run(self):
+		while True:
+			with self._cond:
+				while len(self._pending) == 0:
+					self._cond.wait()
+				batch = self._pending
+				self._pending = []
+			try:
+				self._commit(batch)
+			except:
+				for c in batch:
+					c.error = c.error or str(sys.exc_info()[1])
+			with self._cond:
+				self.batches += 1
+				self.mails += len(batch)
+				for c in batch:
+					c.done = True
+				self._cond.notify_all()
+
+
+	def _commit(self, batch):
+		directories = set([ c.directory for c in batch ])
+		files = [ f for c in batch for f in c.files ]
+		if self._syncfs != None and len(files) >= self.syncfsFiles:
+			for d in directories:
+				fd = os.open(d, os.O_RDONLY)
+				try:
+					if self._syncfs(fd) != 0:
+						raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+				finally:
+					os.close(fd)
+		else:
+			for f in files:
+				fd = os.open(f, os.O_RDWR)
+				try:
+					os.fsync(fd)
+				finally:
+					os.close(fd)
+		for c in batch:
+			try:
+				os.rename(c.tmp, c.fn)
+			except OSError as e:
+				c.error = str(e)
+		for d in directories:
+			try:
+				syncDirectory(d)
+			except OSError as e:
+				for c in batch:
+					if c.directory == d:
+						c.error = c.error or str(e)
+
+
+
+def syncDirectory(directory):
+	""" Flush the entries of 'directory' to disk, e.g. after a rename. This is
+		not possible on all systems; then nothing is done.
+	"""
+	try:
+		fd = os.open(directory, os.O_RDONLY)
+	except OSError:
+		return
+	try:
+		os.fsync(fd)
+	except OSError as e:
+		if e.errno not in (errno.EINVAL, errno.EBADF):
+			raise
+	finally:
+		os.close(fd)
+
+
+def claim(fn, maxAge = None):
+	""" Try to claim the spooled file 'fn'. Returns True if the claim was
+		successful, or False if the file is already claimed or doesn't exist
+		anymore. If 'maxAge' is given then an existing lease whose owner
+		doesn't exist anymore, or that wasn't renewed for 'maxAge' seconds,
+		is broken and the file is claimed.
+	"""
+	lease = fn + leaseSuffix
+	if not _createLease(lease):
+		owner = _leaseOwner(lease)
+		if maxAge == None or owner == None or not _leaseStale(lease, owner, maxAge):
+			return False
+		if not _breakLease(lease, owner) or not _createLease(lease):
+			return False
+	if not os.path.exists(fn):
+		# Delivered and removed by another worker in the meantime
+		release(fn)
+		return False
+	return True
+
+
+def _createLease(lease):
+	""" Create the lease file 'lease' for this process. Returns False if it
+		already exists.
+	"""
+	tmp = lease + '.' + str(os.getpid()) + '.' + str(threading.current_thread().ident) + tmpSuffix
+	with open(tmp, 'wb') as f:
+		f.write(str(os.getpid()).encode())
+	try:
+		os.link(tmp, lease)
+	except OSError as e:
+		if e.errno == errno.EEXIST:
+			return False
+		raise
+	finally:
+		os.remove(tmp)
+	return True
+
+
+def renew(fn):
+	""" Renew the claim on the spooled file 'fn', so that it isn't broken
+		because of its age.
+	"""
+	try:
+		os.utime(fn + leaseSuffix, None)
+	except OSError:
+		pass
+
+
+def release(fn):
+	""" Release the claim on the spooled file 'fn'.
+	"""
+	try:
+		os.remove(fn + leaseSuffix)
+	except OSError:
+		pass
+
+
+def remove(fn):
+	""" Remove the claimed mail with the envelope file 'fn' together with its
+		message file and its lease.
+	"""
+	os.remove(fn)
+	try:
+		os.remove(messageFile(fn))
+	except OSError:
+		pass
+	release(fn)
+
+
+def recoverLeases(directory, pid = None, maxAge = None):
+	""" Remove the leases in 'directory' whose owning process doesn't exist
+		anymore, or that weren't renewed for 'maxAge' seconds, or only those
+		of the process 'pid', so that the mails can be delivered again.
+		Returns the list of the envelope file names (without the directory)
+		of the recovered mails.
+	"""
+	names = []
+	for e in os.listdir(directory):
+		if not e.endswith(leaseSuffix):
+			continue
+		fn = os.path.join(directory, e)
+		owner = _leaseOwner(fn)
+		if owner == None:
+			continue
+		if pid != None:
+			if owner != pid:
+				continue
+		elif owner != os.getpid() and not _leaseStale(fn, owner, maxAge):
+			continue
+		if _breakLease(fn, owner):
+			names.append(e[:-len(leaseSuffix)])
+	return names
+
+
+def _leaseOwner(fn):
+	""" Return the pid in the lease file 'fn', 0 if it can't be read, or
+		None if the file doesn't exist anymore.
+	"""
+	try:
+		with open(fn) as f:
+			return int(f.read() or 0)
+	except (OSError, ValueError):
+		return None if not os.path.exists(fn) else 0
+
+
+def _leaseStale(fn, owner, maxAge):
+	""" Check whether the lease file 'fn' of the process 'owner' is stale:
+		its owner doesn't exist anymore, or it wasn't renewed for 'maxAge'
+		seconds.
+	"""
+	if owner != os.getpid() and not pidAlive(owner):
+		return True
+	if maxAge == None:
+		return False
+	try:
+		return time.time() - os.path.getmtime(fn) > maxAge
+	except OSError:
+		return False
+
+
+def _breakLease(fn, owner):
+	""" Remove a stale lease. The lease is renamed first, so that a new lease
+		that another worker created in the meantime is not removed: if the
+		renamed lease isn't the stale one it is put back.
+	"""
+	tmp = fn + '.' + str(os.getpid()) + tmpSuffix
+	try:
+		os.rename(fn, tmp)
+	except OSError:
+		return False
+	if _leaseOwner(tmp) != owner:
+		try:
+			os.link(tmp, fn)
+		except OSError:
+			pass
+		os.remove(tmp)
+		return False
+	os.remove(tmp)
+	return True
+
+
+def pidAlive(pid):
+	""" Check whether a process with the given pid exists.
+	"""
+	if pid <= 0:
+		return False
+	try:
+		os.kill(pid, 0)
+	except OSError as e:
+		return e.errno == errno.EPERM
+	return True
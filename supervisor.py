@@ -0,0 +1,127 @@
+#
+# supervisor.py
+#
+# Author: Andreas Kraft (akr@mheg.org)
+#
+# DISCLAIMER
+# You are free to use this code in any way you like, subject to the
+# Python disclaimers & copyrights. I make no representations about the
+# suitability of this software for any purpose. It is provided "AS-IS"
+# without warranty of any kind, either express or implied. So there.
+#
+"""	Runs the proxy in several processes.
+
+	The supervisor forks the worker processes, e.g. receivers that share the
+	SMTP port and delivery processes, and starts them again when they exit.
+	Signals that are sent to the supervisor are forwarded to the workers.
+	The supervisor itself only waits for its workers. Forking requires a
+	POSIX system.
+"""
+
+import os, signal, sys, time
+
+
+class Supervisor:
+	""" Starts and watches the worker processes.
+
+		* onExit - An optional function that is called with the name, the
+		  number and the pid of a worker that exited, before it is started
+		  again.
+		* forward - The signals that are forwarded to the workers.
+	"""
+
+	# A worker that exits within this many seconds after its start is
+	# started again only after this time has passed.
+	restartDelay = 1
+
+	def __init__(self, log, onExit = None, forward = None):
+		self._log = log
+		self._onExit = onExit
+		self._forward = forward if forward != None else []
+		self._roles = []		# list of (name, function, count)
+		self._workers = {}		# pid -> (name, number, function, start time)
+		self._stopping = False
+
+
+	def add(self, name, function, count):
+		""" Add 'count' workers that run 'function(number)', where 'number' is
+			the number of the worker (0..count-1). A worker exits when the
+			function returns.
+		"""
+		self._roles.append((name, function, count))
+
+
+	def run(self):
+		""" Start all workers and watch them until the supervisor gets a
+			SIGTERM or SIGINT, which is passed on to the workers.
+		"""
+		signal.signal(signal.SIGTERM, self._stop)
+		signal.signal(signal.SIGINT, self._stop)
+		for s in self._forward:
+			signal.signal(s, self._forwardSignal)
+		for (name, function, count) in self._roles:
+			for n in range(count):
+				self._start(name, n, function)
+		while len(self._workers) > 0:
+			try:
+				(pid, status) = os.wait()
+			except ChildProcessError:
+				break
+			if pid not in self._workers:
+				continue
+			(name, n, function, started) = self._workers.pop(pid)
+			if self._stopping:
+				continue
+			self._log.logerr('Process ' + name + '-' + str(n) + ' (' + str(pid) + ') exited with status ' + str(status) + ', restarting')
+			if self._onExit != None:
+				try:
+					self._onExit(name, n, pid)
+				except:
+					self._log.logerr('Cleaning up after process ' + str(pid) + ' caught exception: ' +  str(sys.exc_info()[0]) +": " + str(sys.exc_info()[1]))
+			if time.time() - started < self.restartDelay:
+				time.sleep(self.restartDelay)
+			if not self._stopping:
+				self._start(name, n, function)
+		self._log.log('All processes stopped')
+
+
+	def _start(self, name, n, function):
+		pid = os.fork()
+		if pid != 0:
+			self._workers[pid] = (name, n, function, time.time())
+			self._log.log('Started process ' + name + '-' + str(n) + ' (' + str(pid) + ')')
+			return
+		# In the worker process
+		status = 0
+		try:
+			signal.signal(signal.SIGTERM, signal.SIG_DFL)
+			signal.signal(signal.SIGINT, signal.SIG_DFL)
+			# Forwarded signals are ignored until the worker handles them
+			for s in self._forward:
+				signal.signal(s, signal.SIG_IGN)
+			function(n)
+		except SystemExit as e:
+			status = e.code if isinstance(e.code, int) else 1
+		except:
+			self._log.logerr('Process ' + name + '-' + str(n) + ' caught exception: ' +  str(sys.exc_info()[0]) +": " + str(sys.exc_info()[1]))
+			status = 1
+		finally:
+			try:
+				self._log.flush()
+			except:
+				pass
+			os._exit(status)
+
+
+	def _stop(self, signum, frame):
+		self._stopping = True
+		self._log.log('Stopping all processes')
+		self._forwardSignal(signal.SIGTERM, frame)
+
+
+	def _forwardSignal(self, signum, frame):
+		for pid in list(self._workers.keys()):
+			try:
+				os.kill(pid, signum)
+			except OSError:
+				pass
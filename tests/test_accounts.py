@@ -0,0 +1,97 @@
+#
+# test_accounts.py
+#
+# Author: Andreas Kraft (akr@mheg.org)
+#
+# DISCLAIMER
+# You are free to use this code in any way you like, subject to the
+# Python disclaimers & copyrights. I make no representations about the
+# suitability of this software for any purpose. It is provided "AS-IS"
+# without warranty of any kind, either express or implied. So there.
+#
+"""	Tests of the resolution of sender addresses to mail accounts.
+
+	Run with: python -m unittest discover tests
+"""
+
+import os, sys, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import accounts
+
+
+class Account:
+	def __init__(self, name, useconfig = None):
+		self.name = name
+		self.useconfig = useconfig
+
+
+
+def resolver(*items):
+	""" Return a resolver for the accounts with the (name, useconfig) tuples
+		'items'.
+	"""
+	return accounts.AccountResolver(dict([ (name, Account(name, use)) for (name, use) in items ]))
+
+
+
+class TestAccountResolver(unittest.TestCase):
+
+	def name(self, r, address):
+		account = r.resolve(address)
+		return account.name if account != None else None
+
+
+	def test_rules(self):
+		r = resolver(('a@example.com', None), ('*@example.com', None), ('*@*.example.com', None), ('*@*.sub.example.com', None), ('default', None))
+		self.assertEqual(self.name(r, 'a@example.com'), 'a@example.com')
+		self.assertEqual(self.name(r, 'b@example.com'), '*@example.com')
+		self.assertEqual(self.name(r, 'b@mail.example.com'), '*@*.example.com')
+		self.assertEqual(self.name(r, 'b@mail.sub.example.com'), '*@*.sub.example.com')
+		self.assertEqual(self.name(r, 'b@example.org'), None)
+		self.assertEqual(self.name(r, 'b@notexample.com'), None)
+		self.assertEqual(self.name(r, 'default'), 'default')
+
+
+	def test_subdomainRuleDoesntMatchTheDomain(self):
+		r = resolver(('*@*.example.com', None))
+		self.assertEqual(self.name(r, 'a@example.com'), None)
+
+
+	def test_caseInsensitive(self):
+		r = resolver(('A@Example.com', None), ('*@Example.org', None))
+		self.assertEqual(self.name(r, 'a@EXAMPLE.COM'), 'A@Example.com')
+		self.assertEqual(self.name(r, 'B@example.ORG'), '*@Example.org')
+		# Remembered lookups don't mix up addresses
+		self.assertEqual(self.name(r, 'a@EXAMPLE.COM'), 'A@Example.com')
+		self.assertEqual(self.name(r, 'c@example.net'), None)
+
+
+	def test_useReferences(self):
+		r = resolver(('a@example.com', 'b@example.com'), ('b@example.com', 'c@example.com'), ('c@example.com', None))
+		self.assertEqual(self.name(r, 'a@example.com'), 'c@example.com')
+		self.assertEqual(r.account('a@example.com').name, 'c@example.com')
+		self.assertEqual(r.account('c@example.com').name, 'c@example.com')
+		self.assertEqual(r.account('d@example.com'), None)
+
+
+	def test_missingReference(self):
+		self.assertRaises(ValueError, resolver, ('a@example.com', 'b@example.com'))
+
+
+	def test_cyclicReferences(self):
+		self.assertRaises(ValueError, resolver, ('a@example.com', 'b@example.com'), ('b@example.com', 'a@example.com'))
+		self.assertRaises(ValueError, resolver, ('a@example.com', 'a@example.com'))
+
+
+	def test_cacheSize(self):
+		r = resolver(('*@example.com', None))
+		r.cacheSize = 10
+		for i in range(25):
+			self.assertEqual(self.name(r, str(i) + '@example.com'), '*@example.com')
+		self.assertLessEqual(len(r._cache), 10)
+
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,169 @@
+#
+# test_delivery.py
+#
+# Author: Andreas Kraft (akr@mheg.org)
+#
+# DISCLAIMER
+# You are free to use this code in any way you like, subject to the
+# Python disclaimers & copyrights. I make no representations about the
+# suitability of this software for any purpose. It is provided "AS-IS"
+# without warranty of any kind, either express or implied. So there.
+#
+"""	Tests of the scheduling of mails for delivery.
+
+	Run with: python -m unittest discover tests
+"""
+
+import os, shutil, sys, tempfile, time, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import accounts, delivery, queueindex, spool, smtpproxy
+
+
+class NullLog:
+	def log(self, msg, *args):
+		pass
+	logdebug = logwarn = logerr = log
+
+
+
+class TestDeliveryQueue(unittest.TestCase):
+
+	def test_releasedMailCanBeQueuedAgain(self):
+		q = delivery.DeliveryQueue()
+		q.put('a', 1, 'm1', None)
+		q.put('a', 1, 'm2', None)
+		(key, items) = q.get(2)
+		q.release('m2')
+		self.assertNotIn('m2', q)
+		self.assertIn('m1', q)
+		self.assertTrue(q.put('a', 1, 'm2', None))
+		q.done(key, [ id for (id, item) in items ])
+		# The mail that was queued again is not lost with the end of the batch
+		self.assertNotIn('m1', q)
+		self.assertIn('m2', q)
+
+
+
+class TestBatchRetry(unittest.TestCase):
+	""" A mail that fails in a batch is scheduled again for its next attempt,
+		also when that attempt is due before the batch is finished.
+	"""
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.index = queueindex.QueueIndex(self.directory)
+		account = smtpproxy.MailAccount()
+		account.name = 'account'
+		account.rsmtphost = 'localhost'
+		self.saved = dict([ (n, getattr(smtpproxy, n)) for n in ('mlog', 'msgdir', 'queueIndex', 'deliveryQueue', 'accountResolver', 'retrydelay', 'deleteonerror', 'sendMails') if hasattr(smtpproxy, n) ])
+		smtpproxy.mlog = NullLog()
+		smtpproxy.msgdir = self.directory
+		smtpproxy.queueIndex = self.index
+		smtpproxy.deliveryQueue = delivery.DeliveryQueue()
+		smtpproxy.accountResolver = accounts.AccountResolver({ 'account' : account })
+		smtpproxy.retrydelay = 0
+		smtpproxy.deleteonerror = False
+
+
+	def tearDown(self):
+		for (n, v) in self.saved.items():
+			setattr(smtpproxy, n, v)
+		if 'mlog' not in self.saved:
+			del smtpproxy.mlog
+		self.index.close()
+		shutil.rmtree(self.directory, ignore_errors=True)
+
+
+	def test_failedMailOfBatchIsScheduledAgain(self):
+		names = []
+		for i in range(2):
+			fn = spool.store(self.directory, b'Subject: test\r\n\r\ntest\r\n', spool.Envelope('a@example.com', [ 'b@example.com' ], 'account'))
+			self.index.add(os.path.basename(fn), spool.readEnvelope(fn))
+			names.append(fn)
+		smtpproxy.scheduleMails()
+		(key, items) = smtpproxy.deliveryQueue.get(2)
+		self.assertEqual(len(items), 2)
+
+		def sendMails(account, mails, finished):
+			# The first mail is sent, the second fails, and its next attempt
+			# is due before the batch is finished.
+			(ok, failed) = mails
+			finished(ok[1], ok[0], True)
+			finished(failed[1], failed[0], False)
+			time.sleep(0.01)
+			smtpproxy.scheduleMails()
+			return [ True, False ]
+
+		smtpproxy.sendMails = sendMails
+		try:
+			smtpproxy.deliverMails(key, items)
+		finally:
+			smtpproxy.deliveryQueue.done(key, [ id for (id, item) in items ])
+		self.assertFalse(os.path.exists(names[0]))
+		self.assertIn(names[1], smtpproxy.deliveryQueue)
+		self.assertNotIn(names[0], smtpproxy.deliveryQueue)
+		self.assertEqual(self.index.count(), 1)
+
+
+	def test_mailOfAccountThatBecameAnAlias(self):
+		fn = spool.store(self.directory, b'Subject: test\r\n\r\ntest\r\n', spool.Envelope('a@example.com', [ 'b@example.com' ], 'account'))
+		self.index.add(os.path.basename(fn), spool.readEnvelope(fn))
+		# After a reload 'account' uses the data of 'other'
+		alias = smtpproxy.MailAccount()
+		alias.name = 'account'
+		alias.useconfig = 'other'
+		other = smtpproxy.MailAccount()
+		other.name = 'other'
+		other.rsmtphost = 'localhost'
+		smtpproxy.accountResolver = accounts.AccountResolver({ 'account' : alias, 'other' : other })
+		smtpproxy.scheduleMails()
+		(key, items) = smtpproxy.deliveryQueue.get(1)
+		self.assertEqual(key, 'other')
+		self.assertEqual(items[0][0], fn)
+
+
+
+class FailingPool:
+	""" A connection pool whose server can't be reached.
+	"""
+	def __init__(self):
+		self.connects = 0
+
+	def acquire(self, account):
+		self.connects += 1
+		raise ConnectionRefusedError(111, 'Connection refused')
+
+
+
+class TestSendMails(unittest.TestCase):
+
+	def setUp(self):
+		self.saved = dict([ (n, getattr(smtpproxy, n)) for n in ('mlog', 'smtpPool') if hasattr(smtpproxy, n) ])
+		smtpproxy.mlog = NullLog()
+		smtpproxy.smtpPool = FailingPool()
+
+
+	def tearDown(self):
+		for (n, v) in self.saved.items():
+			setattr(smtpproxy, n, v)
+		if 'mlog' not in self.saved:
+			del smtpproxy.mlog
+
+
+	def test_batchFailsAfterFailedConnect(self):
+		account = smtpproxy.MailAccount()
+		account.name = 'account'
+		mails = [ (spool.Envelope('a@example.com', [ 'b@example.com' ], 'account'), '/nonexistent/' + str(i) + '.env') for i in range(5) ]
+		finished = []
+		results = smtpproxy.sendMails(account, mails, lambda fn, envelope, ok: finished.append(ok))
+		self.assertEqual(results, [ False ] * 5)
+		self.assertEqual(finished, [ False ] * 5)
+		self.assertEqual(smtpproxy.smtpPool.connects, 1)
+		for (envelope, fn) in mails:
+			self.assertIn('Connection refused', envelope.lastError)
+
+
+
+if __name__ == '__main__':
+	unittest.main()
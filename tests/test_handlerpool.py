@@ -0,0 +1,58 @@
+#
+# test_handlerpool.py
+#
+# Author: Andreas Kraft (akr@mheg.org)
+#
+# DISCLAIMER
+# You are free to use this code in any way you like, subject to the
+# Python disclaimers & copyrights. I make no representations about the
+# suitability of this software for any purpose. It is provided "AS-IS"
+# without warranty of any kind, either express or implied. So there.
+#
+"""	Tests of the pool of mail handler processes.
+
+	Run with: python -m unittest discover tests
+"""
+
+import os, sys, threading, time, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import handlerpool
+
+
+class NullLog:
+	def log(self, msg, *args):
+		pass
+	logdebug = logwarn = logerr = log
+
+
+
+class TestHandlerPool(unittest.TestCase):
+
+	def busyPool(self):
+		""" Return a pool whose only worker is busy.
+		"""
+		pool = handlerpool.HandlerPool({}, '.', 1, NullLog())
+		pool._count = 1
+		return pool
+
+
+	def test_waitForWorkerTimesOut(self):
+		pool = self.busyPool()
+		started = time.time()
+		self.assertRaises(handlerpool.HandlerTimeout, pool.call, 'Handler', None, None, 'a@example.com', [ 'b@example.com' ], 0.2)
+		self.assertLess(time.time() - started, 2)
+
+
+	def test_releasedWorkerIsTaken(self):
+		pool = self.busyPool()
+		worker = (None, None)
+		t = threading.Timer(0.1, pool._release, (worker,))
+		t.start()
+		self.assertIs(pool._acquire(time.time() + 5), worker)
+		t.join()
+
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,136 @@
+#
+# test_headers.py
+#
+# Author: Andreas Kraft (akr@mheg.org)
+#
+# DISCLAIMER
+# You are free to use this code in any way you like, subject to the
+# Python disclaimers & copyrights. I make no representations about the
+# suitability of this software for any purpose. It is provided "AS-IS"
+# without warranty of any kind, either express or implied. So there.
+#
+"""	Tests of the lazily parsed messages.
+
+	Run with: python -m unittest discover tests
+"""
+
+import email, io, os, sys, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import headers
+
+
+message = b'From: a@example.com\r\nSubject: test\r\n\r\nbody \xe4\r\n'
+
+
+def lazyMessage(data = message):
+	fp = io.BytesIO(data)
+	(fields, separator) = headers.readHeader(fp)
+	return headers.LazyMessage(fields, separator, fp)
+
+
+def serialized(m):
+	(fields, separator, fp) = m.serialize()
+	return b''.join(fields) + separator + fp.read()
+
+
+
+class TestLazyMessage(unittest.TestCase):
+
+	def test_unchangedMessageIsNotParsed(self):
+		m = lazyMessage()
+		self.assertEqual(m['Subject'], 'test')
+		self.assertEqual(m.get_content_type(), 'text/plain')
+		self.assertEqual(m.changed(), None)
+		self.assertEqual(m._full, None)
+		self.assertEqual(serialized(m), message)
+
+
+	def test_changedHeaderKeepsBody(self):
+		m = lazyMessage()
+		m['X-Test'] = 'yes'
+		del m['Subject']
+		self.assertEqual(m.changed(), 'headers')
+		self.assertEqual(m._full, None)
+		self.assertEqual(serialized(m), b'From: a@example.com\r\nX-Test: yes\r\n\r\nbody \xe4\r\n')
+
+
+	def test_fullMessageIsParsedOnDemand(self):
+		m = lazyMessage()
+		self.assertIn('body', m.get_payload())
+		self.assertNotEqual(m._full, None)
+		self.assertEqual(m.changed(), None)
+		self.assertEqual(serialized(m), message)
+
+
+	def test_headerChangesAreKeptByTheFullMessage(self):
+		m = lazyMessage()
+		m['X-Test'] = 'yes'
+		m.get_payload()
+		self.assertEqual(m['X-Test'], 'yes')
+		self.assertEqual(m.changed(), 'headers')
+
+
+	def test_changedBody(self):
+		m = lazyMessage()
+		m.set_payload('new body')
+		m.modified()
+		self.assertEqual(m.changed(), 'body')
+		self.assertEqual(serialized(m), b'From: a@example.com\r\nSubject: test\r\n\r\nnew body')
+
+
+	def test_replacedMessage(self):
+		m = lazyMessage()
+		m.modified(email.message_from_string('Subject: other\n\nreplaced body'))
+		self.assertEqual(m.changed(), 'body')
+		self.assertEqual(m['Subject'], 'other')
+		self.assertEqual(serialized(m), b'Subject: other\r\n\r\nreplaced body')
+
+
+	def test_headersOnly(self):
+		m = lazyMessage()
+		self.assertEqual(m.toBytes(True), b'From: a@example.com\r\nSubject: test\r\n\r\n')
+		self.assertEqual(m.toBytes(), message)
+
+
+
+class TestHandlerChain(unittest.TestCase):
+	""" The handlers of a chain work on the same message, and each one's
+		result is announced with modified(), like smtpproxy does.
+	"""
+
+	def callHandlers(self, m, handlers):
+		for h in handlers:
+			m.modified(h(m))
+
+
+	def test_returnedMessageThenPayload(self):
+		m = lazyMessage()
+		payloads = []
+		self.callHandlers(m, [ lambda m: m, lambda m: payloads.append(m.get_payload()) or m ])
+		self.assertIn('body', payloads[0])
+		self.assertEqual(m.changed(), 'body')
+
+
+	def test_returnedMessageIsNotAChange(self):
+		m = lazyMessage()
+		self.callHandlers(m, [ lambda m: m, lambda m: m ])
+		self.assertEqual(m.changed(), None)
+		self.assertEqual(serialized(m), message)
+
+
+	def test_headerChangeThenPayload(self):
+		def setHeader(m):
+			m['X-Test'] = 'yes'
+			return m
+		m = lazyMessage()
+		payloads = []
+		self.callHandlers(m, [ setHeader, lambda m: payloads.append(m.get_payload()) or m ])
+		self.assertIn('body', payloads[0])
+		self.assertEqual(m['X-Test'], 'yes')
+		self.assertIn(b'X-Test: yes\r\n', serialized(m))
+
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,86 @@
+#
+# test_metrics.py
+#
+# Author: Andreas Kraft (akr@mheg.org)
+#
+# DISCLAIMER
+# You are free to use this code in any way you like, subject to the
+# Python disclaimers & copyrights. I make no representations about the
+# suitability of this software for any purpose. It is provided "AS-IS"
+# without warranty of any kind, either express or implied. So there.
+#
+"""	Tests of the metrics server.
+
+	Run with: python -m unittest discover tests
+"""
+
+import os, sys, unittest
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import metrics
+
+
+class NullLog:
+	def log(self, msg, *args):
+		pass
+	logdebug = logwarn = logerr = log
+
+
+
+class TestMetricsServer(unittest.TestCase):
+
+	def setUp(self):
+		self.calls = []
+		self.server = metrics.startServer(0, '127.0.0.1', NullLog(), { '/action' : self.action })
+		self.url = 'http://127.0.0.1:' + str(self.server.server_address[1])
+
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+
+	def action(self, query):
+		count = int(query.get('count', 1))
+		self.calls.append(count)
+		return 'done ' + str(count) + '\n'
+
+
+	def request(self, path, method = 'GET', data = None):
+		""" Return the status and the body of the response to a request.
+		"""
+		try:
+			with urlopen(Request(self.url + path, data=data, method=method), timeout=5) as r:
+				return (r.status, r.read())
+		except HTTPError as e:
+			return (e.code, None)
+
+
+	def test_metrics(self):
+		(status, body) = self.request('/metrics')
+		self.assertEqual(status, 200)
+
+
+	def test_actionNeedsPost(self):
+		self.assertEqual(self.request('/action'), (405, None))
+		self.assertEqual(self.calls, [])
+		self.assertEqual(self.request('/action?count=2', 'POST'), (200, b'done 2\n'))
+		self.assertEqual(self.request('/action', 'POST', b'count=3'), (200, b'done 3\n'))
+		self.assertEqual(self.calls, [ 2, 3 ])
+
+
+	def test_wrongParameter(self):
+		self.assertEqual(self.request('/action?count=x', 'POST')[0], 400)
+		self.assertEqual(self.calls, [])
+
+
+	def test_unknownPath(self):
+		self.assertEqual(self.request('/nothing')[0], 404)
+		self.assertEqual(self.request('/nothing', 'POST')[0], 404)
+
+
+
+if __name__ == '__main__':
+	unittest.main()
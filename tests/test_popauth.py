@@ -0,0 +1,154 @@
+#
+# test_popauth.py
+#
+# Author: Andreas Kraft (akr@mheg.org)
+#
+# DISCLAIMER
+# You are free to use this code in any way you like, subject to the
+# Python disclaimers & copyrights. I make no representations about the
+# suitability of this software for any purpose. It is provided "AS-IS"
+# without warranty of any kind, either express or implied. So there.
+#
+"""	Tests of the POP-before-SMTP authentication cache.
+
+	Run with: python -m unittest discover tests
+"""
+
+import os, poplib, sys, time, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config, popauth, smtpproxy
+
+
+class NullLog:
+	def log(self, msg, *args):
+		pass
+	logdebug = logwarn = logerr = log
+
+
+
+class FakePOP3:
+	""" Counts the logins instead of connecting to a POP3 server.
+	"""
+	logins = 0
+	fail = False
+
+	def __init__(self, host, port, timeout = None):
+		pass
+
+	def user(self, user):
+		pass
+
+	def pass_(self, password):
+		FakePOP3.logins += 1
+		if FakePOP3.fail:
+			raise poplib.error_proto('-ERR Authentication failed')
+
+	def quit(self):
+		pass
+
+
+
+class TestPopAuthCache(unittest.TestCase):
+
+	def setUp(self):
+		self.pop3 = (poplib.POP3, poplib.POP3_SSL)
+		poplib.POP3 = poplib.POP3_SSL = FakePOP3
+		FakePOP3.logins = 0
+		FakePOP3.fail = False
+		self.account = smtpproxy.MailAccount()
+		self.account.name = 'account'
+		self.account.rPBS = True
+		self.account.rpophost = 'localhost'
+		self.account.rpopcheckdelay = 7
+
+
+	def tearDown(self):
+		(poplib.POP3, poplib.POP3_SSL) = self.pop3
+
+
+	def waitFor(self, cache, result = None):
+		""" Check the account until the check returns 'result'.
+		"""
+		deadline = time.time() + 5
+		while time.time() < deadline:
+			if cache.check(self.account) == result:
+				return
+			time.sleep(0.01)
+		self.fail('Timeout')
+
+
+	def test_loginIsCached(self):
+		cache = popauth.PopAuthCache(NullLog(), 0)
+		self.assertNotEqual(cache.check(self.account), None)
+		self.waitFor(cache)
+		self.assertEqual(cache.check(self.account), None)
+		self.assertEqual(FakePOP3.logins, 1)
+
+
+	def test_mailsWaitAfterLogin(self):
+		cache = popauth.PopAuthCache(NullLog(), 2)
+		self.account.rpopcheckdelay = 60
+		started = time.time()
+		when = cache.check(self.account)
+		self.assertGreaterEqual(when, started + 2)
+		time.sleep(0.2)
+		when = cache.check(self.account)
+		self.assertGreaterEqual(when, started + 2)
+		self.assertLess(when, time.time() + 2)
+		self.assertEqual(FakePOP3.logins, 1)
+
+
+	def test_loginIsNotRefreshedRightAway(self):
+		cache = popauth.PopAuthCache(NullLog(), 0)
+		self.waitFor(cache)
+		time.sleep(1)
+		self.assertEqual(FakePOP3.logins, 1)
+
+
+	def test_failedLogin(self):
+		FakePOP3.fail = True
+		cache = popauth.PopAuthCache(NullLog(), 0)
+		cache.check(self.account)
+		deadline = time.time() + 5
+		while time.time() < deadline:
+			try:
+				cache.check(self.account)
+			except popauth.PopAuthError:
+				break
+			time.sleep(0.01)
+		else:
+			self.fail('Timeout')
+		# Not tried again before 'retryAfter'
+		self.assertRaises(popauth.PopAuthError, cache.check, self.account)
+		self.assertEqual(FakePOP3.logins, 1)
+
+
+	def test_forget(self):
+		cache = popauth.PopAuthCache(NullLog(), 0)
+		self.waitFor(cache)
+		cache.forget(self.account.name)
+		self.assertNotEqual(cache.check(self.account), None)
+		self.waitFor(cache)
+		self.assertEqual(FakePOP3.logins, 2)
+
+
+
+class TestPopCheckDelay(unittest.TestCase):
+
+	def readAccounts(self, popcheckdelay):
+		c = config.Config()
+		c.read_string('[a@example.com]\nsmtphost=localhost\npopbeforesmtp=true\npophost=localhost\npopusername=u\npoppassword=p\npopcheckdelay=' + str(popcheckdelay) + '\n')
+		return smtpproxy.readAccounts(c)
+
+
+	def test_popCheckDelayMustExceedWaitAfterPop(self):
+		waitafterpop = smtpproxy.waitafterpop
+		self.assertRaises(ValueError, self.readAccounts, waitafterpop + popauth.PopAuthCache.refreshMargin)
+		resolver = self.readAccounts(waitafterpop + popauth.PopAuthCache.refreshMargin + 1)
+		self.assertEqual(resolver.account('a@example.com').rpopcheckdelay, waitafterpop + popauth.PopAuthCache.refreshMargin + 1)
+
+
+
+if __name__ == '__main__':
+	unittest.main()
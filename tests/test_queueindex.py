@@ -0,0 +1,54 @@
+#
+# test_queueindex.py
+#
+# Author: Andreas Kraft (akr@mheg.org)
+#
+# DISCLAIMER
+# You are free to use this code in any way you like, subject to the
+# Python disclaimers & copyrights. I make no representations about the
+# suitability of this software for any purpose. It is provided "AS-IS"
+# without warranty of any kind, either express or implied. So there.
+#
+"""	Tests of the queue index.
+
+	Run with: python -m unittest discover tests
+"""
+
+import os, shutil, sys, tempfile, time, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import queueindex, spool
+
+
+class TestQueueIndex(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.index = queueindex.QueueIndex(self.directory)
+
+
+	def tearDown(self):
+		self.index.close()
+		shutil.rmtree(self.directory, ignore_errors=True)
+
+
+	def test_addWithoutReplaceKeepsHold(self):
+		self.assertTrue(self.index.add('m.env', spool.Envelope('a@example.com', [ 'b@example.com' ], 'account')))
+		self.assertEqual(self.index.take(10, 600), [ 'm.env' ])
+		# A rewritten envelope that is seen again doesn't clear the hold
+		self.assertFalse(self.index.add('m.env', spool.Envelope('a@example.com', [ 'b@example.com' ], 'account'), False))
+		self.assertEqual(self.index.take(10, 600), [])
+		self.assertGreater(self.index.nextDue(), time.time() + 500)
+
+
+	def test_usageCountsSizeOfMessageFiles(self):
+		self.assertEqual(self.index.usage(), (0, 0))
+		for body in (b'Subject: a\r\n\r\na\r\n', b'Subject: b\r\n\r\nbb\r\n'):
+			fn = spool.store(self.directory, body, spool.Envelope('a@example.com', [ 'b@example.com' ], 'account'))
+			self.index.add(os.path.basename(fn), spool.readEnvelope(fn))
+		self.assertEqual(self.index.usage(), (2, 35))
+
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,164 @@
+#
+# test_smtps.py
+#
+# Author: Andreas Kraft (akr@mheg.org)
+#
+# DISCLAIMER
+# You are free to use this code in any way you like, subject to the
+# Python disclaimers & copyrights. I make no representations about the
+# suitability of this software for any purpose. It is provided "AS-IS"
+# without warranty of any kind, either express or implied. So there.
+#
+"""	Tests of the SMTP server engine.
+
+	Run with: python -m unittest discover tests
+"""
+
+import os, sys, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import smtps
+
+
+class TestDataReceiver(unittest.TestCase):
+
+	def receive(self, chunks, limit = 0):
+		""" Feed the chunks to a new receiver. Returns the receiver, the
+			stored message and whether the terminator was found.
+		"""
+		r = smtps.DataReceiver(smtps.SMTPServerOptions(), limit)
+		done = False
+		for c in chunks:
+			done = r.feed(c)
+			if done:
+				break
+		data = r.fp.read()
+		r.close()
+		return (r, data, done)
+
+
+	def test_dotStuffingIsRemoved(self):
+		(r, data, done) = self.receive([ b'Subject: x\r\n\r\n..line\r\n.\r\n' ])
+		self.assertTrue(done)
+		self.assertEqual(data, b'Subject: x\r\n\r\n.line\r\n')
+		self.assertEqual(r.size, len(data))
+
+
+	def test_dotStuffingAtTheStart(self):
+		(r, data, done) = self.receive([ b'..first\r\n.\r\n' ])
+		self.assertTrue(done)
+		self.assertEqual(data, b'.first\r\n')
+
+
+	def test_terminatorSplitAcrossChunks(self):
+		message = b'Subject: x\r\n\r\nbody\r\n..dot\r\nend\r\n.\r\n'
+		for i in range(1, len(message)):
+			(r, data, done) = self.receive([ message[:i], message[i:] ])
+			self.assertTrue(done, i)
+			self.assertEqual(data, b'Subject: x\r\n\r\nbody\r\n.dot\r\nend\r\n', i)
+
+
+	def test_byteByByte(self):
+		message = b'a\r\n..\r\n.b\r\n.\r\n'
+		(r, data, done) = self.receive([ message[i:i+1] for i in range(len(message)) ])
+		self.assertTrue(done)
+		self.assertEqual(data, b'a\r\n.\r\nb\r\n')
+
+
+	def test_dotInsideALineIsKept(self):
+		(r, data, done) = self.receive([ b'a.b\r\n.\r\n' ])
+		self.assertEqual(data, b'a.b\r\n')
+
+
+	def test_remainderAfterTerminator(self):
+		(r, data, done) = self.receive([ b'x\r\n.\r\nQUIT\r\n' ])
+		self.assertTrue(done)
+		self.assertEqual(data, b'x\r\n')
+		self.assertEqual(r.remainder, b'QUIT\r\n')
+
+
+	def test_unterminatedData(self):
+		(r, data, done) = self.receive([ b'x\r\n', b'y\r\n.' ])
+		self.assertFalse(done)
+
+
+	def test_limitIsExceeded(self):
+		(r, data, done) = self.receive([ b'x' * 10 + b'\r\n', b'y' * 10 + b'\r\n.\r\n' ], 20)
+		self.assertTrue(done)
+		self.assertTrue(r.exceeded)
+		self.assertEqual(r.size, 24)
+		self.assertEqual(data, b'')
+
+
+
+class NullLog:
+	def log(self, msg, *args):
+		pass
+	logdebug = logwarn = logerr = log
+
+
+
+class SizeInterface(smtps.SMTPServerInterface):
+	""" An application with a limit for the mails of one account.
+	"""
+	def __init__(self):
+		self.limit = None
+		self.received = []
+
+	def mailFrom(self, args):
+		self.limit = 100 if 'small@' in args else None
+
+	def maxMessageSize(self):
+		return self.limit
+
+	def dataFile(self, fp):
+		self.received.append(fp.read())
+
+
+
+class TestSize(unittest.TestCase):
+
+	def setUp(self):
+		options = smtps.SMTPServerOptions()
+		options.maxMessageSize = 1000
+		self.impl = SizeInterface()
+		self.engine = smtps.SMTPServerEngine(None, self.impl, NullLog(), options)
+		self.engine.doCommand('EHLO client')
+
+
+	def send(self, frm, message):
+		""" Send a mail and return the reply to the message data.
+		"""
+		self.assertEqual(self.engine.doCommand('MAIL FROM:<' + frm + '>')[0], '250 OK')
+		self.engine.doCommand('RCPT TO:<b@example.com>')
+		self.assertEqual(self.engine.doCommand('DATA')[0][:3], '354')
+		self.assertTrue(self.engine.feedData(message + b'.\r\n'))
+		return self.engine.finishData()
+
+
+	def test_sizeIsAnnounced(self):
+		self.assertIn('SIZE 1000', self.engine.extensions())
+
+
+	def test_declaredSize(self):
+		self.assertEqual(self.engine.doCommand('MAIL FROM:<a@example.com> SIZE=1001')[0][:3], '552')
+		self.assertEqual(self.engine.doCommand('MAIL FROM:<a@example.com> SIZE=x')[0][:3], '501')
+		self.assertEqual(self.engine.doCommand('MAIL FROM:<a@example.com> SIZE=1000')[0], '250 OK')
+
+
+	def test_largeMessageIsRefused(self):
+		self.assertEqual(self.send('a@example.com', b'x' * 1001 + b'\r\n')[:3], '552')
+		self.assertEqual(self.impl.received, [])
+		# The session goes on
+		self.assertEqual(self.send('a@example.com', b'x\r\n')[:3], '250')
+		self.assertEqual(self.impl.received, [ b'x\r\n' ])
+
+
+	def test_limitOfTheApplication(self):
+		self.assertEqual(self.send('small@example.com', b'x' * 101 + b'\r\n')[:3], '552')
+		self.assertEqual(self.send('a@example.com', b'x' * 101 + b'\r\n')[:3], '250')
+
+
+
+if __name__ == '__main__':
+	unittest.main()
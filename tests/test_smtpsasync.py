@@ -0,0 +1,97 @@
+#
+# test_smtpsasync.py
+#
+# Author: Andreas Kraft (akr@mheg.org)
+#
+# DISCLAIMER
+# You are free to use this code in any way you like, subject to the
+# Python disclaimers & copyrights. I make no representations about the
+# suitability of this software for any purpose. It is provided "AS-IS"
+# without warranty of any kind, either express or implied. So there.
+#
+"""	Tests of the asyncio based SMTP server engine.
+
+	Run with: python -m unittest discover tests
+"""
+
+import os, smtplib, socket, sys, threading, time, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import smtps, smtpsasync
+
+
+class NullLog:
+	def log(self, msg, *args):
+		pass
+	logdebug = logwarn = logerr = log
+
+
+
+class RecordingInterface(smtps.SMTPServerInterface):
+	""" Records the received messages.
+	"""
+	messages = []
+
+	def dataFile(self, fp):
+		RecordingInterface.messages.append(fp.read())
+
+
+
+class TestAsyncSMTPServer(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		s.bind(('127.0.0.1', 0))
+		cls.port = s.getsockname()[1]
+		s.close()
+		server = smtpsasync.AsyncSMTPServer(cls.port, NullLog())
+		t = threading.Thread(target=server.serve, args=(RecordingInterface,))
+		t.daemon = True
+		t.start()
+		deadline = time.time() + 5
+		while time.time() < deadline:
+			try:
+				socket.create_connection(('127.0.0.1', cls.port), 1).close()
+				break
+			except OSError:
+				time.sleep(0.05)
+
+
+	def setUp(self):
+		RecordingInterface.messages = []
+
+
+	def test_sendMails(self):
+		s = smtplib.SMTP('127.0.0.1', self.port, timeout=5)
+		try:
+			for i in range(2):
+				s.sendmail('a@example.com', [ 'b@example.com' ], 'Subject: ' + str(i) + '\r\n\r\n.dot\r\n')
+		finally:
+			s.quit()
+		self.assertEqual(RecordingInterface.messages, [ b'Subject: 0\r\n\r\n.dot\r\n', b'Subject: 1\r\n\r\n.dot\r\n' ])
+
+
+	def test_pipelining(self):
+		s = socket.create_connection(('127.0.0.1', self.port), 5)
+		f = s.makefile('rb')
+		try:
+			self.assertEqual(f.readline()[:3], b'220')
+			s.sendall(b'EHLO client\r\nMAIL FROM:<a@example.com>\r\nRCPT TO:<b@example.com>\r\nDATA\r\n')
+			replies = []
+			while len(replies) < 4:
+				line = f.readline()
+				if line[3:4] != b'-':
+					replies.append(line[:3])
+			self.assertEqual(replies, [ b'250', b'250', b'250', b'354' ])
+			s.sendall(b'Subject: x\r\n\r\nbody\r\n.\r\nQUIT\r\n')
+			self.assertEqual(f.readline()[:3], b'250')
+		finally:
+			f.close()
+			s.close()
+		self.assertEqual(RecordingInterface.messages, [ b'Subject: x\r\n\r\nbody\r\n' ])
+
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,109 @@
+#
+# test_spool.py
+#
+# Author: Andreas Kraft (akr@mheg.org)
+#
+# DISCLAIMER
+# You are free to use this code in any way you like, subject to the
+# Python disclaimers & copyrights. I make no representations about the
+# suitability of this software for any purpose. It is provided "AS-IS"
+# without warranty of any kind, either express or implied. So there.
+#
+"""	Tests of the message spool directory.
+
+	Run with: python -m unittest discover tests
+"""
+
+import os, shutil, subprocess, sys, tempfile, time, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import spool
+
+
+def deadPid():
+	""" Return the pid of a process that doesn't exist anymore.
+	"""
+	p = subprocess.Popen([ sys.executable, '-c', '' ])
+	p.wait()
+	return p.pid
+
+
+
+class TestClaim(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.fn = spool.store(self.directory, b'Subject: test\r\n\r\ntest\r\n', spool.Envelope('a@example.com', [ 'b@example.com' ]))
+
+
+	def tearDown(self):
+		shutil.rmtree(self.directory, ignore_errors=True)
+
+
+	def writeLease(self, pid):
+		with open(self.fn + spool.leaseSuffix, 'w') as f:
+			f.write(str(pid))
+
+
+	def test_claimIsExclusive(self):
+		self.assertTrue(spool.claim(self.fn))
+		self.assertFalse(spool.claim(self.fn))
+		spool.release(self.fn)
+		self.assertTrue(spool.claim(self.fn))
+
+
+	def test_claimOfRemovedMail(self):
+		self.assertTrue(spool.claim(self.fn))
+		spool.remove(self.fn)
+		self.assertFalse(spool.claim(self.fn))
+		self.assertEqual(os.listdir(self.directory), [])
+
+
+	def test_recoverLeasesOfDeadProcess(self):
+		self.writeLease(deadPid())
+		self.assertEqual(spool.recoverLeases(self.directory), [ os.path.basename(self.fn) ])
+		self.assertTrue(spool.claim(self.fn))
+
+
+	def test_recoverKeepsLeasesOfLiveProcess(self):
+		self.writeLease(os.getppid())
+		self.assertEqual(spool.recoverLeases(self.directory), [])
+		self.assertFalse(spool.claim(self.fn))
+
+
+	def test_recoverLeasesOfProcess(self):
+		self.writeLease(os.getppid())
+		self.assertEqual(spool.recoverLeases(self.directory, os.getpid()), [])
+		self.assertEqual(spool.recoverLeases(self.directory, os.getppid()), [ os.path.basename(self.fn) ])
+
+
+	def test_staleLeaseIsBroken(self):
+		self.writeLease(os.getppid())
+		self.assertFalse(spool.claim(self.fn, 3600))
+		os.utime(self.fn + spool.leaseSuffix, (time.time() - 7200, time.time() - 7200))
+		self.assertEqual(spool.recoverLeases(self.directory), [])
+		self.assertTrue(spool.claim(self.fn, 3600))
+
+
+	def test_leaseOfDeadProcessIsBrokenByClaim(self):
+		self.writeLease(deadPid())
+		self.assertFalse(spool.claim(self.fn))
+		self.assertTrue(spool.claim(self.fn, 3600))
+
+
+	def test_renewedLeaseIsKept(self):
+		self.assertTrue(spool.claim(self.fn))
+		os.utime(self.fn + spool.leaseSuffix, (time.time() - 7200, time.time() - 7200))
+		spool.renew(self.fn)
+		self.assertFalse(spool.claim(self.fn, 3600))
+
+
+	def test_recoverOldLeases(self):
+		self.writeLease(os.getppid())
+		os.utime(self.fn + spool.leaseSuffix, (time.time() - 7200, time.time() - 7200))
+		self.assertEqual(spool.recoverLeases(self.directory, maxAge=3600), [ os.path.basename(self.fn) ])
+
+
+
+if __name__ == '__main__':
+	unittest.main()
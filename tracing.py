@@ -0,0 +1,222 @@
+#
+# tracing.py
+#
+# Author: Andreas Kraft (akr@mheg.org)
+#
+# DISCLAIMER
+# You are free to use this code in any way you like, subject to the
+# Python disclaimers & copyrights. I make no representations about the
+# suitability of this software for any purpose. It is provided "AS-IS"
+# without warranty of any kind, either express or implied. So there.
+#
+"""	Per-mail stage tracing and an on-demand sampling profiler.
+
+	A sample of the received mails is traced: the time of each stage of a
+	mail, from the connection to the end of its delivery, is recorded and
+	written as one JSON line to a trace file when the mail was delivered.
+	Mails that are not sampled get a NullTrace, which records nothing. The
+	state of a trace is also stored with the mail, so that a trace can be
+	finished by another process that delivers the mail.
+
+	The Profiler periodically samples the stacks of all threads for a
+	number of seconds and writes the counted stacks to a file, in the
+	"collapsed" format that flame graph tools read.
+"""
+
+import collections, json, os, random, sys, threading, time
+
+
+class NullTrace:
+	""" The trace of a mail that is not sampled.
+	"""
+
+	sampled = False
+
+	def stamp(self, stage):
+		pass
+
+	def set(self, key, value):
+		pass
+
+
+
+class Trace:
+	""" The stage times of one mail.
+	"""
+
+	sampled = True
+
+	def __init__(self, start = None):
+		self.start = start if start != None else time.time()
+		self.stages = [ ('accept', self.start) ]
+		self.info = {}
+
+
+	def stamp(self, stage):
+		""" Record that the mail reached 'stage' now.
+		"""
+		self.stages.append((stage, time.time()))
+
+
+	def set(self, key, value):
+		""" Add some information to the trace, e.g. the account.
+		"""
+		self.info[key] = value
+
+
+	def state(self):
+		""" Return the state of the trace, which can be stored as JSON.
+		"""
+		return { 'start' : self.start, 'stages' : self.stages, 'info' : self.info }
+
+
+	@classmethod
+	def fromState(cls, state):
+		""" Return a Trace with a state from state().
+		"""
+		trace = cls(state['start'])
+		trace.stages = [ tuple(s) for s in state['stages'] ]
+		trace.info = dict(state['info'])
+		return trace
+
+
+	def toDict(self):
+		d = dict(self.info)
+		d['time'] = self.start
+		d['stages'] = collections.OrderedDict([ (s, round((t - self.start) * 1000, 3)) for (s, t) in self.stages ])
+		return d
+
+
+
+nullTrace = NullTrace()
+
+
+class Tracer:
+	""" Creates the traces of a sample of the mails and writes the finished
+		traces to 'traceFile'. 'sampleRate' is the fraction of the mails
+		that are traced (0 turns tracing off). Traces of mails that were
+		stored but not yet delivered are kept by the name of the mail, at
+		most 'maxPending' of them.
+	"""
+
+	def __init__(self, traceFile, sampleRate = 0.0, maxPending = 10000):
+		self.traceFile = traceFile
+		self.sampleRate = sampleRate
+		self.maxPending = maxPending
+		self._pending = collections.OrderedDict()	# name of the mail -> Trace
+		self._lock = threading.Lock()
+
+
+	def trace(self, start = None):
+		""" Return a new Trace if this mail is sampled, or the NullTrace.
+		"""
+		if self.sampleRate > 0 and random.random() < self.sampleRate:
+			return Trace(start)
+		return nullTrace
+
+
+	def stored(self, name, trace):
+		""" Keep the trace of a stored mail until it is delivered.
+		"""
+		if not trace.sampled:
+			return
+		with self._lock:
+			self._pending[name] = trace
+			while len(self._pending) > self.maxPending:
+				self._pending.popitem(last=False)
+
+
+	def pending(self, name, state = None, stored = None):
+		""" Return the trace of a stored mail, or the NullTrace. A trace that
+			was not stored by this process is created from its 'state' (see
+			Trace.state()), if there is one, with 'stored' as the time of its
+			'spooled' stage.
+		"""
+		if len(self._pending) > 0:
+			with self._lock:
+				trace = self._pending.get(name)
+			if trace != None:
+				return trace
+		if state == None:
+			return nullTrace
+		trace = Trace.fromState(state)
+		if stored != None:
+			trace.stages.append(('spooled', stored))
+		return trace
+
+
+	def finish(self, trace, name = None):
+		""" Write a finished trace and forget it.
+		"""
+		if not trace.sampled:
+			return
+		with self._lock:
+			if name != None:
+				self._pending.pop(name, None)
+			with open(self.traceFile, 'a') as f:
+				f.write(json.dumps(trace.toDict()) + '\n')
+
+
+
+class Profiler:
+	""" A sampling profiler for all threads of the process. It looks at the
+		stacks of all threads every 'interval' seconds.
+	"""
+
+	interval = 0.01
+
+	def __init__(self, directory, log):
+		self.directory = directory
+		self._log = log
+		self._lock = threading.Lock()
+		self.running = False
+
+
+	def start(self, seconds):
+		""" Start a capture of 'seconds' seconds in a separate thread. Returns
+			the name of the file the result is written to, or None if a
+			capture is already running.
+		"""
+		with self._lock:
+			if self.running:
+				return None
+			self.running = True
+		fn = os.path.join(self.directory, 'smtpproxy-profile-' + time.strftime('%Y%m%d-%H%M%S') + '-' + str(os.getpid()) + '.txt')
+		t = threading.Thread(target=self._run, args=(seconds, fn), name='profiler')
+		t.daemon = True
+		t.start()
+		return fn
+
+
+	def _run(self, seconds, fn):
+		self._log.log('Profiling for %d seconds', seconds)
+		counts = collections.Counter()
+		names = {}
+		samples = 0
+		own = threading.current_thread().ident
+		deadline = time.time() + seconds
+		try:
+			while time.time() < deadline:
+				for t in threading.enumerate():
+					names[t.ident] = t.name
+				for (ident, frame) in sys._current_frames().items():
+					if ident == own:
+						continue
+					stack = []
+					while frame != None:
+						code = frame.f_code
+						stack.append(code.co_name + ' (' + os.path.basename(code.co_filename) + ':' + str(code.co_firstlineno) + ')')
+						frame = frame.f_back
+					stack.append(names.get(ident, str(ident)))
+					counts[';'.join(reversed(stack))] += 1
+				samples += 1
+				time.sleep(self.interval)
+			with open(fn, 'w') as f:
+				for (stack, count) in counts.most_common():
+					f.write(stack + ' ' + str(count) + '\n')
+			self._log.log('Profile of %d samples written to %s', samples, fn)
+		except:
+			self._log.logerr('Profiling caught exception: ' +  str(sys.exc_info()[0]) +": " + str(sys.exc_info()[1]))
+		finally:
+			with self._lock:
+				self.running = False